@@ -0,0 +1,167 @@
+#!/usr/bin/env python3
+"""
+缓存预热脚本
+
+把锁文件或镜像列表提交给镜像服务的管理接口（/_admin/warm），
+由服务端解析为上游文件并批量下载，本脚本显示进度和吞吐量。
+"""
+
+import json
+import os
+import sys
+from datetime import datetime
+
+import httpx
+
+# 添加项目路径到 sys.path
+sys.path.insert(0, '/app/src')
+
+from mirrorsrun.config import ADMIN_TOKEN, SERVER_PORT
+
+
+def detect_kind(file_path: str) -> str:
+    """根据文件名推断输入类型"""
+    name = os.path.basename(file_path).lower()
+    if name == "poetry.lock":
+        return "poetry"
+    if name in ("package-lock.json", "npm-shrinkwrap.json"):
+        return "npm"
+    if name == "go.sum":
+        return "gosum"
+    if name.endswith(".txt") and "requirements" in name:
+        return "requirements"
+    return "docker"
+
+
+def print_progress(progress: dict):
+    line = (
+        f"[{progress['elapsed']:>7.1f}s] "
+        f"files: {progress['files']} | "
+        f"cached: {progress['cached']} | "
+        f"done: {progress['completed']}/{progress['submitted']} | "
+        f"failed: {progress['failed']} | "
+        f"{progress['completed_mb']:.2f} MB @ {progress['throughput_mbs']:.2f} MB/s"
+    )
+    print(line, flush=True)
+
+
+def warm_file(server: str, token: str, file_path: str, kind: str, file_filter, platform) -> int:
+    """
+    提交一个文件并等待预热完成
+
+    Returns:
+        失败的文件数加上无法解析的条目数
+    """
+    with open(file_path, "r", encoding="utf-8") as f:
+        content = f.read()
+
+    print("=" * 70)
+    print(f"Warming {file_path} ({kind}) - {datetime.now().strftime('%Y-%m-%d %H:%M:%S')}")
+    print("=" * 70)
+
+    payload = {"kind": kind, "content": content}
+    if file_filter:
+        payload["filter"] = file_filter
+    if platform:
+        payload["platform"] = platform
+
+    progress = None
+    with httpx.Client(timeout=None) as client:
+        with client.stream(
+            "POST",
+            f"{server.rstrip('/')}/_admin/warm",
+            json=payload,
+            headers={"authorization": f"Bearer {token}"},
+        ) as response:
+            if response.status_code != 200:
+                print(f"❌ Server returned {response.status_code}: {response.read().decode()}")
+                return 1
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                progress = json.loads(line)
+                print_progress(progress)
+
+    if progress is None:
+        print("❌ No progress received")
+        return 1
+
+    print()
+    print(f"✅ Completed: {progress['completed']} files, {progress['completed_mb']:.2f} MB")
+    print(f"📦 Already cached: {progress['cached']} files")
+    if progress["failed"]:
+        print(f"❌ Failed: {progress['failed']} files")
+    if progress["unresolved"]:
+        print(f"⚠️  Unresolved: {len(progress['unresolved'])}")
+        for item in progress["unresolved"]:
+            print(f"  - {item}")
+    if progress.get("error"):
+        print(f"❌ Error: {progress['error']}")
+        return 1
+    print()
+
+    return progress["failed"] + len(progress["unresolved"])
+
+
+def main():
+    """主函数"""
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description="LightMirrors Cache Warming Tool",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog="""
+Examples:
+  # 预热 requirements.txt 中固定版本的包（类型由文件名推断）
+  python3 cache_warm.py requirements.txt
+
+  # 只预热 CPython 3.11 Linux 的 wheel
+  python3 cache_warm.py poetry.lock --filter "cp311.*manylinux|none-any"
+
+  # 预热 npm 和 Go 依赖
+  python3 cache_warm.py package-lock.json go.sum
+
+  # 预热镜像列表中的 arm64 镜像（每行一个镜像引用）
+  python3 cache_warm.py images.txt --kind docker --platform linux/arm64
+        """
+    )
+
+    parser.add_argument("files", nargs="+", help="Lockfiles or image lists to warm")
+    parser.add_argument(
+        "--kind",
+        choices=["requirements", "poetry", "npm", "gosum", "docker"],
+        help="Input type (default: detected from the file name)"
+    )
+    parser.add_argument(
+        "--server",
+        default=f"http://127.0.0.1:{SERVER_PORT}",
+        help=f"Mirror server address, the base domain or an IP (default: http://127.0.0.1:{SERVER_PORT})"
+    )
+    parser.add_argument(
+        "--token",
+        default=ADMIN_TOKEN,
+        help="Admin token (default: ADMIN_TOKEN environment variable)"
+    )
+    parser.add_argument("--filter", help="Regex that PyPI file names must match")
+    parser.add_argument("--platform", help="Image platform for manifest lists, e.g. linux/arm64")
+
+    args = parser.parse_args()
+
+    if not args.token:
+        print("❌ Admin token is required (--token or ADMIN_TOKEN)")
+        return 1
+
+    errors = 0
+    for file_path in args.files:
+        kind = args.kind or detect_kind(file_path)
+        try:
+            errors += warm_file(args.server, args.token, file_path, kind, args.filter, args.platform)
+        except Exception as e:
+            print(f"❌ Failed to warm {file_path}: {e}")
+            errors += 1
+
+    return 0 if errors == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,30 +1,64 @@
+import asyncio
 import json
 import logging
 import uuid
-from typing import Optional
+from enum import IntEnum
+from typing import Any, Dict, List, Optional, Set, Tuple
 
 import httpx
 
-from mirrorsrun.config import RPC_SECRET, ARIA2_RPC_URL
+from mirrorsrun.aria2_ws import Aria2NotificationListener
+from mirrorsrun.config import (
+    RPC_SECRET,
+    ARIA2_RPC_URL,
+    ARIA2_WS_URL,
+    ARIA2_ADAPTIVE_CONCURRENCY,
+    ARIA2_MAX_CONCURRENCY,
+    ARIA2_MIN_CONCURRENCY,
+    BACKGROUND_BANDWIDTH_SHARE,
+    DOWNLOAD_SCHEDULER,
+)
 
 logger = logging.getLogger(__name__)
 
+# 下载结束通知（onDownloadComplete / onDownloadError / onDownloadStop）
+notification_listener = Aria2NotificationListener(ARIA2_WS_URL)
+
+
+# 与 aria2 之间的长连接，所有 RPC 调用（包括 /jsonrpc 透传）共用
+_client: Optional[httpx.AsyncClient] = None
+
+
+def get_client() -> httpx.AsyncClient:
+    global _client
+    if _client is None or _client.is_closed:
+        # specify the internal API call don't use proxy
+        _client = httpx.AsyncClient(
+            mounts={"all://": httpx.AsyncHTTPTransport()},
+            limits=httpx.Limits(max_connections=16, max_keepalive_connections=16),
+            timeout=30,
+        )
+    return _client
+
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
 
 # refer to https://aria2.github.io/manual/en/html/aria2c.html
-async def send_request(method, params=None):
+async def send_request(method, params=None, with_token=True):
     request_id = uuid.uuid4().hex
     payload = {
         "jsonrpc": "2.0",
         "id": request_id,
         "method": method,
-        "params": [f"token:{RPC_SECRET}"] + (params or []),
+        "params": ([f"token:{RPC_SECRET}"] if with_token else []) + (params or []),
     }
 
-    # specify the internal API call don't use proxy
-    async with httpx.AsyncClient(
-        mounts={"all://": httpx.AsyncHTTPTransport()}
-    ) as client:
-        response = await client.post(ARIA2_RPC_URL, json=payload)
+    response = await get_client().post(ARIA2_RPC_URL, json=payload)
     try:
         return response.json()
     except json.JSONDecodeError as e:
@@ -34,10 +68,98 @@ async def send_request(method, params=None):
         raise e
 
 
+class RpcBatcher:
+    """
+    把同一时间窗口内的并发调用合并为一次 system.multicall
+
+    返回值与 send_request 相同的格式：{"result": ...} 或 {"error": ...}
+    """
+
+    def __init__(self, window: float = 0.005, max_batch_size: int = 100):
+        self.window = window
+        self.max_batch_size = max_batch_size
+        self._pending: List[Tuple[str, list, asyncio.Future]] = []
+        self._flush_task: Optional[asyncio.Task] = None
+        # 持有正在发送的批次，避免任务在完成前被回收
+        self._send_tasks: Set[asyncio.Task] = set()
+
+    async def call(self, method: str, params: Optional[list] = None) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((method, params or [], future))
+
+        if len(self._pending) >= self.max_batch_size:
+            self._flush_now()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+        return await future
+
+    def _flush_now(self):
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        batch, self._pending = self._pending, []
+        task = asyncio.create_task(self._send(batch))
+        self._send_tasks.add(task)
+        task.add_done_callback(self._send_tasks.discard)
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.window)
+        self._flush_task = None
+        batch, self._pending = self._pending, []
+        await self._send(batch)
+
+    async def _send(self, batch: List[Tuple[str, list, asyncio.Future]]):
+        if not batch:
+            return
+
+        try:
+            if len(batch) == 1:
+                method, params, future = batch[0]
+                responses = [await send_request(method, params)]
+            else:
+                responses = await self._multicall(batch)
+        except Exception as e:
+            for _, _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        for (_, _, future), response in zip(batch, responses):
+            if not future.done():
+                future.set_result(response)
+
+    @staticmethod
+    async def _multicall(batch: List[Tuple[str, list, asyncio.Future]]) -> List[dict]:
+        # system.multicall 本身不带 token，每个子调用各自携带
+        calls = [
+            {"methodName": method, "params": [f"token:{RPC_SECRET}"] + params}
+            for method, params, _ in batch
+        ]
+        response = await send_request("system.multicall", [calls], with_token=False)
+        if "result" not in response:
+            return [response] * len(batch)
+
+        # 成功的子调用返回 [value]，失败的返回 {"code": ..., "message": ...}
+        return [
+            {"result": item[0]} if isinstance(item, list) else {"error": item}
+            for item in response["result"]
+        ]
+
+
+batcher = RpcBatcher()
+
+
 async def add_download(
-    url, save_dir="/app/cache", out_file=None, headers: Optional[dict] = None
+    url,
+    save_dir="/app/cache",
+    out_file=None,
+    headers: Optional[dict] = None,
+    position: Optional[int] = None,
 ):
-    logger.info(f"[Aria2] add_download {url=} {save_dir=} {out_file=} {headers=}")
+    logger.info(
+        f"[Aria2] add_download {url=} {save_dir=} {out_file=} {headers=} {position=}"
+    )
 
     method = "aria2.addUri"
     options = {
@@ -49,8 +171,11 @@ async def add_download(
     if headers:
         options["header"] = [f"{k}: {v}" for k, v in headers.items()]
 
-    params = [[url], options]
-    response = await send_request(method, params)
+    params: List[Any] = [[url], options]
+    if position is not None:
+        # 在等待队列中的位置，0 表示队首
+        params.append(position)
+    response = await batcher.call(method, params)
     return response["result"]
 
 
@@ -61,6 +186,13 @@ async def pause_download(gid):
     return response["result"]
 
 
+async def remove_download(gid):
+    method = "aria2.forceRemove"
+    params = [gid]
+    response = await send_request(method, params)
+    return response["result"]
+
+
 async def resume_download(gid):
     method = "aria2.unpause"
     params = [gid]
@@ -71,11 +203,285 @@ async def resume_download(gid):
 async def get_status(gid):
     method = "aria2.tellStatus"
     params = [gid]
-    response = await send_request(method, params)
+    response = await batcher.call(method, params)
     return response["result"]
 
 
-async def list_downloads():
+async def list_downloads(keys: Optional[List[str]] = None):
     method = "aria2.tellActive"
+    response = await send_request(method, [keys] if keys else None)
+    return response["result"]
+
+
+async def change_position(gid, pos, how="POS_SET"):
+    method = "aria2.changePosition"
+    params = [gid, pos, how]
+    response = await batcher.call(method, params)
+    return response["result"]
+
+
+async def change_option(gid, options: dict):
+    method = "aria2.changeOption"
+    params = [gid, options]
+    response = await batcher.call(method, params)
+    return response["result"]
+
+
+async def get_global_option():
+    method = "aria2.getGlobalOption"
     response = await send_request(method)
     return response["result"]
+
+
+async def change_global_option(options: dict):
+    method = "aria2.changeGlobalOption"
+    params = [options]
+    response = await send_request(method, params)
+    return response["result"]
+
+
+async def get_global_stat():
+    method = "aria2.getGlobalStat"
+    response = await send_request(method)
+    return response["result"]
+
+
+class DownloadPriority(IntEnum):
+    """下载优先级，数值越小越优先"""
+
+    # 有客户端在等待
+    INTERACTIVE = 0
+    # 预测客户端随后需要的文件
+    PREFETCH = 1
+    # 批量预热
+    BULK = 2
+
+
+# 后台下载限速的下限（字节/秒），避免限得过低导致连接超时
+MIN_BACKGROUND_LIMIT = 64 * 1024
+# 观察吞吐量、调整并发数的间隔（秒）
+ADAPT_INTERVAL = 10
+
+
+class DownloadScheduler:
+    """
+    aria2 前面的优先级调度
+
+    aria2 按先进先出处理等待队列，预取和预热的下载会挡住有客户端在等待的下载。
+    - 前台下载插入队首；客户端开始等待一个后台下载时，把它提升为前台并移到队首
+    - 前台下载等不到空闲槽位时暂停后台下载（先暂停预热，再暂停预取），
+      其余仍在进行的后台下载限速到观察到的吞吐量的 BACKGROUND_BANDWIDTH_SHARE；
+      前台下载全部结束后恢复
+    - 定期观察总吞吐量，开启 ARIA2_ADAPTIVE_CONCURRENCY 时据此调整 max-concurrent-downloads
+
+    只管理本进程提交的下载，不影响通过 aria2 界面添加的任务。
+    """
+
+    def __init__(self, enabled: bool = DOWNLOAD_SCHEDULER):
+        self.enabled = enabled
+        # 尚未结束的下载
+        self._priorities: Dict[str, DownloadPriority] = {}
+        # 为前台下载让路而暂停、限速的后台下载
+        self._paused: Set[str] = set()
+        self._limited: Set[str] = set()
+        self._lock = asyncio.Lock()
+        self._max_concurrent: Optional[int] = None
+        self._peak_speed = 0.0
+        self._last_speed = 0.0
+        self._direction = 1
+        self._task: Optional[asyncio.Task] = None
+        # 持有恢复后台下载的任务，避免任务在完成前被回收
+        self._resume_tasks: Set[asyncio.Task] = set()
+
+    async def submit(
+        self,
+        url: str,
+        save_dir: str,
+        out_file: str,
+        headers: dict,
+        priority: DownloadPriority = DownloadPriority.INTERACTIVE,
+    ) -> str:
+        """提交下载并返回 GID"""
+        if not self.enabled:
+            return await add_download(
+                url, save_dir=save_dir, out_file=out_file, headers=headers
+            )
+
+        interactive = priority == DownloadPriority.INTERACTIVE
+        gid = await add_download(
+            url,
+            save_dir=save_dir,
+            out_file=out_file,
+            headers=headers,
+            position=0 if interactive else None,
+        )
+        self._priorities[gid] = priority
+        if interactive:
+            await self._preempt()
+        return gid
+
+    async def promote(self, gid: str):
+        """客户端开始等待一个后台下载"""
+        priority = self._priorities.get(gid)
+        if not self.enabled or priority in (None, DownloadPriority.INTERACTIVE):
+            return
+        logger.info(f"[Aria2] Promote download {gid} to interactive")
+        self._priorities[gid] = DownloadPriority.INTERACTIVE
+        async with self._lock:
+            if gid in self._paused:
+                self._paused.discard(gid)
+                await self._call(resume_download(gid))
+            if gid in self._limited:
+                self._limited.discard(gid)
+                await self._call(change_option(gid, {"max-download-limit": "0"}))
+        # 只有等待中的下载可以移动，已经开始的下载会返回错误，忽略即可
+        await self._call(change_position(gid, 0))
+        await self._preempt()
+
+    def is_paused(self, gid: str) -> bool:
+        """下载是否为前台下载让路而被暂停"""
+        return gid in self._paused
+
+    def on_finished(self, gid: str):
+        priority = self._priorities.pop(gid, None)
+        self._paused.discard(gid)
+        self._limited.discard(gid)
+        if priority == DownloadPriority.INTERACTIVE and not self._has_interactive():
+            task = asyncio.create_task(self._resume_background())
+            self._resume_tasks.add(task)
+            task.add_done_callback(self._resume_tasks.discard)
+
+    def _has_interactive(self) -> bool:
+        return DownloadPriority.INTERACTIVE in self._priorities.values()
+
+    @staticmethod
+    async def _call(coroutine) -> bool:
+        # 下载可能在调度期间结束，此时 aria2 返回错误
+        try:
+            await coroutine
+            return True
+        except Exception as e:
+            logger.debug(f"[Aria2] scheduler call failed: {e}")
+            return False
+
+    async def _get_max_concurrent(self) -> int:
+        if self._max_concurrent is None:
+            option = await get_global_option()
+            self._max_concurrent = int(option.get("max-concurrent-downloads", 5))
+        return self._max_concurrent
+
+    async def _preempt(self):
+        """为等待中的前台下载腾出槽位"""
+        async with self._lock:
+            try:
+                max_concurrent = await self._get_max_concurrent()
+                active = [item["gid"] for item in await list_downloads(["gid"])]
+            except Exception as e:
+                logger.warning(f"[Aria2] Failed to query downloads for scheduling: {e}")
+                return
+
+            waiting_interactive = [
+                gid
+                for gid, priority in self._priorities.items()
+                if priority == DownloadPriority.INTERACTIVE and gid not in active
+            ]
+            # 先暂停预热，再暂停预取
+            background = sorted(
+                (
+                    gid
+                    for gid in active
+                    if self._priorities.get(gid, DownloadPriority.INTERACTIVE)
+                    != DownloadPriority.INTERACTIVE
+                ),
+                key=lambda gid: -self._priorities[gid],
+            )
+            free = max_concurrent - len(active)
+            to_pause = background[: max(0, len(waiting_interactive) - free)]
+            for gid in to_pause:
+                if await self._call(pause_download(gid)):
+                    logger.info(f"[Aria2] Pause background download {gid}")
+                    self._paused.add(gid)
+
+            remaining = [
+                gid for gid in background[len(to_pause) :] if gid not in self._limited
+            ]
+            if not remaining or not self._peak_speed:
+                return
+            limit = max(
+                int(self._peak_speed * BACKGROUND_BANDWIDTH_SHARE / len(remaining)),
+                MIN_BACKGROUND_LIMIT,
+            )
+            for gid in remaining:
+                if await self._call(
+                    change_option(gid, {"max-download-limit": str(limit)})
+                ):
+                    self._limited.add(gid)
+
+    async def _resume_background(self):
+        async with self._lock:
+            if self._has_interactive():
+                return
+            # on_finished 不持锁修改这两个集合，先取出再逐个恢复；
+            # 期间结束的下载会返回错误，由 _call 忽略
+            paused, self._paused = self._paused, set()
+            limited, self._limited = self._limited, set()
+            for gid in paused:
+                logger.info(f"[Aria2] Resume background download {gid}")
+                await self._call(resume_download(gid))
+            for gid in limited:
+                await self._call(change_option(gid, {"max-download-limit": "0"}))
+
+    async def _adapt(self):
+        stat = await get_global_stat()
+        speed = float(stat.get("downloadSpeed", 0))
+        num_waiting = int(stat.get("numWaiting", 0))
+        # 缓慢衰减的峰值，作为估计的可用带宽
+        self._peak_speed = max(speed, self._peak_speed * 0.9)
+
+        if not ARIA2_ADAPTIVE_CONCURRENCY:
+            return
+        if num_waiting == 0:
+            # 没有排队的下载，吞吐量不受并发数限制
+            self._last_speed = 0
+            return
+        max_concurrent = await self._get_max_concurrent()
+
+        # 爬山：吞吐量下降时反向调整
+        if self._last_speed and speed < self._last_speed * 0.95:
+            self._direction = -self._direction
+        self._last_speed = speed
+
+        new_concurrent = min(
+            max(max_concurrent + self._direction, ARIA2_MIN_CONCURRENCY),
+            ARIA2_MAX_CONCURRENCY,
+        )
+        if new_concurrent != max_concurrent:
+            await change_global_option(
+                {"max-concurrent-downloads": str(new_concurrent)}
+            )
+            self._max_concurrent = new_concurrent
+            logger.info(
+                f"[Aria2] max-concurrent-downloads {max_concurrent} -> {new_concurrent} "
+                f"({speed / 1024 / 1024:.2f} MB/s)"
+            )
+
+    async def _adapt_loop(self):
+        while True:
+            await asyncio.sleep(ADAPT_INTERVAL)
+            try:
+                await self._adapt()
+            except Exception as e:
+                logger.warning(f"[Aria2] Failed to adapt download concurrency: {e}")
+
+    def start(self):
+        if self.enabled and self._task is None:
+            self._task = asyncio.create_task(self._adapt_loop())
+            logger.info("Download scheduler started")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+download_scheduler = DownloadScheduler()
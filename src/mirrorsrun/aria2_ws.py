@@ -0,0 +1,274 @@
+"""
+aria2 WebSocket 通知监听
+
+与 aria2 保持一条长连接，接收 aria2.onDownloadComplete / onDownloadError /
+onDownloadStop 等通知并按 GID 分发给等待的请求，替代轮询。
+
+只实现了 RFC 6455 中接收文本通知所需的最小子集，避免引入额外依赖。
+"""
+
+import asyncio
+import base64
+import hashlib
+import json
+import logging
+import os
+import ssl
+import struct
+import time
+from collections import OrderedDict
+from typing import Dict, List, Optional, Tuple
+from urllib.parse import urlparse
+
+logger = logging.getLogger(__name__)
+
+WS_GUID = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+OPCODE_CONTINUATION = 0x0
+OPCODE_TEXT = 0x1
+OPCODE_BINARY = 0x2
+OPCODE_CLOSE = 0x8
+OPCODE_PING = 0x9
+OPCODE_PONG = 0xA
+
+EVENT_COMPLETE = "aria2.onDownloadComplete"
+EVENT_ERROR = "aria2.onDownloadError"
+EVENT_STOP = "aria2.onDownloadStop"
+EVENT_BT_COMPLETE = "aria2.onBtDownloadComplete"
+
+FINISH_EVENTS = (EVENT_COMPLETE, EVENT_ERROR, EVENT_STOP, EVENT_BT_COMPLETE)
+
+# 通知可能先于 addUri 的响应到达，保留最近的事件供稍后订阅的请求查询
+RECENT_EVENTS_LIMIT = 1024
+RECENT_EVENTS_TTL = 300
+
+
+class WebSocketClosed(Exception):
+    pass
+
+
+class WebSocketConnection:
+    """最小化的 WebSocket 客户端连接"""
+
+    def __init__(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self.reader = reader
+        self.writer = writer
+
+    @classmethod
+    async def connect(cls, url: str, timeout: float = 10) -> "WebSocketConnection":
+        parsed = urlparse(url)
+        secure = parsed.scheme == "wss"
+        host = parsed.hostname
+        assert host, f"invalid websocket url {url}"
+        port = parsed.port or (443 if secure else 80)
+        path = parsed.path or "/"
+
+        reader, writer = await asyncio.wait_for(
+            asyncio.open_connection(
+                host, port, ssl=ssl.create_default_context() if secure else None
+            ),
+            timeout,
+        )
+
+        key = base64.b64encode(os.urandom(16)).decode()
+        handshake = (
+            f"GET {path} HTTP/1.1\r\n"
+            f"Host: {host}:{port}\r\n"
+            "Upgrade: websocket\r\n"
+            "Connection: Upgrade\r\n"
+            f"Sec-WebSocket-Key: {key}\r\n"
+            "Sec-WebSocket-Version: 13\r\n"
+            "\r\n"
+        )
+        writer.write(handshake.encode())
+        await writer.drain()
+
+        raw_headers = await asyncio.wait_for(reader.readuntil(b"\r\n\r\n"), timeout)
+        status_line, *header_lines = raw_headers.decode("latin-1").split("\r\n")
+        if " 101 " not in f"{status_line} ":
+            writer.close()
+            raise ConnectionError(f"websocket handshake failed: {status_line}")
+
+        headers = {}
+        for line in header_lines:
+            if ":" in line:
+                name, value = line.split(":", 1)
+                headers[name.strip().lower()] = value.strip()
+
+        expected_accept = base64.b64encode(
+            hashlib.sha1((key + WS_GUID).encode()).digest()
+        ).decode()
+        if headers.get("sec-websocket-accept") != expected_accept:
+            writer.close()
+            raise ConnectionError("websocket handshake failed: bad accept key")
+
+        return cls(reader, writer)
+
+    async def send(self, opcode: int, payload: bytes = b""):
+        # 客户端发送的帧必须加掩码
+        header = bytearray([0x80 | opcode])
+        length = len(payload)
+        if length < 126:
+            header.append(0x80 | length)
+        elif length < (1 << 16):
+            header.append(0x80 | 126)
+            header += struct.pack(">H", length)
+        else:
+            header.append(0x80 | 127)
+            header += struct.pack(">Q", length)
+
+        mask = os.urandom(4)
+        masked = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        self.writer.write(bytes(header) + mask + masked)
+        await self.writer.drain()
+
+    async def _read_frame(self) -> Tuple[bool, int, bytes]:
+        first, second = await self.reader.readexactly(2)
+        fin = bool(first & 0x80)
+        opcode = first & 0x0F
+        length = second & 0x7F
+        if length == 126:
+            (length,) = struct.unpack(">H", await self.reader.readexactly(2))
+        elif length == 127:
+            (length,) = struct.unpack(">Q", await self.reader.readexactly(8))
+
+        mask = await self.reader.readexactly(4) if second & 0x80 else None
+        payload = await self.reader.readexactly(length)
+        if mask:
+            payload = bytes(b ^ mask[i % 4] for i, b in enumerate(payload))
+        return fin, opcode, payload
+
+    async def recv(self) -> str:
+        """读取下一条文本消息，自动处理 ping 和分片"""
+        fragments: List[bytes] = []
+        while True:
+            try:
+                fin, opcode, payload = await self._read_frame()
+            except (asyncio.IncompleteReadError, ConnectionError) as e:
+                raise WebSocketClosed(str(e))
+
+            if opcode == OPCODE_PING:
+                await self.send(OPCODE_PONG, payload)
+                continue
+            if opcode == OPCODE_PONG:
+                continue
+            if opcode == OPCODE_CLOSE:
+                raise WebSocketClosed("closed by server")
+
+            fragments.append(payload)
+            if fin:
+                return b"".join(fragments).decode("utf-8")
+
+    async def close(self):
+        try:
+            await self.send(OPCODE_CLOSE)
+        except Exception:
+            pass
+        self.writer.close()
+
+
+class Aria2NotificationListener:
+    """订阅 aria2 的下载通知，按 GID 唤醒等待者"""
+
+    def __init__(self, ws_url: str):
+        self.ws_url = ws_url
+        self._task: Optional[asyncio.Task] = None
+        self._connection: Optional[WebSocketConnection] = None
+        self._waiters: Dict[str, List[asyncio.Future]] = {}
+        self._recent_events: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+
+    @property
+    def connected(self) -> bool:
+        return self._connection is not None
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+            logger.info(f"aria2 notification listener started, {self.ws_url}")
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            logger.info("aria2 notification listener stopped")
+
+    def subscribe(self, gid: str) -> asyncio.Future:
+        """
+        订阅某个 GID 的结束事件
+
+        Returns:
+            Future，结果为事件名（例如 aria2.onDownloadComplete）
+        """
+        future = asyncio.get_running_loop().create_future()
+
+        recent = self._recent_events.get(gid)
+        if recent is not None:
+            future.set_result(recent[0])
+            return future
+
+        self._waiters.setdefault(gid, []).append(future)
+        future.add_done_callback(lambda f: self._discard_waiter(gid, f))
+        return future
+
+    def _discard_waiter(self, gid: str, future: asyncio.Future):
+        waiters = self._waiters.get(gid)
+        if waiters and future in waiters:
+            waiters.remove(future)
+            if not waiters:
+                del self._waiters[gid]
+
+    def _dispatch(self, method: str, gid: str):
+        now = time.time()
+        self._recent_events[gid] = (method, now)
+        self._recent_events.move_to_end(gid)
+        while self._recent_events:
+            _, oldest_time = next(iter(self._recent_events.values()))
+            expired = now - oldest_time > RECENT_EVENTS_TTL
+            if not expired and len(self._recent_events) <= RECENT_EVENTS_LIMIT:
+                break
+            self._recent_events.popitem(last=False)
+
+        for future in list(self._waiters.pop(gid, [])):
+            if not future.done():
+                future.set_result(method)
+
+    def _handle_message(self, message: str):
+        try:
+            data = json.loads(message)
+        except json.JSONDecodeError:
+            logger.warning(f"invalid aria2 notification: {message[:200]}")
+            return
+
+        method = data.get("method")
+        if method not in FINISH_EVENTS:
+            return
+
+        for event in data.get("params", []):
+            gid = event.get("gid")
+            if gid:
+                logger.debug(f"[Aria2] {method} GID: {gid}")
+                self._dispatch(method, gid)
+
+    async def _run(self):
+        retry_wait = 1
+        while True:
+            try:
+                self._connection = await WebSocketConnection.connect(self.ws_url)
+                logger.info("Connected to aria2 websocket")
+                retry_wait = 1
+                while True:
+                    message = await self._connection.recv()
+                    self._handle_message(message)
+            except asyncio.CancelledError:
+                if self._connection is not None:
+                    await self._connection.close()
+                self._connection = None
+                raise
+            except Exception as e:
+                logger.warning(
+                    f"aria2 websocket disconnected: {e}, retry in {retry_wait}s"
+                )
+
+            self._connection = None
+            await asyncio.sleep(retry_wait)
+            retry_wait = min(retry_wait * 2, 60)
@@ -1,6 +1,31 @@
 import os
 
 ARIA2_RPC_URL = os.environ.get("ARIA2_RPC_URL", "http://aria2:6800/jsonrpc")
+# aria2 serves websocket notifications on the same endpoint as JSON-RPC
+ARIA2_WS_URL = os.environ.get("ARIA2_WS_URL", ARIA2_RPC_URL.replace("http", "ws", 1))
+ENABLE_ARIA2_NOTIFICATIONS = (
+    os.environ.get("ENABLE_ARIA2_NOTIFICATIONS", "true") == "true"
+)
+# Download backend of the file cache: aria2, or native (in-process segmented downloader)
+DOWNLOAD_BACKEND = os.environ.get("DOWNLOAD_BACKEND", "aria2")
+# native backend: max files downloading at the same time, and Range segments per file
+NATIVE_MAX_CONCURRENT_DOWNLOADS = int(
+    os.environ.get("NATIVE_MAX_CONCURRENT_DOWNLOADS", "5")
+)
+NATIVE_SEGMENTS = int(os.environ.get("NATIVE_SEGMENTS", "4"))
+NATIVE_MIN_SEGMENT_SIZE = int(
+    os.environ.get("NATIVE_MIN_SEGMENT_SIZE", str(4 * 1024 * 1024))
+)
+# Put downloads with a waiting client ahead of prefetch / warm-up downloads in aria2
+DOWNLOAD_SCHEDULER = os.environ.get("DOWNLOAD_SCHEDULER", "true") == "true"
+# share of the observed throughput left to background downloads while clients are waiting
+BACKGROUND_BANDWIDTH_SHARE = float(os.environ.get("BACKGROUND_BANDWIDTH_SHARE", "0.2"))
+# tune aria2's max-concurrent-downloads between the bounds by observed throughput
+ARIA2_ADAPTIVE_CONCURRENCY = (
+    os.environ.get("ARIA2_ADAPTIVE_CONCURRENCY", "false") == "true"
+)
+ARIA2_MIN_CONCURRENCY = int(os.environ.get("ARIA2_MIN_CONCURRENCY", "2"))
+ARIA2_MAX_CONCURRENCY = int(os.environ.get("ARIA2_MAX_CONCURRENCY", "16"))
 RPC_SECRET = os.environ.get("RPC_SECRET", "")
 BASE_DOMAIN = os.environ.get("BASE_DOMAIN", "local.homeinfra.org")
 
@@ -36,14 +61,126 @@ BASE_URL_QUAY = os.environ.get("BASE_URL_QUAY", "https://quay.io")
 BASE_URL_GHCR = os.environ.get("BASE_URL_GHCR", "https://ghcr.io")
 BASE_URL_NVCR = os.environ.get("BASE_URL_NVCR", "https://nvcr.io")
 
+# Progressive serving: stream partially downloaded files instead of returning 504
+PROGRESSIVE_SERVING = os.environ.get("PROGRESSIVE_SERVING", "true") == "true"
+# abort the stream if the partial file makes no progress for this many seconds
+PROGRESSIVE_STALL_TIMEOUT = int(os.environ.get("PROGRESSIVE_STALL_TIMEOUT", "120"))
+# Tee-on-miss: fetch small files directly on a cache miss, streaming them to the client
+# while writing the cache, instead of waiting for the download backend
+TEE_ON_MISS = os.environ.get("TEE_ON_MISS", "false") == "true"
+# larger files (and files of unknown length) still go through the download backend
+TEE_ON_MISS_MAX_SIZE = int(
+    os.environ.get("TEE_ON_MISS_MAX_SIZE", str(50 * 1024 * 1024))
+)
+
+# Upstream connection pool shared by all proxied requests
+# HTTP/2 needs the optional h2 package (pip install httpx[http2])
+UPSTREAM_HTTP2 = os.environ.get("UPSTREAM_HTTP2", "true") == "true"
+UPSTREAM_MAX_CONNECTIONS = int(os.environ.get("UPSTREAM_MAX_CONNECTIONS", "200"))
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = int(
+    os.environ.get("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", "50")
+)
+UPSTREAM_KEEPALIVE_EXPIRY = float(os.environ.get("UPSTREAM_KEEPALIVE_EXPIRY", "60"))
+
+# Docker blobs shared by all registries, keyed by digest only
+BLOB_STORE_DIR = os.environ.get("BLOB_STORE_DIR", os.path.join(CACHE_DIR, "_blobs"))
+
+# Metadata cache (index pages, packuments, ...) stored under the cache dir
+METADATA_CACHE_DIR = os.environ.get(
+    "METADATA_CACHE_DIR", os.path.join(CACHE_DIR, "_metadata")
+)
+METADATA_MEMORY_LIMIT = int(
+    os.environ.get("METADATA_MEMORY_LIMIT", str(64 * 1024 * 1024))
+)
+PYPI_SIMPLE_TTL = int(os.environ.get("PYPI_SIMPLE_TTL", "600"))
+PYPI_SIMPLE_STALE_TTL = int(os.environ.get("PYPI_SIMPLE_STALE_TTL", "86400"))
+NPM_PACKUMENT_TTL = int(os.environ.get("NPM_PACKUMENT_TTL", "300"))
+NPM_PACKUMENT_STALE_TTL = int(os.environ.get("NPM_PACKUMENT_STALE_TTL", "86400"))
+# gzip or zstd (zstd needs the optional zstandard package)
+NPM_PACKUMENT_COMPRESSION = os.environ.get("NPM_PACKUMENT_COMPRESSION", "gzip")
+# @v/list and @latest of Go modules
+GOPROXY_LIST_TTL = int(os.environ.get("GOPROXY_LIST_TTL", "60"))
+GOPROXY_LIST_STALE_TTL = int(os.environ.get("GOPROXY_LIST_STALE_TTL", "3600"))
+# Docker manifests by tag (manifests by digest never expire)
+DOCKER_TAG_MANIFEST_TTL = int(os.environ.get("DOCKER_TAG_MANIFEST_TTL", "60"))
+DOCKER_TAG_MANIFEST_STALE_TTL = int(
+    os.environ.get("DOCKER_TAG_MANIFEST_STALE_TTL", "600")
+)
+# max number of manifests kept on disk by each of the two manifest caches,
+# the least recently used are removed first
+DOCKER_MANIFEST_CACHE_MAX_ENTRIES = int(
+    os.environ.get("DOCKER_MANIFEST_CACHE_MAX_ENTRIES", "20000")
+)
+# Queue the layers of a requested image manifest into aria2 before the client asks for them
+DOCKER_LAYER_PREFETCH = os.environ.get("DOCKER_LAYER_PREFETCH", "false") == "true"
+# max number of prefetched blobs downloading at the same time
+DOCKER_PREFETCH_CONCURRENCY = int(os.environ.get("DOCKER_PREFETCH_CONCURRENCY", "4"))
+# platform used for manifest lists when the client's User-Agent doesn't tell
+DOCKER_PREFETCH_PLATFORM = os.environ.get("DOCKER_PREFETCH_PLATFORM", "linux/amd64")
+# Prefetch the likely dependencies of requested wheels (needs the optional packaging package)
+PYPI_PREFETCH = os.environ.get("PYPI_PREFETCH", "false") == "true"
+# max number of prefetched PyPI files downloading at the same time
+PYPI_PREFETCH_CONCURRENCY = int(os.environ.get("PYPI_PREFETCH_CONCURRENCY", "2"))
+# how many levels of the dependency tree are followed
+PYPI_PREFETCH_DEPTH = int(os.environ.get("PYPI_PREFETCH_DEPTH", "3"))
+# how often the auth realms of the upstream registries are rediscovered
+DOCKER_REALM_REFRESH_INTERVAL = int(
+    os.environ.get("DOCKER_REALM_REFRESH_INTERVAL", "21600")
+)
+# apt/apk indexes (InRelease, Packages, APKINDEX, ...)
+# no stale window by default: Release and Packages must stay consistent
+MIRROR_INDEX_TTL = int(os.environ.get("MIRROR_INDEX_TTL", "300"))
+MIRROR_INDEX_STALE_TTL = int(os.environ.get("MIRROR_INDEX_STALE_TTL", "0"))
+
 # Data directories
 DATA_DIR = os.environ.get("DATA_DIR", "/app/data/")
 METRICS_FILE = os.path.join(DATA_DIR, "metrics.json")
 
+# Digest verification of cached files
+VERIFIED_FILES_FILE = os.path.join(DATA_DIR, "verified_files.json")
+# seconds between writing newly verified files to VERIFIED_FILES_FILE
+VERIFIED_FILES_FLUSH_INTERVAL = int(
+    os.environ.get("VERIFIED_FILES_FLUSH_INTERVAL", "30")
+)
+# files that failed verification are moved here, and removed by the cache cleanup
+QUARANTINE_DIR = os.environ.get(
+    "QUARANTINE_DIR", os.path.join(CACHE_DIR, "_quarantine")
+)
+
+# Auth realms of the upstream docker registries, shared by all workers
+DOCKER_REALMS_FILE = os.path.join(DATA_DIR, "docker_realms.json")
+
+# Bearer token of the admin API (/_admin/...), the API is disabled when empty
+ADMIN_TOKEN = os.environ.get("ADMIN_TOKEN", "")
+
 # Session management
 SESSION_TIMEOUT = int(os.environ.get("SESSION_TIMEOUT", "5"))
 ENABLE_SESSION_SUMMARY = os.environ.get("ENABLE_SESSION_SUMMARY", "true") == "true"
 
+# Warm the files that usually follow the first file of an install session
+# (learned from finalized sessions, needs ENABLE_SESSION_SUMMARY)
+COOCCURRENCE_PREFETCH = os.environ.get("COOCCURRENCE_PREFETCH", "false") == "true"
+# how requests are grouped into install sessions:
+# - window: same client within the same 5-second window
+# - activity: same client until SESSION_TIMEOUT passes without a request, so a long
+#   install is one session (default when COOCCURRENCE_PREFETCH learns from sessions)
+SESSION_GROUPING = os.environ.get(
+    "SESSION_GROUPING", "activity" if COOCCURRENCE_PREFETCH else "window"
+)
+COOCCURRENCE_FILE = os.path.join(DATA_DIR, "cooccurrence.json")
+# seconds between merging newly learned sessions into the shared model file
+COOCCURRENCE_FLUSH_INTERVAL = int(os.environ.get("COOCCURRENCE_FLUSH_INTERVAL", "60"))
+# max number of files warmed for one session
+COOCCURRENCE_PREFETCH_BUDGET = int(os.environ.get("COOCCURRENCE_PREFETCH_BUDGET", "50"))
+# max number of warmed files downloading at the same time
+COOCCURRENCE_PREFETCH_CONCURRENCY = int(
+    os.environ.get("COOCCURRENCE_PREFETCH_CONCURRENCY", "4")
+)
+# a file is warmed when it followed the first file in at least this share of sessions
+COOCCURRENCE_MIN_CONFIDENCE = float(
+    os.environ.get("COOCCURRENCE_MIN_CONFIDENCE", "0.5")
+)
+
 # Cache lifecycle management
 CACHE_EXPIRY_DAYS = int(os.environ.get("CACHE_EXPIRY_DAYS", "30"))
 CACHE_ACCESS_TRACKING_FILE = os.path.join(DATA_DIR, "cache_access.json")
@@ -0,0 +1,275 @@
+"""
+根据历史安装会话预取文件
+
+同一类客户端（例如 CI 镜像）每次安装的文件集合几乎相同。会话结束时记录
+"以 X 开始的会话随后请求了 Y、Z"，之后某个客户端的新会话以 X 开始时，在后台
+提前下载历史上经常跟随 X 的文件，新节点上的大部分缓存未命中因此变成命中。
+
+模型保存在 DATA_DIR 下供所有 worker 共享，由后台任务定期合并写回。
+"""
+
+import asyncio
+import fcntl
+import json
+import logging
+import os
+import time
+import typing
+from pathlib import Path
+from threading import Lock
+
+import anyio
+from starlette.requests import Request
+
+from mirrorsrun.config import (
+    COOCCURRENCE_FILE,
+    COOCCURRENCE_FLUSH_INTERVAL,
+    COOCCURRENCE_MIN_CONFIDENCE,
+    COOCCURRENCE_PREFETCH_BUDGET,
+    COOCCURRENCE_PREFETCH_CONCURRENCY,
+)
+
+logger = logging.getLogger(__name__)
+
+# 模型大小上限：起始文件数、每个起始文件记录的跟随文件数
+MAX_TRIGGERS = 1000
+MAX_FOLLOWERS = 500
+# 同一个客户端在这段时间内只触发一次预取（秒）
+TRIGGER_COOLDOWN = 60
+
+# (上游地址, 缓存文件)
+SessionFile = typing.Tuple[str, str]
+StartDownload = typing.Callable[
+    [Request, str, str], typing.Awaitable[typing.Optional[asyncio.Task]]
+]
+
+
+class CooccurrenceModel:
+    """
+    {起始文件地址: {"sessions": 会话数, "last_seen": 时间,
+                    "followers": {文件地址: [出现次数, 缓存文件]}}}
+
+    learn() 只更新内存，新学到的增量由后台任务定期合并到磁盘上的模型：
+    在线程中加文件锁读取最新的模型（包括其他 worker 写入的内容），加上本 worker
+    的增量后写回。
+    """
+
+    def __init__(
+        self,
+        store_file: str = COOCCURRENCE_FILE,
+        flush_interval: int = COOCCURRENCE_FLUSH_INTERVAL,
+    ):
+        self.store_file = store_file
+        self.flush_interval = flush_interval
+        self._triggers: typing.Dict[str, dict] = {}
+        # 上次写回之后学到的增量，格式与 _triggers 相同
+        self._pending: typing.Dict[str, dict] = {}
+        self._loaded_mtime = 0.0
+        self._lock = Lock()
+        self._task: typing.Optional[asyncio.Task] = None
+
+    @staticmethod
+    def _merge(triggers: typing.Dict[str, dict], trigger_url: str, delta: dict):
+        stats = triggers.pop(trigger_url, None) or {"sessions": 0, "followers": {}}
+        # 重新插入到末尾，字典顺序即最近使用顺序
+        triggers[trigger_url] = stats
+        stats["sessions"] += delta["sessions"]
+        stats["last_seen"] = max(stats.get("last_seen", 0), delta["last_seen"])
+        for url, (count, cache_file) in delta["followers"].items():
+            old_count = stats["followers"].get(url, [0])[0]
+            stats["followers"][url] = [old_count + count, cache_file]
+
+        if len(stats["followers"]) > MAX_FOLLOWERS:
+            ranked = sorted(stats["followers"].items(), key=lambda item: -item[1][0])
+            stats["followers"] = dict(ranked[:MAX_FOLLOWERS])
+        while len(triggers) > MAX_TRIGGERS:
+            del triggers[next(iter(triggers))]
+
+    def _read(self) -> typing.Dict[str, dict]:
+        try:
+            with open(self.store_file, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return {}
+        except Exception as e:
+            logger.warning(f"Failed to load co-occurrence model: {e}")
+            return {}
+
+    def _write(self, triggers: typing.Dict[str, dict]):
+        # 原子写入：先写入临时文件，再重命名
+        temp_file = f"{self.store_file}.{os.getpid()}.tmp"
+        with open(temp_file, "w", encoding="utf-8") as f:
+            json.dump(triggers, f, ensure_ascii=False)
+        os.replace(temp_file, self.store_file)
+
+    def _get_mtime(self) -> float:
+        try:
+            return os.path.getmtime(self.store_file)
+        except OSError:
+            return 0.0
+
+    def _flush_sync(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending and self._get_mtime() == self._loaded_mtime:
+            return
+
+        try:
+            Path(self.store_file).parent.mkdir(parents=True, exist_ok=True)
+            # 多个 worker 之间互斥，避免读取后写回时覆盖其他 worker 的增量
+            with open(f"{self.store_file}.lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                triggers = self._read()
+                for trigger_url, delta in pending.items():
+                    self._merge(triggers, trigger_url, delta)
+                if pending:
+                    self._write(triggers)
+                self._loaded_mtime = self._get_mtime()
+        except Exception as e:
+            logger.error(f"Failed to save co-occurrence model: {e}")
+            # 下次再写，期间学到的增量合并在一起
+            with self._lock:
+                for trigger_url, delta in pending.items():
+                    self._merge(self._pending, trigger_url, delta)
+            return
+
+        with self._lock:
+            # 写回期间又学到的增量仍在 _pending 中，继续体现在内存模型里
+            for trigger_url, delta in self._pending.items():
+                self._merge(triggers, trigger_url, delta)
+            self._triggers = triggers
+
+    async def flush(self):
+        """把增量合并到磁盘，并载入其他 worker 学到的内容"""
+        await anyio.to_thread.run_sync(self._flush_sync)
+
+    async def _flush_loop(self):
+        while True:
+            await self.flush()
+            await asyncio.sleep(self.flush_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+            await self.flush()
+
+    def learn(self, files: typing.List[SessionFile]):
+        """
+        记录一个结束的会话，只更新内存，由 flush() 写回磁盘
+
+        Args:
+            files: 会话中的文件，按请求开始时间排序
+        """
+        if not files:
+            return
+
+        trigger_url, _ = files[0]
+        followers = {
+            url: [1, cache_file] for url, cache_file in files[1:] if url != trigger_url
+        }
+        delta = {"sessions": 1, "last_seen": time.time(), "followers": followers}
+
+        with self._lock:
+            self._merge(self._triggers, trigger_url, delta)
+            self._merge(self._pending, trigger_url, delta)
+
+        logger.debug(
+            f"Learned session of {trigger_url} with {len(followers)} followers"
+        )
+
+    def predict(self, trigger_url: str, limit: int) -> typing.List[SessionFile]:
+        """返回经常跟随 trigger_url 的文件，按出现次数从高到低"""
+        stats = self._triggers.get(trigger_url)
+        if stats is None:
+            return []
+
+        min_count = stats["sessions"] * COOCCURRENCE_MIN_CONFIDENCE
+        ranked = sorted(
+            (
+                (count, url, cache_file)
+                for url, (count, cache_file) in stats["followers"].items()
+                if count >= min_count
+            ),
+            reverse=True,
+        )
+        return [(url, cache_file) for _, url, cache_file in ranked[:limit]]
+
+
+class SessionPrefetcher:
+    def __init__(
+        self,
+        model: CooccurrenceModel,
+        budget: int = COOCCURRENCE_PREFETCH_BUDGET,
+        concurrency: int = COOCCURRENCE_PREFETCH_CONCURRENCY,
+    ):
+        self.model = model
+        self.budget = budget
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._triggered: typing.Dict[str, float] = {}
+        # 持有后台预取任务，避免任务在完成前被回收
+        self._tasks: typing.Set[asyncio.Task] = set()
+
+    def _should_trigger(self, client_key: str) -> bool:
+        now = time.time()
+        for expired in [
+            k for k, t in self._triggered.items() if now - t > TRIGGER_COOLDOWN
+        ]:
+            del self._triggered[expired]
+        if client_key in self._triggered:
+            return False
+        self._triggered[client_key] = now
+        return True
+
+    async def _warm(
+        self, request: Request, url: str, cache_file: str, start_download: StartDownload
+    ):
+        async with self._semaphore:
+            try:
+                task = await start_download(request, url, cache_file)
+                if task is None:
+                    return
+                logger.info(f"Warming {url} for the new session")
+                # 下载结束后才释放名额
+                await asyncio.shield(task)
+            except Exception as e:
+                logger.warning(f"Failed to warm {url}: {e}")
+
+    def on_session_start(
+        self,
+        request: Request,
+        client_key: str,
+        trigger_url: str,
+        start_download: StartDownload,
+    ):
+        """
+        新会话的第一个文件到达时调用，在后台预取预测的文件
+
+        Args:
+            request: 客户端请求，请求头用于下载
+            client_key: 标识客户端的字符串
+            trigger_url: 会话的第一个文件
+            start_download: 开始下载 (request, 上游地址, 缓存文件)，
+                返回等待下载结束的任务；已缓存或正在下载时返回 None
+        """
+        if not self._should_trigger(client_key):
+            return
+        predicted = self.model.predict(trigger_url, self.budget)
+        if not predicted:
+            return
+        logger.info(f"Session of {trigger_url} predicts {len(predicted)} files")
+        for url, cache_file in predicted:
+            task = asyncio.create_task(
+                self._warm(request, url, cache_file, start_download)
+            )
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+
+# 全局模型和预取器
+cooccurrence_model = CooccurrenceModel()
+session_prefetcher = SessionPrefetcher(cooccurrence_model)
@@ -0,0 +1,154 @@
+"""
+根据 manifest 预取 docker layer
+
+客户端拿到 manifest 后会逐个请求其中的 blob。在返回 manifest 的同时把尚未缓存的
+config 和 layer 提交给 aria2，冷启动拉取大镜像时就只受带宽限制，而不是受往返次数限制。
+同时下载的预取数量受 DOCKER_PREFETCH_CONCURRENCY 限制，其余按 manifest 中的顺序排队。
+"""
+
+import asyncio
+import json
+import logging
+import re
+import typing
+
+from starlette.requests import Request
+
+from mirrorsrun.config import DOCKER_PREFETCH_CONCURRENCY, DOCKER_PREFETCH_PLATFORM
+from mirrorsrun.proxy.blob_store import get_blob_path
+from mirrorsrun.proxy.file_cache import prefetch_file
+
+logger = logging.getLogger(__name__)
+
+INDEX_MEDIA_TYPES = (
+    "application/vnd.oci.image.index.v1+json",
+    "application/vnd.docker.distribution.manifest.list.v2+json",
+)
+MANIFEST_MEDIA_TYPES = (
+    "application/vnd.oci.image.manifest.v1+json",
+    "application/vnd.docker.distribution.manifest.v2+json",
+)
+
+# docker 的 User-Agent 中包含平台信息，例如 "docker/24.0.7 ... os/linux arch/amd64"
+_user_agent_platform_regex = re.compile(r"\bos/(\w+) arch/(\w+)")
+
+
+def get_media_type(manifest: dict, content_type: str) -> str:
+    return manifest.get("mediaType") or content_type.split(";")[0].strip()
+
+
+def get_client_platform(user_agent: str) -> typing.Tuple[str, str]:
+    """
+    Returns:
+        (os, architecture)
+    """
+    match = _user_agent_platform_regex.search(user_agent)
+    if match:
+        return match.group(1), match.group(2)
+    os_name, _, architecture = DOCKER_PREFETCH_PLATFORM.partition("/")
+    return os_name, architecture.split("/")[0]
+
+
+def select_platform_manifest(
+    index: dict, os_name: str, architecture: str
+) -> typing.Optional[str]:
+    """从 manifest list 中选出指定平台的 manifest digest"""
+    for descriptor in index.get("manifests", []):
+        platform = descriptor.get("platform", {})
+        if (
+            platform.get("os") == os_name
+            and platform.get("architecture") == architecture
+        ):
+            return descriptor.get("digest")
+    return None
+
+
+def get_blob_digests(manifest: dict) -> typing.List[str]:
+    """config 和所有 layer 的 digest，跳过需要从外部地址下载的 layer"""
+    descriptors = [manifest.get("config", {})] + manifest.get("layers", [])
+    return [
+        descriptor["digest"]
+        for descriptor in descriptors
+        if descriptor.get("digest") and not descriptor.get("urls")
+    ]
+
+
+class LayerPrefetcher:
+    def __init__(self, concurrency: int = DOCKER_PREFETCH_CONCURRENCY):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._queued: typing.Set[str] = set()
+
+    async def _prefetch_blob(
+        self, request: Request, base_url: str, name: str, digest: str
+    ):
+        blob_file = get_blob_path(digest)
+        if blob_file is None or blob_file in self._queued:
+            return
+        self._queued.add(blob_file)
+        try:
+            async with self._semaphore:
+                target_url = base_url + f"/v2/{name}/blobs/{digest}"
+                # 排队期间客户端可能已经自己请求了这个 blob，prefetch_file 会跳过
+                flight = await prefetch_file(request, target_url, cache_file=blob_file)
+                if flight is None or flight.task is None:
+                    return
+                logger.info(f"Prefetching {name}@{digest}")
+                # 下载结束后才释放名额
+                await asyncio.shield(flight.task)
+        finally:
+            self._queued.discard(blob_file)
+
+    async def prefetch(
+        self,
+        request: Request,
+        base_url: str,
+        name: str,
+        manifest_body: bytes,
+        content_type: str,
+        fetch_manifest: typing.Callable[
+            [str], typing.Awaitable[typing.Optional[bytes]]
+        ],
+    ):
+        """
+        预取 manifest 引用的所有 blob
+
+        Args:
+            request: 客户端请求，认证信息用于下载 blob
+            base_url: 上游 registry 地址
+            name: 上游的镜像名
+            manifest_body: manifest 或 manifest list 的内容
+            content_type: manifest 的 Content-Type
+            fetch_manifest: 按 digest 获取 manifest 内容，用于 manifest list
+        """
+        try:
+            manifest = json.loads(manifest_body)
+            media_type = get_media_type(manifest, content_type)
+
+            if media_type in INDEX_MEDIA_TYPES:
+                os_name, architecture = get_client_platform(
+                    request.headers.get("user-agent", "")
+                )
+                digest = select_platform_manifest(manifest, os_name, architecture)
+                if digest is None:
+                    return
+                body = await fetch_manifest(digest)
+                if body is None:
+                    return
+                manifest = json.loads(body)
+                media_type = get_media_type(manifest, "")
+
+            if media_type not in MANIFEST_MEDIA_TYPES:
+                return
+
+            await asyncio.gather(
+                *(
+                    self._prefetch_blob(request, base_url, name, digest)
+                    for digest in get_blob_digests(manifest)
+                )
+            )
+        except Exception as e:
+            logger.warning(f"Failed to prefetch layers of {name}: {e}")
+
+
+# 全局预取器
+layer_prefetcher = LayerPrefetcher()
@@ -0,0 +1,158 @@
+"""
+上游 docker registry 的认证 realm
+
+启动时对每个配置的 registry 请求一次 /v2/，从 WWW-Authenticate 中解析 realm 和 service，
+保存到 DATA_DIR 下供所有 worker 共享，并定期在后台刷新。
+/token 请求据此直接得到上游的 token 服务地址，不依赖客户端是否先访问过 /v2/。
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from threading import Lock
+from typing import Dict, List, Optional
+
+from mirrorsrun.config import DOCKER_REALM_REFRESH_INTERVAL, DOCKER_REALMS_FILE
+from mirrorsrun.proxy.direct import get_upstream_client
+
+logger = logging.getLogger(__name__)
+
+_challenge_param_regex = re.compile(r'(\w+)="([^"]*)"')
+
+
+@dataclass
+class RealmInfo:
+    realm: str
+    service: str
+    discovered_at: float
+
+
+def parse_bearer_challenge(header: str) -> Optional[Dict[str, str]]:
+    """
+    解析 WWW-Authenticate: Bearer realm="...",service="...",scope="..."
+
+    Returns:
+        参数字典，不是 Bearer 认证时返回 None
+    """
+    if not header.startswith("Bearer "):
+        return None
+    return dict(_challenge_param_regex.findall(header.removeprefix("Bearer ")))
+
+
+class RealmRegistry:
+    """以上游 registry 地址为键的 realm 登记表"""
+
+    def __init__(self, store_file: str = DOCKER_REALMS_FILE):
+        self.store_file = store_file
+        self._registries: List[str] = []
+        self._realms: Dict[str, RealmInfo] = {}
+        self._loaded_mtime = 0.0
+        self._lock = Lock()
+        self._task: Optional[asyncio.Task] = None
+        self._load()
+
+    def register(self, base_url: str):
+        """登记需要发现 realm 的上游 registry"""
+        if base_url not in self._registries:
+            self._registries.append(base_url)
+
+    def _load(self):
+        try:
+            mtime = os.path.getmtime(self.store_file)
+            if mtime == self._loaded_mtime:
+                return
+            with open(self.store_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            with self._lock:
+                self._realms.update({k: RealmInfo(**v) for k, v in data.items()})
+            self._loaded_mtime = mtime
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Failed to load docker realms: {e}")
+
+    def _save(self):
+        try:
+            Path(self.store_file).parent.mkdir(parents=True, exist_ok=True)
+            # 原子写入：先写入临时文件，再重命名
+            temp_file = f"{self.store_file}.{os.getpid()}.tmp"
+            with self._lock:
+                data = {k: asdict(v) for k, v in self._realms.items()}
+            with open(temp_file, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False, indent=2)
+            os.replace(temp_file, self.store_file)
+            self._loaded_mtime = os.path.getmtime(self.store_file)
+        except Exception as e:
+            logger.error(f"Failed to save docker realms: {e}")
+
+    def get(self, base_url: str) -> Optional[RealmInfo]:
+        info = self._realms.get(base_url)
+        if info is None:
+            # 可能已由其他 worker 发现
+            self._load()
+            info = self._realms.get(base_url)
+        return info
+
+    def record(self, base_url: str, realm: str, service: str):
+        info = self._realms.get(base_url)
+        if info is not None and info.realm == realm and info.service == service:
+            return
+        logger.info(f"Docker auth realm for {base_url}: {realm} (service={service})")
+        with self._lock:
+            self._realms[base_url] = RealmInfo(realm, service, time.time())
+        self._save()
+
+    async def discover(self, base_url: str) -> Optional[RealmInfo]:
+        """请求上游 /v2/，从认证质询中解析 realm"""
+        try:
+            response = await get_upstream_client().get(
+                base_url + "/v2/", follow_redirects=True, timeout=30
+            )
+        except Exception as e:
+            logger.warning(f"Failed to discover auth realm of {base_url}: {e}")
+            return None
+
+        challenge = parse_bearer_challenge(response.headers.get("www-authenticate", ""))
+        if not challenge or not challenge.get("realm"):
+            logger.warning(
+                f"No bearer challenge from {base_url}/v2/, status {response.status_code}"
+            )
+            return None
+
+        self.record(base_url, challenge["realm"], challenge.get("service", ""))
+        return self._realms[base_url]
+
+    async def resolve(self, base_url: str) -> Optional[RealmInfo]:
+        """返回 realm，本地没有时立即发现一次"""
+        return self.get(base_url) or await self.discover(base_url)
+
+    async def discover_all(self):
+        await asyncio.gather(
+            *(self.discover(base_url) for base_url in self._registries)
+        )
+
+    async def _refresh_loop(self):
+        while True:
+            await self.discover_all()
+            await asyncio.sleep(DOCKER_REALM_REFRESH_INTERVAL)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._refresh_loop())
+            logger.info(
+                f"Docker realm discovery started for {len(self._registries)} registries"
+            )
+
+    def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+
+
+# 全局登记表
+realm_registry = RealmRegistry()
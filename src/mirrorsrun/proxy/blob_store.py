@@ -0,0 +1,63 @@
+"""
+内容寻址的 blob 存储
+
+docker 的 blob 以 digest 寻址，同一个 layer 可能以不同的镜像名出现在多个 registry 中。
+所有 registry 共用一份以 digest 为键的存储：<BLOB_STORE_DIR>/<algorithm>/<hex[:2]>/<hex>
+"""
+
+import logging
+import os
+import re
+import typing
+from pathlib import Path
+
+from mirrorsrun.config import BLOB_STORE_DIR
+
+logger = logging.getLogger(__name__)
+
+# https://github.com/opencontainers/image-spec/blob/main/descriptor.md#registered-algorithms
+DIGEST_REGEX = re.compile(r"^(sha256:[a-f0-9]{64}|sha512:[a-f0-9]{128})$")
+
+
+def parse_digest(digest: str) -> typing.Optional[typing.Tuple[str, str]]:
+    """
+    Returns:
+        (algorithm, hex)，不是受支持的 digest 时返回 None
+    """
+    if not DIGEST_REGEX.match(digest):
+        return None
+    algorithm, hex_digest = digest.split(":", 1)
+    return algorithm, hex_digest
+
+
+def get_blob_path(digest: str) -> typing.Optional[str]:
+    """返回 digest 对应的缓存文件路径，不是受支持的 digest 时返回 None"""
+    parsed = parse_digest(digest)
+    if parsed is None:
+        return None
+    algorithm, hex_digest = parsed
+    return str(Path(BLOB_STORE_DIR) / algorithm / hex_digest[:2] / hex_digest)
+
+
+def adopt_legacy_blob(legacy_file: str, blob_file: str) -> bool:
+    """
+    把旧版按 registry/镜像名 保存的 blob 移入共享存储，避免重新下载
+
+    Returns:
+        是否移动了文件
+    """
+    if os.path.exists(blob_file) or not os.path.isfile(legacy_file):
+        return False
+    # 仍在下载中的文件不处理
+    if os.path.exists(f"{legacy_file}.aria2"):
+        return False
+
+    try:
+        os.makedirs(os.path.dirname(blob_file), exist_ok=True)
+        os.replace(legacy_file, blob_file)
+    except OSError as e:
+        logger.warning(f"Failed to move {legacy_file} into blob store: {e}")
+        return False
+
+    logger.info(f"Moved cached blob {legacy_file} to {blob_file}")
+    return True
@@ -1,13 +1,21 @@
+import importlib.util
 import logging
 import typing
-from typing import Callable, Coroutine
+from typing import Callable, Coroutine, Optional
 
 import httpx
 from httpx import Request as HttpxRequest
 from starlette.requests import Request
-from starlette.responses import Response
+from starlette.responses import Response, StreamingResponse
 from tenacity import retry, retry_if_exception_type, stop_after_attempt
 
+from mirrorsrun.config import (
+    UPSTREAM_HTTP2,
+    UPSTREAM_KEEPALIVE_EXPIRY,
+    UPSTREAM_MAX_CONNECTIONS,
+    UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+)
+
 SyncPreProcessor = Callable[[Request, HttpxRequest], HttpxRequest]
 
 AsyncPreProcessor = Callable[
@@ -20,11 +28,58 @@ AsyncPostProcessor = Callable[
     [Request, Response], Coroutine[Request, Response, Response]
 ]
 
+# 流式变换：逐块处理上游响应体，不需要先把整个响应读入内存
+StreamTransform = Callable[
+    [Request, typing.AsyncIterator[bytes]], typing.AsyncIterator[bytes]
+]
+
 PreProcessor = typing.Union[SyncPreProcessor, AsyncPreProcessor, None]
 PostProcessor = typing.Union[SyncPostProcessor, AsyncPostProcessor, None]
 
 logger = logging.getLogger(__name__)
 
+# 逐跳头部只对客户端到本服务的连接有效，不能转发（HTTP/2 会直接拒绝）
+HOP_BY_HOP_HEADERS = [
+    "connection",
+    "keep-alive",
+    "proxy-connection",
+    "te",
+    "transfer-encoding",
+    "upgrade",
+]
+
+# 所有上游请求共用的连接池，避免每个请求重复 DNS 解析和 TCP/TLS 握手
+_upstream_client: Optional[httpx.AsyncClient] = None
+
+
+def get_upstream_client() -> httpx.AsyncClient:
+    global _upstream_client
+    if _upstream_client is None or _upstream_client.is_closed:
+        # HTTP/2 依赖可选的 h2 包（httpx[http2]），未安装时退回 HTTP/1.1
+        http2 = UPSTREAM_HTTP2 and importlib.util.find_spec("h2") is not None
+        if UPSTREAM_HTTP2 and not http2:
+            logger.warning("h2 is not installed, upstream connections use HTTP/1.1")
+
+        # httpx will use the following environment variables to determine the proxy
+        # https://www.python-httpx.org/environment_variables/#http_proxy-https_proxy-all_proxy
+        _upstream_client = httpx.AsyncClient(
+            http2=http2,
+            limits=httpx.Limits(
+                max_connections=UPSTREAM_MAX_CONNECTIONS,
+                max_keepalive_connections=UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=UPSTREAM_KEEPALIVE_EXPIRY,
+            ),
+        )
+        logger.info(f"Upstream client created, {http2=}")
+    return _upstream_client
+
+
+async def close_upstream_client():
+    global _upstream_client
+    if _upstream_client is not None:
+        await _upstream_client.aclose()
+        _upstream_client = None
+
 
 async def pre_process_request(
     request: Request,
@@ -55,6 +110,64 @@ async def post_process_response(
         return response
 
 
+async def replace_in_stream(
+    chunks: typing.AsyncIterator[bytes], old: bytes, new: bytes
+) -> typing.AsyncIterator[bytes]:
+    """在字节流中替换 old 为 new，正确处理跨块的匹配"""
+    keep = len(old) - 1
+    tail = b""
+    async for chunk in chunks:
+        parts = (tail + chunk).split(old)
+        last = parts[-1]
+        # 完整的匹配已经被切分掉，跨块的匹配只可能从最后 keep 个字节开始
+        split_at = max(len(last) - keep, 0)
+        tail = last[split_at:]
+        out = new.join(parts[:-1] + [last[:split_at]])
+        if out:
+            yield out
+    if tail:
+        yield tail
+
+
+async def iter_upstream(
+    upstream_response: httpx.Response, chunks: typing.AsyncIterator[bytes]
+) -> typing.AsyncIterator[bytes]:
+    try:
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        # 客户端中途断开时也要把连接还给连接池
+        await upstream_response.aclose()
+
+
+def make_streaming_response(
+    request: Request,
+    upstream_response: httpx.Response,
+    stream_transform: Optional[StreamTransform] = None,
+) -> Response:
+    res_headers = {
+        key: value
+        for key, value in upstream_response.headers.items()
+        if key not in HOP_BY_HOP_HEADERS
+    }
+
+    chunks: typing.AsyncIterator[bytes]
+    if stream_transform is not None:
+        # 变换需要解压后的内容，长度也会变化
+        res_headers.pop("content-length", None)
+        res_headers.pop("content-encoding", None)
+        chunks = stream_transform(request, upstream_response.aiter_bytes())
+    else:
+        # 原样转发（包括压缩编码），保留上游的 content-length
+        chunks = upstream_response.aiter_raw()
+
+    return StreamingResponse(
+        iter_upstream(upstream_response, chunks),
+        status_code=upstream_response.status_code,
+        headers=res_headers,
+    )
+
+
 @retry(
     stop=stop_after_attempt(6),
     retry=retry_if_exception_type(Exception),
@@ -69,43 +182,57 @@ async def direct_proxy(
     pre_process: typing.Union[SyncPreProcessor, AsyncPreProcessor, None] = None,
     post_process: typing.Union[SyncPostProcessor, AsyncPostProcessor, None] = None,
     follow_redirects: bool = True,
+    stream_transform: Optional[StreamTransform] = None,
 ) -> Response:
+    """
+    转发请求到上游
 
-    # httpx will use the following environment variables to determine the proxy
-    # https://www.python-httpx.org/environment_variables/#http_proxy-https_proxy-all_proxy
-    async with httpx.AsyncClient() as client:
-        req_headers = request.headers.mutablecopy()
-        for key in req_headers.keys():
-            if key in ["host"]:
-                del req_headers[key]
-
-        httpx_req: HttpxRequest = client.build_request(
-            request.method,
-            target_url,
-            headers=req_headers,
-            timeout=30,
-        )
+    没有 post_process 时以流的方式返回，首字节延迟和内存占用只与块大小有关；
+    post_process 需要完整的 Response，因此会先读取整个响应体。
+    """
+
+    client = get_upstream_client()
 
-        httpx_req = await pre_process_request(request, httpx_req, pre_process)
+    req_headers = request.headers.mutablecopy()
+    for key in req_headers.keys():
+        if key in ["host"] + HOP_BY_HOP_HEADERS:
+            del req_headers[key]
 
+    httpx_req: HttpxRequest = client.build_request(
+        request.method,
+        target_url,
+        headers=req_headers,
+        timeout=30,
+    )
+
+    httpx_req = await pre_process_request(request, httpx_req, pre_process)
+
+    if post_process is None:
         upstream_response = await client.send(
             httpx_req,
             follow_redirects=follow_redirects,
+            stream=True,
         )
+        return make_streaming_response(request, upstream_response, stream_transform)
 
-        res_headers = {key: value for key, value in upstream_response.headers.items()}
+    upstream_response = await client.send(
+        httpx_req,
+        follow_redirects=follow_redirects,
+    )
 
-        if request.method != "HEAD":
-            res_headers.pop("content-length", None)
-            res_headers.pop("content-encoding", None)
+    res_headers = {key: value for key, value in upstream_response.headers.items()}
 
-        content = upstream_response.content
-        response = Response(
-            headers=res_headers,
-            content=content,
-            status_code=upstream_response.status_code,
-        )
+    if request.method != "HEAD":
+        res_headers.pop("content-length", None)
+        res_headers.pop("content-encoding", None)
 
-        response = await post_process_response(request, response, post_process)
+    content = upstream_response.content
+    response = Response(
+        headers=res_headers,
+        content=content,
+        status_code=upstream_response.status_code,
+    )
 
-        return response
+    response = await post_process_response(request, response, post_process)
+
+    return response
@@ -0,0 +1,468 @@
+"""
+文件缓存的下载后端
+
+后端负责把上游文件下载到缓存路径，并提供：
+- 文件是否正在下载（lookup_cache_file 据此区分 DOWNLOADING / DOWNLOADED）
+- 下载进度（边下载边返回据此确定可以读取的范围）
+- 监视下载直到完成或失败，唤醒等待同一文件的请求
+
+可选的实现：
+- aria2：由独立的 aria2 服务下载，通过 JSON-RPC 和 WebSocket 通知跟踪进度
+- native：进程内的分段下载器（见 native_downloader），不依赖外部服务
+"""
+
+import asyncio
+import logging
+from abc import ABC, abstractmethod
+import os
+import time
+import typing
+from asyncio import sleep
+from urllib.parse import urlparse
+
+from mirrorsrun.aria2_api import (
+    DownloadPriority,
+    download_scheduler,
+    get_status,
+    notification_listener,
+    remove_download,
+)
+from mirrorsrun.aria2_ws import EVENT_BT_COMPLETE, EVENT_COMPLETE
+from mirrorsrun.config import (
+    DOWNLOAD_BACKEND,
+    ENABLE_ARIA2_NOTIFICATIONS,
+    NATIVE_MAX_CONCURRENT_DOWNLOADS,
+    NATIVE_MIN_SEGMENT_SIZE,
+    NATIVE_SEGMENTS,
+    PROGRESSIVE_SERVING,
+    PROGRESSIVE_STALL_TIMEOUT,
+)
+from mirrorsrun.proxy.native_downloader import (
+    PART_SUFFIX,
+    NativeDownload,
+    NativeDownloader,
+)
+from mirrorsrun.proxy.progressive import DownloadProgress, get_aria2_progress
+from mirrorsrun.proxy.singleflight import DownloadFlight
+
+logger = logging.getLogger(__name__)
+
+# 使用 aria2 通知时，兜底查询下载状态的间隔（秒）
+STATUS_CHECK_INTERVAL = 30
+# 排队或被暂停的 aria2 下载状态，没有进度不代表停滞
+HELD_STATUSES = ("waiting", "paused")
+
+
+class DownloadFailed(Exception):
+    """后端报告下载失败"""
+
+
+class DownloadBackend(ABC):
+    name = ""
+
+    @abstractmethod
+    def is_downloading(self, cache_file: str) -> bool:
+        """cache_file 是否正在被下载（包括其他进程提交的下载）"""
+
+    @abstractmethod
+    def get_progress(self, cache_file: str) -> typing.Optional[DownloadProgress]:
+        """正在下载或已经下载完成的文件的进度，文件不存在时返回 None"""
+
+    @abstractmethod
+    def get_written_length(self, cache_file: str) -> typing.Optional[int]:
+        """其他进程提交的下载已经写入的字节数，仅用于判断下载是否停滞"""
+
+    @abstractmethod
+    async def submit(
+        self,
+        url: str,
+        cache_file: str,
+        headers: typing.Dict[str, str],
+        priority: DownloadPriority,
+    ) -> str:
+        """提交下载并返回下载 ID"""
+
+    async def promote(self, download_id: str):
+        """有客户端开始等待这个下载"""
+
+    def on_finished(self, download_id: str):
+        """下载的监视任务结束"""
+
+    def is_held(self, download_id: str) -> bool:
+        """下载是否在排队或被暂停，此时没有进度不算停滞"""
+        return False
+
+    async def cancel(self, download_id: str, cache_file: str):
+        """
+        监视失败后取消下载并删除未完成的文件
+
+        否则遗留的下载会让之后的请求一直认为文件正在下载。
+        """
+
+    async def query_completed_length(self, download_id: str) -> typing.Optional[int]:
+        """
+        查询本进程提交的下载已完成的字节数
+
+        Raises:
+            DownloadFailed: 下载已经失败
+        """
+        return None
+
+    async def watch(self, flight: DownloadFlight, target_url: str):
+        """监视下载直到完成或失败，结果写入 flight"""
+        await self.poll(flight, target_url)
+
+    def start(self):
+        pass
+
+    def stop(self):
+        pass
+
+    async def poll(self, flight: DownloadFlight, target_url: str):
+        """每秒检查一次缓存文件，用于无法接收下载事件的情况"""
+        cache_file = flight.key
+        package_name = os.path.basename(urlparse(target_url).path)
+        last_progress = time.time()
+        last_completed_length = -1
+
+        i = 0
+        while True:
+            await sleep(1)
+
+            if not self.is_downloading(cache_file) and os.path.exists(cache_file):
+                logger.info(f"[METRICS] {self.name} download completed: {package_name}")
+                flight.complete()
+                return
+
+            progress = self.get_progress(cache_file)
+            if progress is not None and progress.total_length is not None:
+                flight.mark_streamable()
+
+            completed_length = None
+            if flight.gid:
+                # 定期获取下载状态（每 5 秒一次）
+                if i % 5 == 0:
+                    try:
+                        completed_length = await self.query_completed_length(flight.gid)
+                    except DownloadFailed as e:
+                        flight.fail(str(e))
+                        return
+                    except Exception as e:
+                        logger.warning(
+                            f"Failed to get status of download {flight.gid}: {e}"
+                        )
+            else:
+                # 由其他进程提交的下载，没有下载 ID，根据已写入的数据判断进度
+                completed_length = self.get_written_length(cache_file)
+
+            if flight.gid and self.is_held(flight.gid):
+                # 排队或被暂停的下载没有进度，不算停滞
+                last_progress = time.time()
+            elif (
+                completed_length is not None
+                and completed_length != last_completed_length
+            ):
+                last_completed_length = completed_length
+                last_progress = time.time()
+
+            if time.time() - last_progress > PROGRESSIVE_STALL_TIMEOUT:
+                flight.fail(f"no progress for {PROGRESSIVE_STALL_TIMEOUT}s")
+                return
+
+            i += 1
+
+
+class Aria2Backend(DownloadBackend):
+    """
+    由 aria2 下载
+
+    aria2 直接写入缓存文件，下载期间旁边存在控制文件（*.aria2）。
+    """
+
+    name = "Aria2"
+
+    def __init__(self):
+        # 最近一次查询时在排队或被暂停的下载
+        self._held: typing.Set[str] = set()
+
+    def is_downloading(self, cache_file: str) -> bool:
+        return os.path.exists(f"{cache_file}.aria2")
+
+    def get_progress(self, cache_file: str) -> typing.Optional[DownloadProgress]:
+        return get_aria2_progress(cache_file)
+
+    def get_written_length(self, cache_file: str) -> typing.Optional[int]:
+        try:
+            return os.path.getsize(cache_file)
+        except OSError:
+            return None
+
+    async def submit(
+        self,
+        url: str,
+        cache_file: str,
+        headers: typing.Dict[str, str],
+        priority: DownloadPriority,
+    ) -> str:
+        return await download_scheduler.submit(
+            url,
+            save_dir=os.path.dirname(cache_file),
+            out_file=os.path.basename(cache_file),
+            headers=headers,
+            priority=priority,
+        )
+
+    async def promote(self, download_id: str):
+        await download_scheduler.promote(download_id)
+
+    def on_finished(self, download_id: str):
+        self._held.discard(download_id)
+        download_scheduler.on_finished(download_id)
+
+    def is_held(self, download_id: str) -> bool:
+        return download_id in self._held or download_scheduler.is_paused(download_id)
+
+    async def cancel(self, download_id: str, cache_file: str):
+        try:
+            await remove_download(download_id)
+        except Exception as e:
+            # 已经出错结束的下载无法移除
+            logger.debug(f"[Aria2] Failed to remove download {download_id}: {e}")
+
+        # 确认 aria2 已经停止写入后再删除文件
+        status = None
+        for _ in range(50):
+            try:
+                status = (await get_status(download_id)).get("status")
+            except Exception as e:
+                logger.warning(f"Failed to get aria2 status for GID {download_id}: {e}")
+                return
+            if status not in ("active",) + HELD_STATUSES:
+                break
+            await sleep(0.1)
+        if status not in ("removed", "error"):
+            return
+
+        logger.info(f"[Aria2] Removed failed download {download_id} of {cache_file}")
+        for path in (f"{cache_file}.aria2", cache_file):
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                logger.warning(f"Failed to remove {path}: {e}")
+
+    async def query_completed_length(self, download_id: str) -> typing.Optional[int]:
+        status_info = await get_status(download_id)
+        download_speed = int(status_info.get("downloadSpeed", 0))
+        completed_length = int(status_info.get("completedLength", 0))
+        total_length = int(status_info.get("totalLength", 0))
+
+        logger.debug(
+            f"[Aria2] GID: {download_id} | "
+            f"Speed: {download_speed / (1024*1024):.2f}MB/s | "
+            f"Progress: {completed_length}/{total_length}"
+        )
+
+        if status_info.get("status") in ("error", "removed"):
+            raise DownloadFailed(status_info.get("errorMessage") or "download removed")
+        if status_info.get("status") in HELD_STATUSES:
+            self._held.add(download_id)
+        else:
+            self._held.discard(download_id)
+        return completed_length
+
+    async def watch(self, flight: DownloadFlight, target_url: str):
+        # 已连接 aria2 WebSocket 时由通知驱动，否则退回到每秒轮询
+        if flight.gid and notification_listener.connected:
+            await self.wait_download_events(flight, target_url)
+        else:
+            await self.poll(flight, target_url)
+
+    def start(self):
+        # 下载优先级调度：观察吞吐量，调整后台下载的限速和 aria2 并发数
+        download_scheduler.start()
+        # 订阅 aria2 下载完成通知
+        if ENABLE_ARIA2_NOTIFICATIONS:
+            notification_listener.start()
+
+    def stop(self):
+        download_scheduler.stop()
+        if ENABLE_ARIA2_NOTIFICATIONS:
+            notification_listener.stop()
+
+    async def wait_download_events(self, flight: DownloadFlight, target_url: str):
+        """等待 aria2 的下载结束通知，仅在必要时查询状态"""
+        assert flight.gid
+        cache_file = flight.key
+        package_name = os.path.basename(urlparse(target_url).path)
+        finished = notification_listener.subscribe(flight.gid)
+
+        # 渐进式返回需要等控制文件出现才知道文件总长度，这段时间内短暂退避轮询
+        streamable_delay = 0.1
+        last_progress = time.time()
+        last_completed_length = -1
+
+        while True:
+            if PROGRESSIVE_SERVING and not flight.streamable:
+                timeout = streamable_delay
+                streamable_delay = min(streamable_delay * 2, 1)
+            else:
+                timeout = STATUS_CHECK_INTERVAL
+
+            done, _ = await asyncio.wait([finished], timeout=timeout)
+
+            if done:
+                event = finished.result()
+                if event in (EVENT_COMPLETE, EVENT_BT_COMPLETE):
+                    # aria2 删除控制文件与发出通知之间可能有极短的间隔
+                    for _ in range(20):
+                        if not self.is_downloading(cache_file) and os.path.exists(
+                            cache_file
+                        ):
+                            break
+                        await sleep(0.1)
+                    logger.info(f"[METRICS] Aria2 download completed: {package_name}")
+                    flight.complete()
+                else:
+                    flight.fail(await self.get_error_message(flight.gid, event))
+                return
+
+            if not flight.streamable:
+                progress = self.get_progress(cache_file)
+                if progress is not None and progress.total_length is not None:
+                    flight.mark_streamable()
+                if timeout < STATUS_CHECK_INTERVAL:
+                    continue
+
+            # 兜底：WebSocket 断线期间可能错过通知，定期确认一次状态
+            try:
+                status_info = await get_status(flight.gid)
+            except Exception as e:
+                logger.warning(f"Failed to get aria2 status for GID {flight.gid}: {e}")
+                continue
+            status = status_info.get("status")
+            if status == "complete":
+                flight.complete()
+                return
+            if status in ("error", "removed"):
+                flight.fail(status_info.get("errorMessage") or f"download {status}")
+                return
+
+            completed_length = int(status_info.get("completedLength", 0))
+            if completed_length != last_completed_length or status in HELD_STATUSES:
+                last_completed_length = completed_length
+                last_progress = time.time()
+            elif time.time() - last_progress > PROGRESSIVE_STALL_TIMEOUT:
+                flight.fail(f"no progress for {PROGRESSIVE_STALL_TIMEOUT}s")
+                return
+
+    @staticmethod
+    async def get_error_message(gid: str, event: str) -> str:
+        try:
+            status_info = await get_status(gid)
+            return (
+                status_info.get("errorMessage")
+                or f"download {status_info.get('status')}"
+            )
+        except Exception:
+            return event
+
+
+class NativeBackend(DownloadBackend):
+    """
+    由进程内的分段下载器下载
+
+    数据写入 <缓存文件>.part，完成后重命名为缓存文件。其他进程（worker）
+    的下载只能通过临时文件观察：临时文件最近被写入过即视为正在下载。
+    """
+
+    name = "Native"
+
+    def __init__(self):
+        self.downloader = NativeDownloader(
+            max_concurrent=NATIVE_MAX_CONCURRENT_DOWNLOADS,
+            max_segments=NATIVE_SEGMENTS,
+            min_segment_size=NATIVE_MIN_SEGMENT_SIZE,
+            read_timeout=PROGRESSIVE_STALL_TIMEOUT,
+        )
+
+    def is_downloading(self, cache_file: str) -> bool:
+        if self.downloader.find(cache_file) is not None:
+            return True
+        try:
+            mtime = os.path.getmtime(cache_file + PART_SUFFIX)
+        except OSError:
+            return False
+        # 进程退出时遗留的临时文件不再被写入，超过停滞时间后忽略
+        return time.time() - mtime < PROGRESSIVE_STALL_TIMEOUT
+
+    def get_progress(self, cache_file: str) -> typing.Optional[DownloadProgress]:
+        download = self.downloader.find(cache_file)
+        if download is not None:
+            return DownloadProgress(
+                download.total_length, download.available_length, download.part_file
+            )
+        try:
+            return DownloadProgress(None, os.path.getsize(cache_file), cache_file)
+        except OSError:
+            return None
+
+    def get_written_length(self, cache_file: str) -> typing.Optional[int]:
+        # 临时文件中尚未写入的部分是空洞，已分配的块数随写入增长
+        try:
+            return os.stat(cache_file + PART_SUFFIX).st_blocks * 512
+        except OSError:
+            return None
+
+    async def submit(
+        self,
+        url: str,
+        cache_file: str,
+        headers: typing.Dict[str, str],
+        priority: DownloadPriority,
+    ) -> str:
+        return self.downloader.submit(url, cache_file, headers, priority).id
+
+    async def promote(self, download_id: str):
+        self.downloader.promote(download_id, DownloadPriority.INTERACTIVE)
+
+    def on_finished(self, download_id: str):
+        self.downloader.forget(download_id)
+
+    async def watch(self, flight: DownloadFlight, target_url: str):
+        download = self.downloader.get(flight.gid) if flight.gid else None
+        if download is None:
+            await self.poll(flight, target_url)
+            return
+
+        def on_progress(download: NativeDownload):
+            # 知道总长度即可边下载边返回
+            if download.total_length is not None and not download.finished.is_set():
+                flight.mark_streamable()
+
+        download.add_listener(on_progress)
+        on_progress(download)
+        await download.finished.wait()
+
+        if download.error is not None:
+            flight.fail(download.error)
+            return
+        package_name = os.path.basename(urlparse(target_url).path)
+        logger.info(f"[METRICS] Native download completed: {package_name}")
+        flight.complete()
+
+    def stop(self):
+        self.downloader.stop()
+
+
+def create_download_backend(name: str = DOWNLOAD_BACKEND) -> DownloadBackend:
+    if name == "native":
+        return NativeBackend()
+    if name != "aria2":
+        logger.warning(f"Unknown download backend {name!r}, using aria2")
+    return Aria2Backend()
+
+
+# 全局下载后端
+download_backend = create_download_backend()
@@ -3,18 +3,40 @@ import os
 import pathlib
 import typing
 import time
-from asyncio import sleep
+import asyncio
 from enum import Enum
 from urllib.parse import urlparse, quote
 
-import httpx
+from starlette.background import BackgroundTask
 from starlette.requests import Request
-from starlette.responses import Response
-from starlette.status import HTTP_500_INTERNAL_SERVER_ERROR, HTTP_504_GATEWAY_TIMEOUT
+from starlette.responses import Response, StreamingResponse
+from starlette.status import (
+    HTTP_500_INTERNAL_SERVER_ERROR,
+    HTTP_502_BAD_GATEWAY,
+    HTTP_504_GATEWAY_TIMEOUT,
+)
 
-from mirrorsrun.aria2_api import add_download, get_status
-from mirrorsrun.config import CACHE_DIR, EXTERNAL_URL_ARIA2, METRICS_FILE, ENABLE_SESSION_SUMMARY
+from mirrorsrun.aria2_api import DownloadPriority
+from mirrorsrun.config import (
+    CACHE_DIR,
+    COOCCURRENCE_PREFETCH,
+    EXTERNAL_URL_ARIA2,
+    METRICS_FILE,
+    ENABLE_SESSION_SUMMARY,
+    PROGRESSIVE_SERVING,
+    PROGRESSIVE_STALL_TIMEOUT,
+    TEE_ON_MISS,
+    TEE_ON_MISS_MAX_SIZE,
+)
+from mirrorsrun.cooccurrence import session_prefetcher
 from mirrorsrun.metrics import MetricsRecorder
+from mirrorsrun.proxy.direct import get_upstream_client
+from mirrorsrun.proxy.download_backend import download_backend
+from mirrorsrun.proxy.file_response import make_file_response
+from mirrorsrun.proxy.integrity import get_verifier
+from mirrorsrun.proxy.progressive import DownloadProgress, make_progressive_response
+from mirrorsrun.proxy.singleflight import DownloadFlight, download_flights
+from mirrorsrun.proxy.tee import TeeDownload, start_tee, tee_downloads
 from mirrorsrun.session_manager import session_manager
 from mirrorsrun.cache_tracker import get_cache_tracker
 
@@ -49,9 +71,13 @@ class DownloadingStatus(Enum):
 
 def lookup_cache(url: str) -> DownloadingStatus:
     cache_file, _ = get_cache_file_and_folder(url)
+    return lookup_cache_file(cache_file)
 
-    cache_file_aria2 = f"{cache_file}.aria2"
-    if os.path.exists(cache_file_aria2):
+
+def lookup_cache_file(cache_file: str) -> DownloadingStatus:
+    if tee_downloads.get(cache_file) is not None or download_backend.is_downloading(
+        cache_file
+    ):
         return DownloadingStatus.DOWNLOADING
 
     if os.path.exists(cache_file):
@@ -60,21 +86,32 @@ def lookup_cache(url: str) -> DownloadingStatus:
     return DownloadingStatus.NOT_FOUND
 
 
-def make_cached_response(url):
-    cache_file, _ = get_cache_file_and_folder(url)
+def get_download_progress(cache_file: str) -> typing.Optional[DownloadProgress]:
+    """正在下载的文件的进度，包括 tee 下载和下载后端的下载"""
+    tee = tee_downloads.get(cache_file)
+    if tee is not None:
+        return tee.get_progress()
+    return download_backend.get_progress(cache_file)
+
 
+def make_cached_response(
+    request: Request,
+    cache_file: str,
+    expected_digest: typing.Optional[str] = None,
+) -> Response:
     assert os.path.exists(cache_file)
     assert not os.path.isdir(cache_file)
-    with open(cache_file, "rb") as f:
-        content = f.read()
-        return Response(content=content, status_code=200)
+    # 流式返回（支持 Range / If-Range / 条件请求），内存占用与文件大小无关
+    # 尚未校验过的文件在第一次完整返回时顺带校验
+    return make_file_response(
+        request.headers, cache_file, verifier=get_verifier(cache_file, expected_digest)
+    )
 
 
 async def get_url_content_length(url):
-    async with httpx.AsyncClient() as client:
-        head_response = await client.head(url)
-        content_len = head_response.headers.get("content-length", None)
-        return content_len
+    head_response = await get_upstream_client().head(url)
+    content_len = head_response.headers.get("content-length", None)
+    return content_len
 
 
 async def record_to_session(
@@ -84,20 +121,25 @@ async def record_to_session(
     cache_hit: bool,
     download_time: float,
     start_time: float,
-    end_time: float
+    end_time: float,
+    target_url: typing.Optional[str] = None,
+    cache_file: typing.Optional[str] = None,
 ):
     """记录包信息到会话"""
     if not ENABLE_SESSION_SUMMARY:
         return
-    
+
     try:
         # 提取客户端信息
         user_agent = request.headers.get("user-agent", "unknown")
         client_ip = request.client.host if request.client else "unknown"
-        
+
         # 转换为 MB
         size_mb = file_size / (1024 * 1024)
-        
+
+        # 私有内容不参与共现学习，避免预取给其他客户端
+        learnable = "authorization" not in request.headers
+
         # 记录到会话管理器
         await session_manager.record_package(
             user_agent=user_agent,
@@ -107,42 +149,315 @@ async def record_to_session(
             cache_hit=cache_hit,
             download_time=download_time,
             start_time=start_time,
-            end_time=end_time
+            end_time=end_time,
+            url=target_url if learnable else None,
+            cache_file=cache_file if learnable else None,
         )
     except Exception as e:
         logger.error(f"Failed to record to session: {e}")
 
 
+async def record_streamed_download(
+    request: Request,
+    target_url: str,
+    cache_file: str,
+    start_time: float,
+    status_message: str,
+):
+    """流式响应全部发送完毕（此时文件已经下载完成）后记录指标和会话"""
+    package_name = os.path.basename(urlparse(target_url).path)
+    end_time = time.time()
+    total_time = end_time - start_time
+    file_size = os.path.getsize(cache_file)
+
+    try:
+        cache_tracker = get_cache_tracker()
+        cache_tracker.update_access_time(cache_file)
+    except Exception:
+        pass  # 静默失败，不影响主要功能
+
+    metrics_recorder.record_metric(
+        url=target_url,
+        package_name=package_name,
+        file_size=file_size,
+        cache_hit=False,
+        total_time=total_time,
+        status="success",
+        client_receive_speed=file_size / total_time if total_time > 0 else 0,
+        status_message=status_message,
+    )
+
+    await record_to_session(
+        request=request,
+        package_name=package_name,
+        file_size=file_size,
+        cache_hit=False,
+        download_time=total_time,
+        start_time=start_time,
+        end_time=end_time,
+        target_url=target_url,
+        cache_file=cache_file,
+    )
+
+
+def make_downloading_response(
+    request: Request,
+    target_url: str,
+    cache_file: str,
+    start_time: float,
+    expected_digest: typing.Optional[str] = None,
+) -> typing.Optional[Response]:
+    """
+    为正在下载的文件构造边下载边返回的响应
+
+    Returns:
+        响应对象；未开启渐进式返回或总长度未知时返回 None
+    """
+    if not PROGRESSIVE_SERVING:
+        return None
+
+    return make_progressive_response(
+        request.headers,
+        cache_file,
+        stall_timeout=PROGRESSIVE_STALL_TIMEOUT,
+        background=BackgroundTask(
+            record_streamed_download,
+            request,
+            target_url,
+            cache_file,
+            start_time,
+            "progressive",
+        ),
+        verifier=get_verifier(cache_file, expected_digest),
+        get_progress=get_download_progress,
+    )
+
+
+def get_forward_headers(request: Request) -> typing.Dict[str, str]:
+    """转发给上游的客户端请求头"""
+    return {
+        key: value
+        for key, value in request.headers.items()
+        if key in ["user-agent", "accept", "authorization"]
+    }
+
+
+async def submit_download(
+    request: typing.Optional[Request],
+    target_url: str,
+    cache_file: str,
+    headers: typing.Optional[typing.Dict[str, str]] = None,
+    priority: DownloadPriority = DownloadPriority.INTERACTIVE,
+) -> str:
+    """
+    提交下载任务并返回下载 ID（aria2 的 GID）
+
+    Args:
+        request: 客户端请求，转发其中的部分请求头
+        target_url: 上游地址
+        cache_file: 缓存文件路径
+        headers: 不来自客户端请求时（例如批量预热），直接指定上游请求头
+        priority: 下载优先级，有客户端在等待的下载排在预取和预热之前
+    """
+    if headers is None:
+        assert request is not None
+        headers = get_forward_headers(request)
+
+    logger.info(f"prepare to cache, {target_url=} {cache_file=}")
+
+    processed_url = quote(target_url, safe="/:?=&%")
+
+    gid = await download_backend.submit(processed_url, cache_file, headers, priority)
+    logger.info(f"[{download_backend.name}] Download task created, GID: {gid}")
+    return gid
+
+
+async def watch_download(flight: DownloadFlight, target_url: str):
+    """
+    监视一个文件的下载进度，完成或失败时唤醒所有等待的请求
+
+    每个文件只运行一个监视任务，无论有多少请求在等待。
+    """
+    try:
+        await download_backend.watch(flight, target_url)
+    except Exception as e:
+        logger.error(f"Error watching download of {target_url}", exc_info=e)
+        flight.fail(str(e))
+    finally:
+        # 在释放之前清理，之后的请求不会看到失败下载遗留的文件
+        if flight.gid and flight.error is not None:
+            try:
+                await download_backend.cancel(flight.gid, flight.key)
+            except Exception as e:
+                logger.warning(f"Failed to cancel download of {target_url}: {e}")
+        download_flights.release(flight)
+        if flight.gid:
+            download_backend.on_finished(flight.gid)
+
+
+async def watch_tee(flight: DownloadFlight, tee: TeeDownload):
+    """tee 下载结束时唤醒合并等待的请求"""
+    try:
+        await tee.finished.wait()
+        if tee.error is not None:
+            flight.fail(tee.error)
+        else:
+            flight.complete()
+    finally:
+        download_flights.release(flight)
+
+
+async def try_tee_on_miss(
+    request: Request,
+    target_url: str,
+    cache_file: str,
+    flight: DownloadFlight,
+    start_time: float,
+    expected_digest: typing.Optional[str] = None,
+) -> typing.Optional[Response]:
+    """
+    缓存未命中时直接从上游边转发边缓存
+
+    Returns:
+        转发给客户端的流式响应；文件不适合 tee（较大、长度未知或上游出错）时返回 None，
+        调用方改用下载后端
+    """
+    # 只处理完整的 GET，Range 请求和 HEAD 仍由下载后端处理
+    if request.method != "GET" or "range" in request.headers:
+        return None
+
+    processed_url = quote(target_url, safe="/:?=&%")
+    tee = await start_tee(
+        processed_url,
+        cache_file,
+        get_forward_headers(request),
+        TEE_ON_MISS_MAX_SIZE,
+        verifier=get_verifier(cache_file, expected_digest),
+    )
+    if tee is None:
+        return None
+
+    logger.info(f"Tee-on-miss for {target_url} ({tee.total_length} bytes)")
+    # 总长度已知，合并等待的请求可以从临时文件边下载边读取
+    flight.mark_streamable()
+    flight.task = asyncio.create_task(watch_tee(flight, tee))
+
+    return StreamingResponse(
+        tee.iter_client(PROGRESSIVE_STALL_TIMEOUT, get_download_progress),
+        headers={"content-length": str(tee.total_length), "accept-ranges": "bytes"},
+        media_type="application/octet-stream",
+        background=BackgroundTask(
+            record_streamed_download, request, target_url, cache_file, start_time, "tee"
+        ),
+    )
+
+
+async def prefetch_file(
+    request: typing.Optional[Request],
+    target_url: str,
+    cache_file: typing.Optional[str] = None,
+    headers: typing.Optional[typing.Dict[str, str]] = None,
+    priority: DownloadPriority = DownloadPriority.PREFETCH,
+) -> typing.Optional[DownloadFlight]:
+    """
+    提前提交下载，不等待完成；之后对同一文件的请求会加入这次下载
+
+    请求头来自 request，或者由 headers 直接指定（参见 submit_download）。
+
+    Returns:
+        新的下载；文件已缓存、正在下载或提交失败时返回 None
+    """
+    if cache_file is None:
+        cache_file, _ = get_cache_file_and_folder(target_url)
+    if lookup_cache_file(cache_file) != DownloadingStatus.NOT_FOUND:
+        return None
+
+    flight, is_owner = download_flights.join(cache_file)
+    if not is_owner:
+        return None
+
+    try:
+        flight.gid = await submit_download(
+            request, target_url, cache_file, headers, priority
+        )
+    except Exception as e:
+        logger.warning(f"Failed to prefetch {target_url}: {e}")
+        flight.fail(str(e))
+        download_flights.release(flight)
+        return None
+
+    flight.task = asyncio.create_task(watch_download(flight, target_url))
+    return flight
+
+
+def schedule_session_prefetch(request: Request, target_url: str):
+    """客户端开始新的会话时，预取历史上经常跟随这个文件的其他文件"""
+    if "authorization" in request.headers:
+        return
+    user_agent = request.headers.get("user-agent", "unknown")
+    client_ip = request.client.host if request.client else "unknown"
+    if session_manager.has_active_session(user_agent, client_ip):
+        return
+
+    async def start_download(
+        request: Request, url: str, cache_file: str
+    ) -> typing.Optional[asyncio.Task]:
+        flight = await prefetch_file(request, url, cache_file=cache_file)
+        return flight.task if flight is not None else None
+
+    session_prefetcher.on_session_start(
+        request, f"{user_agent}:{client_ip}", target_url, start_download
+    )
+
+
 async def try_file_based_cache(
     request: Request,
     target_url: str,
     download_wait_time: int = 60,
+    cache_file: typing.Optional[str] = None,
+    expected_digest: typing.Optional[str] = None,
 ) -> Response:
+    """
+    通过下载后端（aria2 或进程内下载器）下载并缓存文件
+
+    Args:
+        request: 客户端请求
+        target_url: 上游地址
+        download_wait_time: 等待下载完成的最长时间（秒）
+        cache_file: 缓存文件路径，默认由 target_url 推导；
+            内容寻址的文件（例如 docker blob）可以让多个 URL 共享同一个缓存文件
+        expected_digest: 文件内容的 digest（例如 sha256:<hex>），
+            第一次完整读取时校验，不一致的文件会被隔离并重新下载
+    """
     # 记录请求开始时间
     start_time = time.time()
     package_name = os.path.basename(urlparse(target_url).path)
-    
-    cache_status = lookup_cache(target_url)
-    cache_file, cache_file_dir = get_cache_file_and_folder(target_url)
-    
+
+    if cache_file is None:
+        cache_file, _ = get_cache_file_and_folder(target_url)
+    cache_status = lookup_cache_file(cache_file)
+
+    if COOCCURRENCE_PREFETCH:
+        schedule_session_prefetch(request, target_url)
+
     # 场景 1: 缓存命中
     if cache_status == DownloadingStatus.DOWNLOADED:
         logger.info(f"Cache hit for {target_url}")
-        
+
         # 更新缓存访问时间
         try:
             cache_tracker = get_cache_tracker()
             cache_tracker.update_access_time(cache_file)
         except Exception:
             pass  # 静默失败，不影响主要功能
-        
-        response = make_cached_response(target_url)
-        
+
+        response = make_cached_response(request, cache_file, expected_digest)
+
         # 记录缓存命中指标
         end_time = time.time()
         total_time = end_time - start_time
         file_size = os.path.getsize(cache_file)
-        
+
         # 注意：缓存命中时，total_time 只是服务器读取文件的时间，
         # 不包括网络传输时间，所以不记录 client_receive_speed
         metrics_recorder.record_metric(
@@ -153,7 +468,7 @@ async def try_file_based_cache(
             total_time=total_time,
             status="success",
         )
-        
+
         # 记录到会话
         await record_to_session(
             request=request,
@@ -162,147 +477,151 @@ async def try_file_based_cache(
             cache_hit=True,
             download_time=total_time,
             start_time=start_time,
-            end_time=end_time
+            end_time=end_time,
+            target_url=target_url,
+            cache_file=cache_file,
         )
-        
+
         return response
 
-    # 场景 2: 正在下载中
-    if cache_status == DownloadingStatus.DOWNLOADING:
-        logger.info(f"Download is not finished, return 504 for {target_url}")
-        return Response(
-            content=f"This file is downloading, view it at {EXTERNAL_URL_ARIA2}",
-            status_code=HTTP_504_GATEWAY_TIMEOUT,
+    # 场景 2/3: 正在下载中或缓存未命中，同一文件的并发请求共享一次下载
+    flight, is_owner = download_flights.join(cache_file)
+
+    if is_owner:
+        if cache_status == DownloadingStatus.NOT_FOUND and TEE_ON_MISS:
+            tee_response = await try_tee_on_miss(
+                request, target_url, cache_file, flight, start_time, expected_digest
+            )
+            if tee_response is not None:
+                return tee_response
+
+        if cache_status == DownloadingStatus.NOT_FOUND:
+            try:
+                flight.gid = await submit_download(request, target_url, cache_file)
+            except Exception as e:
+                logger.error(f"Download error, return 500 for {target_url}", exc_info=e)
+                flight.fail(str(e))
+                download_flights.release(flight)
+
+                # 记录下载错误
+                total_time = time.time() - start_time
+                metrics_recorder.record_metric(
+                    url=target_url,
+                    package_name=package_name,
+                    file_size=0,
+                    cache_hit=False,
+                    total_time=total_time,
+                    status="error",
+                    status_message=str(e),
+                )
+
+                return Response(
+                    content=f"Failed to add download: {e}",
+                    status_code=HTTP_500_INTERNAL_SERVER_ERROR,
+                )
+
+        # 每个文件只有一个监视任务
+        flight.task = asyncio.create_task(watch_download(flight, target_url))
+    else:
+        logger.info(
+            f"Join in-flight download for {target_url}, waiters: {flight.waiters + 1}"
         )
+        # 可能是预取或预热提交的下载，现在有客户端在等待
+        if flight.gid:
+            await download_backend.promote(flight.gid)
 
-    # 场景 3: 缓存未命中，需要下载
-    assert cache_status == DownloadingStatus.NOT_FOUND
+    # 等待下载完成（开启渐进式返回时，知道文件总长度即可开始返回）
+    await flight.wait(download_wait_time, streamable_ok=PROGRESSIVE_SERVING)
 
-    logger.info(f"prepare to cache, {target_url=} {cache_file=} {cache_file_dir=}")
+    cache_status = lookup_cache_file(cache_file)
 
-    processed_url = quote(target_url, safe="/:?=&%")
+    # 检查下载是否完成
+    if cache_status == DownloadingStatus.DOWNLOADED:
+        aria2_download_time = flight.download_time
+        end_time = time.time()
+        total_time = end_time - start_time
+        file_size = os.path.getsize(cache_file)
 
-    try:
-        # 提交 aria2 下载任务并获取 GID
-        gid = await add_download(
-            processed_url,
-            save_dir=cache_file_dir,
-            out_file=os.path.basename(cache_file),
-            headers={
-                key: value
-                for key, value in request.headers.items()
-                if key in ["user-agent", "accept", "authorization"]
-            },
+        # 计算平均下载速度
+        aria2_avg_speed = (
+            file_size / aria2_download_time if aria2_download_time > 0 else 0
         )
-        logger.info(f"[Aria2] Download task created, GID: {gid}")
-    except Exception as e:
-        logger.error(f"Download error, return 500 for {target_url}", exc_info=e)
-        
-        # 记录下载错误
-        total_time = time.time() - start_time
+        client_receive_speed = file_size / total_time if total_time > 0 else 0
+
+        # 更新缓存访问时间（首次下载完成）
+        try:
+            cache_tracker = get_cache_tracker()
+            cache_tracker.update_access_time(cache_file)
+        except Exception:
+            pass  # 静默失败，不影响主要功能
+
+        # 记录下载成功指标
         metrics_recorder.record_metric(
             url=target_url,
             package_name=package_name,
-            file_size=0,
+            file_size=file_size,
             cache_hit=False,
             total_time=total_time,
+            status="success",
+            aria2_download_speed=aria2_avg_speed,
+            aria2_download_time=aria2_download_time,
+            client_receive_speed=client_receive_speed,
+        )
+
+        # 记录到会话
+        await record_to_session(
+            request=request,
+            package_name=package_name,
+            file_size=file_size,
+            cache_hit=False,
+            download_time=total_time,
+            start_time=start_time,
+            end_time=end_time,
+            target_url=target_url,
+            cache_file=cache_file,
+        )
+
+        logger.info(f"Cache ready for {target_url}")
+        return make_cached_response(request, cache_file, expected_digest)
+
+    # 下载失败
+    if flight.error is not None:
+        logger.warning(f"Download failed for {target_url}: {flight.error}")
+
+        metrics_recorder.record_metric(
+            url=target_url,
+            package_name=package_name,
+            file_size=0,
+            cache_hit=False,
+            total_time=time.time() - start_time,
             status="error",
-            status_message=str(e),
+            status_message=flight.error,
         )
-        
+
         return Response(
-            content=f"Failed to add download: {e}",
-            status_code=HTTP_500_INTERNAL_SERVER_ERROR,
+            content=f"Failed to download: {flight.error}",
+            status_code=HTTP_502_BAD_GATEWAY,
         )
 
-    # 等待下载完成，并监控下载速度
-    aria2_download_start = time.time()
-    last_completed_length = 0
-    total_speed_samples = []
-    
-    for i in range(download_wait_time):
-        await sleep(1)
-        cache_status = lookup_cache(target_url)
-        
-        # 检查下载是否完成
-        if cache_status == DownloadingStatus.DOWNLOADED:
-            aria2_download_time = time.time() - aria2_download_start
-            end_time = time.time()
-            total_time = end_time - start_time
-            file_size = os.path.getsize(cache_file)
-            
-            # 计算平均下载速度
-            aria2_avg_speed = file_size / aria2_download_time if aria2_download_time > 0 else 0
-            client_receive_speed = file_size / total_time if total_time > 0 else 0
-            
-            logger.info(f"[METRICS] Aria2 download completed: {package_name}")
-            
-            # 更新缓存访问时间（首次下载完成）
-            try:
-                cache_tracker = get_cache_tracker()
-                cache_tracker.update_access_time(cache_file)
-            except Exception:
-                pass  # 静默失败，不影响主要功能
-            
-            # 记录下载成功指标
-            metrics_recorder.record_metric(
-                url=target_url,
-                package_name=package_name,
-                file_size=file_size,
-                cache_hit=False,
-                total_time=total_time,
-                status="success",
-                aria2_download_speed=aria2_avg_speed,
-                aria2_download_time=aria2_download_time,
-                client_receive_speed=client_receive_speed,
-            )
-            
-            # 记录到会话
-            await record_to_session(
-                request=request,
-                package_name=package_name,
-                file_size=file_size,
-                cache_hit=False,
-                download_time=total_time,
-                start_time=start_time,
-                end_time=end_time
-            )
-            
-            logger.info(f"Cache ready for {target_url}")
-            return make_cached_response(target_url)
-        
-        # 定期获取下载状态（每 5 秒一次）
-        if i % 5 == 0:
-            try:
-                status_info = await get_status(gid)
-                download_speed = int(status_info.get("downloadSpeed", 0))
-                completed_length = int(status_info.get("completedLength", 0))
-                total_length = int(status_info.get("totalLength", 0))
-                
-                if download_speed > 0:
-                    total_speed_samples.append(download_speed)
-                
-                logger.debug(
-                    f"[Aria2] GID: {gid} | Speed: {download_speed / (1024*1024):.2f}MB/s | "
-                    f"Progress: {completed_length}/{total_length}"
-                )
-            except Exception as e:
-                logger.warning(f"Failed to get aria2 status for GID {gid}: {e}")
+    # 已经知道文件总长度，开始边下载边返回
+    if cache_status == DownloadingStatus.DOWNLOADING:
+        progressive_response = make_downloading_response(
+            request, target_url, cache_file, start_time, expected_digest
+        )
+        if progressive_response is not None:
+            logger.info(f"Serving {target_url} progressively, GID: {flight.gid}")
+            return progressive_response
 
     # 场景 4: 超时
-    assert cache_status != DownloadingStatus.NOT_FOUND
-    
     total_time = time.time() - start_time
-    
-    # 尝试获取最终状态
+
     try:
-        status_info = await get_status(gid)
-        file_size = int(status_info.get("completedLength", 0))
-    except Exception:
+        file_size = os.path.getsize(cache_file)
+    except OSError:
         file_size = 0
-    
+
     logger.info(f"Download timeout after {download_wait_time}s for {target_url}")
-    
+
     # 记录超时指标
     metrics_recorder.record_metric(
         url=target_url,
@@ -313,7 +632,7 @@ async def try_file_based_cache(
         status="timeout",
         status_message=f"Download not finished after {download_wait_time}s",
     )
-    
+
     return Response(
         content=f"This file is downloading, view it at {EXTERNAL_URL_ARIA2}",
         status_code=HTTP_504_GATEWAY_TIMEOUT,
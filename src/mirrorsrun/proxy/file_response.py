@@ -0,0 +1,242 @@
+import email.utils
+import logging
+import os
+import re
+import typing
+from datetime import timezone
+
+import anyio
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from mirrorsrun.proxy.integrity import StreamVerifier
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 256 * 1024
+
+# ASGI 扩展：服务器支持时由服务器直接 sendfile，不经过 Python 内存
+# https://asgi.readthedocs.io/en/latest/extensions.html#zero-copy-send
+ZERO_COPY_SEND_EXTENSION = "http.response.zerocopysend"
+
+_range_regex = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+
+def make_etag(stat_result: os.stat_result) -> str:
+    # 与 nginx 相同的弱校验方式：mtime + size，无需读取文件内容
+    return f'"{int(stat_result.st_mtime):x}-{stat_result.st_size:x}"'
+
+
+def make_last_modified(stat_result: os.stat_result) -> str:
+    return email.utils.formatdate(stat_result.st_mtime, usegmt=True)
+
+
+def parse_range(
+    range_header: str, file_size: int
+) -> typing.Optional[typing.Tuple[int, int]]:
+    """
+    解析单段 Range 请求头
+
+    Returns:
+        (start, end) 闭区间；多段或无法识别的 Range 返回 None（按 RFC 9110 忽略 Range）
+
+    Raises:
+        ValueError: Range 无法满足（应返回 416）
+    """
+    match = _range_regex.match(range_header.strip())
+    if not match:
+        return None
+
+    start_str, end_str = match.groups()
+    if not start_str and not end_str:
+        return None
+
+    if not start_str:
+        # bytes=-N：最后 N 个字节
+        suffix_length = int(end_str)
+        if suffix_length == 0:
+            raise ValueError("empty suffix range")
+        start = max(file_size - suffix_length, 0)
+        end = file_size - 1
+    else:
+        start = int(start_str)
+        end = int(end_str) if end_str else file_size - 1
+        end = min(end, file_size - 1)
+
+    if start >= file_size or start > end:
+        raise ValueError(f"range not satisfiable: {range_header}")
+
+    return start, end
+
+
+def is_not_modified(request_headers: Headers, etag: str, mtime: float) -> bool:
+    if_none_match = request_headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+
+    if_modified_since = request_headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            since = email.utils.parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+        if since.tzinfo is None:
+            since = since.replace(tzinfo=timezone.utc)
+        return int(mtime) <= since.timestamp()
+
+    return False
+
+
+def if_range_matches(request_headers: Headers, etag: str, last_modified: str) -> bool:
+    if_range = request_headers.get("if-range")
+    if if_range is None:
+        return True
+    return if_range in (etag, last_modified)
+
+
+class RangeFileResponse(Response):
+    """
+    以流的方式返回磁盘文件的一个区间
+
+    不会把整个文件读入内存：服务器支持 zerocopysend 扩展时直接交给 sendfile，
+    否则按 CHUNK_SIZE 分块读取。
+
+    指定 verifier 时（仅用于返回整个文件）边读边计算哈希，最后一块在校验通过后才发送，
+    校验失败时中断连接，客户端不会收到完整但错误的内容。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        start: int,
+        end: int,
+        status_code: int = 200,
+        headers: typing.Optional[typing.Mapping[str, str]] = None,
+        media_type: str = "application/octet-stream",
+        background: typing.Optional[BackgroundTask] = None,
+        verifier: typing.Optional[StreamVerifier] = None,
+    ):
+        self.path = path
+        self.start = start
+        self.end = end
+        self.status_code = status_code
+        self.media_type = media_type
+        self.background = background
+        self.verifier = verifier
+        self.init_headers(headers)
+        self.headers["content-length"] = str(max(end - start + 1, 0))
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+
+        count = self.end - self.start + 1
+        send_body = scope.get("method", "GET") != "HEAD" and count > 0
+
+        if not send_body:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        elif self.verifier is None and ZERO_COPY_SEND_EXTENSION in scope.get(
+            "extensions", {}
+        ):
+            with open(self.path, "rb") as file:
+                await send(
+                    {
+                        "type": ZERO_COPY_SEND_EXTENSION,
+                        "file": file,
+                        "offset": self.start,
+                        "count": count,
+                        "more_body": False,
+                    }
+                )
+        else:
+            async with await anyio.open_file(self.path, mode="rb") as file:
+                await file.seek(self.start)
+                remaining = count
+                while remaining > 0:
+                    chunk = await file.read(min(CHUNK_SIZE, remaining))
+                    if not chunk:
+                        # 文件被截断（例如正在被清理），提前结束
+                        logger.warning(f"file {self.path} ended before {self.end}")
+                        break
+                    remaining -= len(chunk)
+                    if self.verifier is not None:
+                        self.verifier.update(chunk)
+                        if remaining == 0:
+                            self.verifier.finish()
+                    await send(
+                        {
+                            "type": "http.response.body",
+                            "body": chunk,
+                            "more_body": remaining > 0,
+                        }
+                    )
+                if remaining > 0:
+                    await send(
+                        {"type": "http.response.body", "body": b"", "more_body": False}
+                    )
+
+        if self.background is not None:
+            await self.background()
+
+
+def make_file_response(
+    request_headers: Headers,
+    path: str,
+    media_type: str = "application/octet-stream",
+    extra_headers: typing.Optional[typing.Mapping[str, str]] = None,
+    verifier: typing.Optional[StreamVerifier] = None,
+) -> Response:
+    """
+    根据请求头构造文件响应：200 / 206 / 304 / 416
+
+    支持 Range、If-Range、If-None-Match、If-Modified-Since。
+    verifier 只作用于返回整个文件的 200 响应，部分内容无法校验。
+    """
+    stat_result = os.stat(path)
+    file_size = stat_result.st_size
+    etag = make_etag(stat_result)
+    last_modified = make_last_modified(stat_result)
+
+    headers = {
+        "accept-ranges": "bytes",
+        "etag": etag,
+        "last-modified": last_modified,
+    }
+    if extra_headers:
+        headers.update(extra_headers)
+
+    if is_not_modified(request_headers, etag, stat_result.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    range_header = request_headers.get("range")
+    if range_header and if_range_matches(request_headers, etag, last_modified):
+        try:
+            byte_range = parse_range(range_header, file_size)
+        except ValueError:
+            headers["content-range"] = f"bytes */{file_size}"
+            return Response(status_code=416, headers=headers)
+
+        if byte_range is not None:
+            start, end = byte_range
+            headers["content-range"] = f"bytes {start}-{end}/{file_size}"
+            return RangeFileResponse(
+                path, start, end, 206, headers=headers, media_type=media_type
+            )
+
+    return RangeFileResponse(
+        path,
+        0,
+        file_size - 1,
+        200,
+        headers=headers,
+        media_type=media_type,
+        verifier=verifier,
+    )
@@ -0,0 +1,248 @@
+"""
+缓存文件的内容校验
+
+在文件第一次被完整读取（边下载边返回，或下载完成后的第一次完整响应）时顺带计算哈希，
+不需要额外把文件再读一遍。校验通过的文件记录下来，之后命中缓存时跳过校验；
+校验失败的文件移入隔离目录，下一次请求会重新下载。
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+import typing
+from pathlib import Path
+from threading import Lock
+
+import anyio
+
+from mirrorsrun.cache_tracker import get_cache_tracker
+from mirrorsrun.config import (
+    QUARANTINE_DIR,
+    VERIFIED_FILES_FILE,
+    VERIFIED_FILES_FLUSH_INTERVAL,
+)
+
+logger = logging.getLogger(__name__)
+
+HASH_FACTORIES: typing.Dict[str, typing.Callable[[], typing.Any]] = {
+    "sha256": hashlib.sha256,
+    "sha512": hashlib.sha512,
+    # PyPI 文件路径中的哈希：/packages/<h[:2]>/<h[2:4]>/<h[4:]>/<filename>
+    "blake2b_256": lambda: hashlib.blake2b(digest_size=32),
+}
+
+
+class DigestMismatch(Exception):
+    """文件内容与期望的 digest 不一致"""
+
+
+def parse_expected_digest(digest: str) -> typing.Optional[typing.Tuple[str, str]]:
+    """
+    Returns:
+        (algorithm, hex)，算法不受支持时返回 None
+    """
+    algorithm, _, hex_digest = digest.partition(":")
+    if algorithm not in HASH_FACTORIES or not hex_digest:
+        return None
+    return algorithm, hex_digest.lower()
+
+
+class VerifiedFileStore:
+    """
+    记录已经通过校验的缓存文件
+
+    记录只在内存中更新，由 flush() 定期在线程中写回磁盘，
+    写入的开销不会随缓存文件数增长落在请求路径上。
+    """
+
+    def __init__(
+        self,
+        store_file: str = VERIFIED_FILES_FILE,
+        flush_interval: int = VERIFIED_FILES_FLUSH_INTERVAL,
+    ):
+        self.store_file = store_file
+        self.flush_interval = flush_interval
+        self._data: typing.Dict[str, typing.Dict[str, typing.Any]] = {}
+        # 上次写回之后是否有变化
+        self._dirty = False
+        self._lock = Lock()
+        self._task: typing.Optional[asyncio.Task] = None
+        self._load()
+
+    def _load(self):
+        try:
+            with open(self.store_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            if isinstance(data, dict):
+                self._data = data
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Failed to load verified files: {e}")
+
+    def _flush_sync(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            content = json.dumps(self._data, ensure_ascii=False)
+            self._dirty = False
+
+        try:
+            Path(self.store_file).parent.mkdir(parents=True, exist_ok=True)
+            # 原子写入：先写入临时文件，再重命名
+            temp_file = f"{self.store_file}.{os.getpid()}.tmp"
+            with open(temp_file, "w", encoding="utf-8") as f:
+                f.write(content)
+            os.replace(temp_file, self.store_file)
+        except Exception as e:
+            logger.error(f"Failed to save verified files: {e}")
+            with self._lock:
+                self._dirty = True
+
+    async def flush(self):
+        """把内存中的记录写回磁盘"""
+        await anyio.to_thread.run_sync(self._flush_sync)
+
+    async def _flush_loop(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+
+    @staticmethod
+    def _identity(cache_file: str) -> typing.Optional[typing.Dict[str, int]]:
+        # aria2 开启了 remote-time，下载完成后会修改 mtime，因此用 inode + 大小识别文件
+        try:
+            stat_result = os.stat(cache_file)
+        except OSError:
+            return None
+        return {"inode": stat_result.st_ino, "size": stat_result.st_size}
+
+    def is_verified(self, cache_file: str, digest: str) -> bool:
+        with self._lock:
+            record = self._data.get(cache_file)
+        if record is None or record.get("digest") != digest:
+            return False
+        identity = self._identity(cache_file)
+        return identity is not None and all(
+            record.get(k) == v for k, v in identity.items()
+        )
+
+    def mark_verified(self, cache_file: str, digest: str):
+        identity = self._identity(cache_file)
+        if identity is None:
+            return
+        with self._lock:
+            self._data[cache_file] = {"digest": digest, **identity}
+            self._dirty = True
+
+    def forget(self, cache_file: str):
+        with self._lock:
+            if self._data.pop(cache_file, None) is not None:
+                self._dirty = True
+
+
+# 全局单例实例
+verified_file_store: typing.Optional[VerifiedFileStore] = None
+
+
+def get_verified_file_store() -> VerifiedFileStore:
+    global verified_file_store
+    if verified_file_store is None:
+        verified_file_store = VerifiedFileStore()
+    return verified_file_store
+
+
+def quarantine_file(cache_file: str) -> typing.Optional[str]:
+    """
+    把校验失败的文件移入隔离目录
+
+    Returns:
+        隔离后的路径，文件已不存在时返回 None
+    """
+    target = Path(QUARANTINE_DIR) / f"{os.path.basename(cache_file)}.{int(time.time())}"
+    try:
+        target.parent.mkdir(parents=True, exist_ok=True)
+        os.replace(cache_file, target)
+    except FileNotFoundError:
+        return None
+    except OSError as e:
+        logger.error(f"Failed to quarantine {cache_file}, removing it: {e}")
+        try:
+            os.remove(cache_file)
+        except OSError:
+            pass
+        return None
+    finally:
+        get_verified_file_store().forget(cache_file)
+
+    # 隔离的文件和其他缓存文件一样由缓存清理按访问时间删除；
+    # 缓存追踪器只在启动时扫描缓存目录，需要在这里登记
+    try:
+        cache_tracker = get_cache_tracker()
+        cache_tracker.remove_tracking(cache_file)
+        cache_tracker.update_access_time(str(target))
+    except Exception as e:
+        logger.warning(f"Failed to track quarantined file {target}: {e}")
+
+    return str(target)
+
+
+class StreamVerifier:
+    """对按顺序读取的整个文件增量计算哈希"""
+
+    def __init__(self, cache_file: str, digest: str):
+        parsed = parse_expected_digest(digest)
+        assert parsed is not None, f"unsupported digest {digest}"
+        self.cache_file = cache_file
+        self.digest = digest
+        self.algorithm, self.expected = parsed
+        self._hash = HASH_FACTORIES[self.algorithm]()
+        self.length = 0
+
+    def update(self, chunk: bytes):
+        self._hash.update(chunk)
+        self.length += len(chunk)
+
+    def finish(self):
+        """
+        比对哈希，通过时记录下来，失败时隔离文件
+
+        Raises:
+            DigestMismatch: 内容与期望的 digest 不一致
+        """
+        actual = self._hash.hexdigest()
+        if actual == self.expected:
+            logger.info(f"Verified {self.cache_file} ({self.algorithm})")
+            get_verified_file_store().mark_verified(self.cache_file, self.digest)
+            return
+
+        quarantined = quarantine_file(self.cache_file)
+        logger.error(
+            f"Digest mismatch for {self.cache_file}: expected {self.expected}, "
+            f"got {actual} after {self.length} bytes, quarantined to {quarantined}"
+        )
+        raise DigestMismatch(f"{self.cache_file}: expected {self.digest}")
+
+
+def get_verifier(
+    cache_file: str, digest: typing.Optional[str]
+) -> typing.Optional[StreamVerifier]:
+    """文件需要校验时返回 StreamVerifier；没有期望值、算法不支持或已校验过时返回 None"""
+    if not digest or parse_expected_digest(digest) is None:
+        return None
+    if get_verified_file_store().is_verified(cache_file, digest):
+        return None
+    return StreamVerifier(cache_file, digest)
@@ -0,0 +1,568 @@
+"""
+元数据缓存：索引页、packument 等小而频繁变化的响应
+
+- 在 TTL 内直接返回本地副本
+- 过期后在 stale 窗口内先返回旧副本，同时在后台用 If-None-Match / If-Modified-Since
+  向上游重新验证
+- 对下游的条件请求返回 304
+
+条目保存在 CACHE_DIR/_metadata/<name>/ 下，重启和多个 worker 之间共享，
+可以限制磁盘上的条目数；内存中保留一个按字节数限制的 LRU。
+"""
+
+import asyncio
+import email.utils
+import gzip
+import hashlib
+import json
+import logging
+import os
+import time
+import typing
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from datetime import timezone
+from pathlib import Path
+from typing import Dict, Optional
+
+import anyio
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.status import HTTP_502_BAD_GATEWAY
+
+from mirrorsrun.config import METADATA_CACHE_DIR, METADATA_MEMORY_LIMIT
+from mirrorsrun.proxy.direct import get_upstream_client
+from mirrorsrun.proxy.file_response import is_not_modified
+
+try:
+    import zstandard  # type: ignore
+except ImportError:  # 可选依赖，未安装时只使用 gzip
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+BodyTransform = typing.Callable[[bytes], bytes]
+
+# 默认转发给上游的请求头
+FORWARD_HEADERS = ("accept", "user-agent")
+
+# 默认保存并返回给下游的上游响应头
+KEEP_HEADERS = ("content-type",)
+
+
+@dataclass
+class MetadataEntry:
+    """一条缓存的上游响应"""
+
+    key: str
+    url: str
+    status_code: int
+    fetched_at: float
+    etag: str
+    headers: Dict[str, str] = field(default_factory=dict)
+    upstream_etag: Optional[str] = None
+    upstream_last_modified: Optional[str] = None
+    # 内容最后一次变化的时间，旧版本写入的条目没有该字段
+    modified_at: Optional[float] = None
+    # body 的存储编码（gzip / zstd），None 表示未压缩
+    encoding: Optional[str] = None
+    body: bytes = b""
+
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+    def last_modified(self) -> float:
+        return self.modified_at if self.modified_at is not None else self.fetched_at
+
+
+def parse_http_date(value: Optional[str]) -> Optional[float]:
+    if not value:
+        return None
+    try:
+        parsed = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if parsed.tzinfo is None:
+        parsed = parsed.replace(tzinfo=timezone.utc)
+    return parsed.timestamp()
+
+
+def make_body_etag(body: bytes) -> str:
+    return '"' + hashlib.sha256(body).hexdigest()[:32] + '"'
+
+
+def make_encoded_etag(etag: str, encoding: str) -> str:
+    # 不同编码是不同的表示，强 ETag 需要区分
+    return f'{etag[:-1]}-{encoding}"'
+
+
+def compress(body: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        assert zstandard is not None
+        return zstandard.ZstdCompressor(level=10).compress(body)
+    assert encoding == "gzip"
+    return gzip.compress(body, compresslevel=6)
+
+
+def decompress(body: bytes, encoding: str) -> bytes:
+    if encoding == "zstd":
+        assert zstandard is not None
+        return zstandard.ZstdDecompressor().decompress(body)
+    assert encoding == "gzip"
+    return gzip.decompress(body)
+
+
+def encode_body(
+    body: bytes, transform: Optional[BodyTransform], compression: Optional[str]
+) -> typing.Tuple[bytes, str]:
+    """
+    Returns:
+        (存储的内容, 变换后未压缩内容的 ETag)
+    """
+    if transform is not None:
+        body = transform(body)
+    etag = make_body_etag(body)
+    if compression:
+        body = compress(body, compression)
+    return body, etag
+
+
+def accepts_encoding(request: Request, encoding: str) -> bool:
+    for item in request.headers.get("accept-encoding", "").split(","):
+        name, _, params = item.strip().partition(";")
+        if name.strip().lower() != encoding:
+            continue
+        params = params.replace(" ", "")
+        return params not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
+
+
+class MetadataCache:
+    """按 key 缓存上游响应，key 由调用方决定（需要包含所有会影响响应内容的因素）"""
+
+    def __init__(
+        self,
+        name: str,
+        ttl: Optional[int],
+        stale_ttl: int = 0,
+        cache_dir: str = METADATA_CACHE_DIR,
+        memory_limit: int = METADATA_MEMORY_LIMIT,
+        compression: Optional[str] = None,
+        head_validator: Optional[str] = None,
+        max_entries: Optional[int] = None,
+    ):
+        """
+        Args:
+            name: 缓存名称，也是磁盘子目录名
+            ttl: 新鲜期（秒），None 表示内容不可变、永不过期
+            stale_ttl: 过期后仍可先返回旧内容并后台刷新的时长（秒）
+            cache_dir: 磁盘缓存根目录
+            memory_limit: 内存 LRU 的字节数上限
+            compression: 压缩存储（gzip / zstd），客户端支持时直接返回压缩内容
+            head_validator: 设置时用 HEAD 重新验证，比较该响应头（以及 ETag）是否变化，
+                适用于 GET 计入限额而 HEAD 不计入的上游（例如 Docker Hub）
+            max_entries: 磁盘上保留的条目数上限，超出时删除最久未使用的条目，
+                None 表示不限制
+        """
+        if compression == "zstd" and zstandard is None:
+            logger.warning(f"[{name}] zstandard is not installed, fall back to gzip")
+            compression = "gzip"
+        self.name = name
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.base_dir = Path(cache_dir) / name
+        self.memory_limit = memory_limit
+        self.compression = compression
+        self.head_validator = head_validator
+        self.max_entries = max_entries
+        self._memory: "OrderedDict[str, MetadataEntry]" = OrderedDict()
+        self._memory_size = 0
+        # 写入次数，每写入一定数量的条目检查一次磁盘上的条目数
+        self._writes = 0
+        self._inflight: Dict[str, asyncio.Task] = {}
+        # 持有后台刷新任务，避免任务在完成前被回收
+        self._refresh_tasks: typing.Set[asyncio.Task] = set()
+
+    def _path(self, key: str) -> Path:
+        digest = hashlib.sha256(key.encode()).hexdigest()
+        return self.base_dir / digest[:2] / digest
+
+    def is_fresh(self, entry: MetadataEntry) -> bool:
+        return self.ttl is None or entry.age() < self.ttl
+
+    def is_usable_stale(self, entry: MetadataEntry) -> bool:
+        assert self.ttl is not None
+        return entry.age() < self.ttl + self.stale_ttl
+
+    def _remember(self, entry: MetadataEntry):
+        old = self._memory.pop(entry.key, None)
+        if old is not None:
+            self._memory_size -= len(old.body)
+
+        if len(entry.body) > self.memory_limit:
+            return
+
+        self._memory[entry.key] = entry
+        self._memory_size += len(entry.body)
+        while self._memory_size > self.memory_limit:
+            _, evicted = self._memory.popitem(last=False)
+            self._memory_size -= len(evicted.body)
+
+    async def get(self, key: str) -> Optional[MetadataEntry]:
+        entry = self._memory.get(key)
+        if entry is not None:
+            self._memory.move_to_end(key)
+            return entry
+
+        # 条目可能有几 MB（例如 npm packument），磁盘读写在线程中进行，不阻塞事件循环
+        entry = await anyio.to_thread.run_sync(self._read, key)
+        if entry is None:
+            return None
+
+        self._remember(entry)
+        return entry
+
+    def _read(self, key: str) -> Optional[MetadataEntry]:
+        # 单个文件：第一行是 JSON 元数据，之后是响应体，保证两者原子地一起更新
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                meta_line = f.readline()
+                body = f.read()
+            entry = MetadataEntry(**json.loads(meta_line), body=body)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning(f"Invalid metadata cache entry {path}: {e}")
+            return None
+
+        if entry.key != key:
+            return None
+        if self.max_entries is not None:
+            # 修改时间即最后使用时间，清理时先删除最久未使用的条目
+            try:
+                os.utime(path)
+            except OSError:
+                pass
+        return entry
+
+    async def put(self, entry: MetadataEntry):
+        self._remember(entry)
+        await anyio.to_thread.run_sync(self._write, entry)
+
+        if self.max_entries is not None:
+            self._writes += 1
+            if self._writes % max(self.max_entries // 10, 1) == 0:
+                await anyio.to_thread.run_sync(self._prune)
+
+    def _prune(self):
+        """磁盘上的条目超过 max_entries 时，删除最久未使用的条目直到只剩九成"""
+        assert self.max_entries is not None
+        files = []
+        for path in self.base_dir.glob("*/*"):
+            if path.suffix == ".tmp":
+                continue
+            try:
+                files.append((path.stat().st_mtime, path))
+            except OSError:
+                continue
+        if len(files) <= self.max_entries:
+            return
+
+        files.sort()
+        to_remove = files[: len(files) - self.max_entries * 9 // 10]
+        for _, path in to_remove:
+            try:
+                path.unlink()
+            except OSError:
+                pass
+        logger.info(
+            f"[{self.name}] removed {len(to_remove)} least recently used entries"
+        )
+
+    def _write(self, entry: MetadataEntry):
+        path = self._path(entry.key)
+        meta = asdict(entry)
+        del meta["body"]
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            # 原子写入：先写入临时文件，再重命名
+            tmp_path = path.with_suffix(f".{os.getpid()}.tmp")
+            with open(tmp_path, "wb") as f:
+                f.write(json.dumps(meta, ensure_ascii=False).encode("utf-8") + b"\n")
+                f.write(entry.body)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.error(f"Failed to save metadata cache entry {path}: {e}")
+
+    async def fetch(
+        self,
+        key: str,
+        url: str,
+        request_headers: Dict[str, str],
+        transform: Optional[BodyTransform] = None,
+        keep_headers: typing.Sequence[str] = KEEP_HEADERS,
+    ) -> MetadataEntry:
+        """
+        从上游获取（或重新验证）一条缓存，同一个 key 的并发调用只请求一次上游
+
+        非 200/304 的响应不会写入缓存，但仍然返回给调用方。
+        """
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(
+                self._fetch(key, url, request_headers, transform, keep_headers)
+            )
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    async def _fetch(
+        self,
+        key: str,
+        url: str,
+        request_headers: Dict[str, str],
+        transform: Optional[BodyTransform],
+        keep_headers: typing.Sequence[str],
+    ) -> MetadataEntry:
+        cached = await self.get(key)
+
+        if cached is not None and self.head_validator:
+            if await self._revalidate_with_head(cached, url, request_headers):
+                return cached
+
+        headers = dict(request_headers)
+        if cached is not None:
+            if cached.upstream_etag:
+                headers["if-none-match"] = cached.upstream_etag
+            if cached.upstream_last_modified:
+                headers["if-modified-since"] = cached.upstream_last_modified
+
+        response = await get_upstream_client().get(
+            url, headers=headers, follow_redirects=True, timeout=30
+        )
+
+        if response.status_code == 304 and cached is not None:
+            logger.debug(f"[{self.name}] revalidated {url}")
+            cached.fetched_at = time.time()
+            await self.put(cached)
+            return cached
+
+        body = response.content
+        encoding = None
+        if response.status_code == 200:
+            # 替换、哈希和压缩几 MB 的内容较慢，在线程中进行
+            body, etag = await anyio.to_thread.run_sync(
+                encode_body, body, transform, self.compression
+            )
+            encoding = self.compression
+        else:
+            etag = make_body_etag(body)
+
+        upstream_last_modified = response.headers.get("last-modified")
+        entry = MetadataEntry(
+            key=key,
+            url=url,
+            status_code=response.status_code,
+            fetched_at=time.time(),
+            etag=etag,
+            headers={
+                k: response.headers[k] for k in keep_headers if k in response.headers
+            },
+            upstream_etag=response.headers.get("etag"),
+            upstream_last_modified=upstream_last_modified,
+            encoding=encoding,
+            body=body,
+        )
+        entry.modified_at = parse_http_date(upstream_last_modified)
+        if entry.modified_at is None and cached is not None and cached.etag == etag:
+            # 上游没有给出时间且内容没有变化，沿用之前的时间
+            entry.modified_at = cached.last_modified()
+
+        if response.status_code == 200:
+            await self.put(entry)
+        return entry
+
+    async def _revalidate_with_head(
+        self, cached: MetadataEntry, url: str, request_headers: Dict[str, str]
+    ) -> bool:
+        """
+        Returns:
+            上游内容没有变化时返回 True（已刷新缓存时间）
+        """
+        assert self.head_validator
+        try:
+            response = await get_upstream_client().head(
+                url, headers=request_headers, follow_redirects=True, timeout=30
+            )
+        except Exception as e:
+            logger.warning(f"[{self.name}] HEAD {url} failed: {e}")
+            return False
+        if response.status_code != 200:
+            return False
+
+        validator = response.headers.get(self.head_validator)
+        etag = response.headers.get("etag")
+        unchanged = (
+            validator and validator == cached.headers.get(self.head_validator)
+        ) or (etag and etag == cached.upstream_etag)
+        if not unchanged:
+            return False
+
+        logger.debug(f"[{self.name}] revalidated {url} with HEAD")
+        cached.fetched_at = time.time()
+        await self.put(cached)
+        return True
+
+    def refresh_in_background(
+        self,
+        key: str,
+        url: str,
+        request_headers: Dict[str, str],
+        transform: Optional[BodyTransform] = None,
+        keep_headers: typing.Sequence[str] = KEEP_HEADERS,
+    ):
+        if key in self._inflight:
+            return
+
+        def on_done(task: asyncio.Task):
+            self._refresh_tasks.discard(task)
+            if not task.cancelled() and task.exception() is not None:
+                logger.warning(
+                    f"[{self.name}] background revalidation of {url} failed: "
+                    f"{task.exception()}"
+                )
+
+        task = asyncio.create_task(
+            self.fetch(key, url, request_headers, transform, keep_headers)
+        )
+        self._refresh_tasks.add(task)
+        task.add_done_callback(on_done)
+
+
+def get_forward_headers(
+    request: Request, forward_headers: typing.Sequence[str] = FORWARD_HEADERS
+) -> Dict[str, str]:
+    """取出需要转发的请求头，重复的请求头（例如每个媒体类型一个 Accept）合并为一个"""
+    return {
+        k: ", ".join(request.headers.getlist(k))
+        for k in forward_headers
+        if k in request.headers
+    }
+
+
+async def make_metadata_response(
+    request: Request, entry: MetadataEntry, cache_status: str
+) -> Response:
+    headers = dict(entry.headers)
+    headers["x-cache"] = cache_status
+    body = entry.body
+
+    if entry.encoding:
+        headers["vary"] = "Accept-Encoding"
+        if accepts_encoding(request, entry.encoding):
+            # 直接返回压缩存储的内容，无需解压再压缩
+            headers["content-encoding"] = entry.encoding
+            headers["etag"] = make_encoded_etag(entry.etag, entry.encoding)
+        else:
+            body = await anyio.to_thread.run_sync(
+                decompress, entry.body, entry.encoding
+            )
+            headers["etag"] = entry.etag
+    elif entry.status_code == 200:
+        headers["etag"] = entry.etag
+
+    if entry.status_code == 200:
+        modified_at = entry.last_modified()
+        headers.setdefault(
+            "last-modified", email.utils.formatdate(modified_at, usegmt=True)
+        )
+        if is_not_modified(request.headers, headers["etag"], modified_at):
+            return Response(status_code=304, headers=headers)
+
+    return Response(content=body, status_code=entry.status_code, headers=headers)
+
+
+async def head_upstream(
+    url: str, request_headers: Dict[str, str], keep_headers: typing.Sequence[str]
+) -> Response:
+    """向上游发送 HEAD，返回不写入缓存"""
+    try:
+        response = await get_upstream_client().head(
+            url, headers=request_headers, follow_redirects=True, timeout=30
+        )
+    except Exception as e:
+        logger.warning(f"HEAD {url} failed: {e}")
+        return Response(
+            content=f"Failed to fetch {url}: {e}",
+            status_code=HTTP_502_BAD_GATEWAY,
+        )
+
+    headers = {k: response.headers[k] for k in keep_headers if k in response.headers}
+    if "content-length" in response.headers:
+        headers["content-length"] = response.headers["content-length"]
+    headers["x-cache"] = "MISS"
+    return Response(status_code=response.status_code, headers=headers)
+
+
+async def serve_cached_metadata(
+    request: Request,
+    cache: MetadataCache,
+    key: str,
+    target_url: str,
+    transform: Optional[BodyTransform] = None,
+    forward_headers: typing.Sequence[str] = FORWARD_HEADERS,
+    keep_headers: typing.Sequence[str] = KEEP_HEADERS,
+    upstream_headers: Optional[Dict[str, str]] = None,
+) -> Response:
+    """
+    从元数据缓存返回响应，必要时向上游获取或重新验证
+
+    Args:
+        request: 客户端请求
+        cache: 使用的缓存
+        key: 缓存键
+        target_url: 上游地址
+        transform: 写入缓存前对响应体做的变换（例如替换下载地址）
+        forward_headers: 转发给上游的请求头
+        keep_headers: 保存并返回给下游的上游响应头
+        upstream_headers: 额外发送给上游的请求头，覆盖转发的同名请求头
+    """
+    request_headers = get_forward_headers(request, forward_headers)
+    request_headers.update(upstream_headers or {})
+
+    entry = await cache.get(key)
+
+    # 新鲜：直接返回
+    if entry is not None and cache.is_fresh(entry):
+        return await make_metadata_response(request, entry, "HIT")
+
+    # 过期但在 stale 窗口内：先返回旧内容，后台重新验证
+    if entry is not None and cache.is_usable_stale(entry):
+        cache.refresh_in_background(
+            key, target_url, request_headers, transform, keep_headers
+        )
+        return await make_metadata_response(request, entry, "STALE")
+
+    if request.method == "HEAD" and entry is None and transform is None:
+        # 未命中的 HEAD 直接以 HEAD 转发，不为此下载响应体（Docker Hub 的 GET 计入限额）
+        return await head_upstream(target_url, request_headers, keep_headers)
+
+    try:
+        fetched = await cache.fetch(
+            key, target_url, request_headers, transform, keep_headers
+        )
+    except Exception as e:
+        logger.warning(f"[{cache.name}] failed to fetch {target_url}: {e}")
+        if entry is not None:
+            # 上游不可用时继续使用旧内容
+            return await make_metadata_response(request, entry, "STALE")
+        return Response(
+            content=f"Failed to fetch {target_url}: {e}",
+            status_code=HTTP_502_BAD_GATEWAY,
+        )
+
+    if fetched.status_code != 200 and entry is not None and fetched.status_code >= 500:
+        return await make_metadata_response(request, entry, "STALE")
+
+    return await make_metadata_response(request, fetched, "MISS")
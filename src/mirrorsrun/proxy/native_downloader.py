@@ -0,0 +1,435 @@
+"""
+进程内的分段下载器，DOWNLOAD_BACKEND=native 时代替 aria2
+
+通过共享的上游连接池并发请求多个 Range 分段，各分段直接写入临时文件
+（<缓存文件>.part）中各自的位置，全部完成后原子地重命名为缓存文件，
+缓存路径上不会出现不完整的文件。下载进度保存在内存中并通过回调通知，
+边下载边返回不需要查询外部进程。
+"""
+
+import asyncio
+import contextlib
+import itertools
+import logging
+import os
+import typing
+from dataclasses import dataclass, field
+from pathlib import Path
+
+import anyio
+import httpx
+
+from mirrorsrun.proxy.direct import get_upstream_client
+
+logger = logging.getLogger(__name__)
+
+PART_SUFFIX = ".part"
+# 累积到这么多数据再写入文件
+WRITE_BUFFER_SIZE = 1024 * 1024
+# 每个分段中断后的重试次数，从中断的位置继续
+SEGMENT_RETRIES = 3
+
+
+class DownloadError(Exception):
+    """上游返回错误或数据不完整"""
+
+
+@dataclass
+class Segment:
+    """文件中的一段 [start, end]，end 为 None 表示直到响应结束（总长度未知）"""
+
+    start: int
+    end: typing.Optional[int]
+    # 下一个要写入的位置
+    position: int = field(init=False)
+
+    def __post_init__(self):
+        self.position = self.start
+
+    @property
+    def done(self) -> bool:
+        return self.end is not None and self.position > self.end
+
+
+class NativeDownload:
+    def __init__(
+        self,
+        download_id: str,
+        url: str,
+        cache_file: str,
+        headers: typing.Dict[str, str],
+        priority: int,
+    ):
+        self.id = download_id
+        self.url = url
+        self.cache_file = cache_file
+        self.part_file = cache_file + PART_SUFFIX
+        self.headers = headers
+        # 数值越小越优先，等待名额期间可以提升
+        self.priority = priority
+        self.total_length: typing.Optional[int] = None
+        self.segments: typing.List[Segment] = []
+        self.error: typing.Optional[str] = None
+        self.finished = asyncio.Event()
+        self.task: typing.Optional[asyncio.Task] = None
+        self._listeners: typing.List[typing.Callable[["NativeDownload"], None]] = []
+
+    @property
+    def completed_length(self) -> int:
+        return sum(segment.position - segment.start for segment in self.segments)
+
+    @property
+    def available_length(self) -> int:
+        """从文件开头起连续写入的字节数"""
+        for segment in self.segments:
+            if not segment.done:
+                return segment.position
+        return self.total_length or 0
+
+    def add_listener(self, callback: typing.Callable[["NativeDownload"], None]):
+        """
+        注册进度回调
+
+        得知总长度、每次写入数据以及下载结束（error 为 None 表示成功）时调用。
+        """
+        self._listeners.append(callback)
+
+    def notify(self):
+        for callback in self._listeners:
+            try:
+                callback(self)
+            except Exception as e:
+                logger.warning(f"Progress callback of {self.url} failed: {e}")
+
+
+class PrioritySlots:
+    """限制同时进行的下载数，名额空出时交给优先级最高（数值最小）的等待者"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self._used = 0
+        self._waiters: typing.List[typing.Tuple[NativeDownload, asyncio.Future]] = []
+
+    @contextlib.asynccontextmanager
+    async def hold(self, download: NativeDownload):
+        await self._acquire(download)
+        try:
+            yield
+        finally:
+            self._used -= 1
+            self._wake()
+
+    async def _acquire(self, download: NativeDownload):
+        if self._used < self.limit and not self._waiters:
+            self._used += 1
+            return
+        waiter = (download, asyncio.get_running_loop().create_future())
+        self._waiters.append(waiter)
+        try:
+            await waiter[1]
+        except asyncio.CancelledError:
+            if waiter in self._waiters:
+                self._waiters.remove(waiter)
+            elif waiter[1].done() and not waiter[1].cancelled():
+                # 已经分到名额后才被取消，把名额交给下一个
+                self._used -= 1
+                self._wake()
+            raise
+
+    def _wake(self):
+        while self._used < self.limit and self._waiters:
+            # 同优先级先到先得
+            waiter = min(self._waiters, key=lambda w: w[0].priority)
+            self._waiters.remove(waiter)
+            self._used += 1
+            waiter[1].set_result(None)
+
+
+def write_at(fd: int, data: bytes, offset: int):
+    view = memoryview(data)
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def remove_file(path: str):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+class NativeDownloader:
+    def __init__(
+        self,
+        max_concurrent: int,
+        max_segments: int,
+        min_segment_size: int,
+        read_timeout: float,
+    ):
+        """
+        Args:
+            max_concurrent: 同时下载的文件数
+            max_segments: 每个文件最多拆分的 Range 分段数
+            min_segment_size: 每个分段的最小字节数，小文件不拆分
+            read_timeout: 上游多久没有发送数据视为中断（秒）
+        """
+        self.max_segments = max(1, max_segments)
+        self.min_segment_size = max(1, min_segment_size)
+        self.timeout = httpx.Timeout(30, read=read_timeout)
+        self._slots = PrioritySlots(max(1, max_concurrent))
+        self._downloads: typing.Dict[str, NativeDownload] = {}
+        self._by_file: typing.Dict[str, NativeDownload] = {}
+        self._ids = itertools.count(1)
+
+    def get(self, download_id: str) -> typing.Optional[NativeDownload]:
+        """按 ID 返回下载，结束的下载保留到 forget 为止，以便读取结果"""
+        return self._downloads.get(download_id)
+
+    def forget(self, download_id: str):
+        self._downloads.pop(download_id, None)
+
+    def find(self, cache_file: str) -> typing.Optional[NativeDownload]:
+        """返回本进程中正在下载到 cache_file 的任务"""
+        return self._by_file.get(cache_file)
+
+    def submit(
+        self,
+        url: str,
+        cache_file: str,
+        headers: typing.Dict[str, str],
+        priority: int,
+    ) -> NativeDownload:
+        """开始下载，同一个缓存文件已经在下载时返回已有的任务"""
+        existing = self._by_file.get(cache_file)
+        if existing is not None:
+            self.promote(existing.id, priority)
+            return existing
+
+        download = NativeDownload(
+            f"native-{os.getpid()}-{next(self._ids)}",
+            url,
+            cache_file,
+            headers,
+            priority,
+        )
+        self._downloads[download.id] = download
+        self._by_file[cache_file] = download
+        download.task = asyncio.create_task(self._run(download))
+        return download
+
+    def promote(self, download_id: str, priority: int):
+        """提升尚在排队的下载的优先级"""
+        download = self._downloads.get(download_id)
+        if download is not None and priority < download.priority:
+            download.priority = priority
+
+    def stop(self):
+        for download in list(self._by_file.values()):
+            if download.task is not None:
+                download.task.cancel()
+
+    async def _run(self, download: NativeDownload):
+        try:
+            async with self._slots.hold(download):
+                await self._download(download)
+            os.replace(download.part_file, download.cache_file)
+            logger.info(
+                f"Native download completed: {download.url} "
+                f"({download.total_length} bytes)"
+            )
+        except asyncio.CancelledError:
+            download.error = "download cancelled"
+            remove_file(download.part_file)
+            raise
+        except Exception as e:
+            download.error = str(e) or type(e).__name__
+            logger.warning(
+                f"Native download of {download.url} failed: {download.error}"
+            )
+            remove_file(download.part_file)
+        finally:
+            del self._by_file[download.cache_file]
+            download.finished.set()
+            download.notify()
+
+    def _split(
+        self, total_length: typing.Optional[int], ranged: bool
+    ) -> typing.List[Segment]:
+        if total_length is None:
+            return [Segment(0, None)]
+        if not ranged:
+            return [Segment(0, total_length - 1)]
+        count = min(self.max_segments, total_length // self.min_segment_size)
+        size = -(-total_length // count)
+        return [
+            Segment(start, min(start + size, total_length) - 1)
+            for start in range(0, total_length, size)
+        ]
+
+    async def _download(self, download: NativeDownload):
+        client = get_upstream_client()
+        # 落盘的必须是上游的原始字节：不接受压缩编码，并用 aiter_raw 读取
+        headers = {**download.headers, "accept-encoding": "identity"}
+        request = client.build_request(
+            "GET", download.url, headers=headers, timeout=self.timeout
+        )
+        response = await client.send(request, stream=True, follow_redirects=True)
+        try:
+            if response.status_code != 200:
+                raise DownloadError(f"upstream returned {response.status_code}")
+
+            content_length = response.headers.get("content-length")
+            total_length = int(content_length) if content_length is not None else None
+            ranged = (
+                total_length is not None
+                and response.headers.get("accept-ranges") == "bytes"
+                and total_length >= 2 * self.min_segment_size
+            )
+
+            Path(download.part_file).parent.mkdir(parents=True, exist_ok=True)
+            # 各分段写入各自的位置，尚未写入的部分是文件空洞
+            with open(download.part_file, "wb"):
+                pass
+            download.total_length = total_length
+            download.segments = self._split(total_length, ranged)
+            download.notify()
+        except BaseException:
+            await response.aclose()
+            raise
+
+        # 其余分段直接请求重定向之后的地址；跨域时不转发认证信息
+        range_url = str(response.url)
+        range_headers = dict(headers)
+        if response.url.host != httpx.URL(download.url).host:
+            range_headers.pop("authorization", None)
+
+        resumable = (
+            total_length is not None
+            and response.headers.get("accept-ranges") == "bytes"
+        )
+        first, *others = download.segments
+        tasks = [
+            asyncio.create_task(
+                self._fetch_segment(
+                    download, first, range_url, range_headers, resumable, response
+                )
+            )
+        ]
+        tasks += [
+            asyncio.create_task(
+                self._fetch_segment(
+                    download, segment, range_url, range_headers, resumable
+                )
+            )
+            for segment in others
+        ]
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            # 空文件的分段一开始就已完成，不会读取（和关闭）第一个响应；
+            # 任务在开始前被取消时也是如此。关闭已经关闭的响应没有影响
+            await response.aclose()
+
+        if download.total_length is not None:
+            size = os.path.getsize(download.part_file)
+            if size != download.total_length:
+                raise DownloadError(
+                    f"expected {download.total_length} bytes, got {size}"
+                )
+
+    async def _fetch_segment(
+        self,
+        download: NativeDownload,
+        segment: Segment,
+        url: str,
+        headers: typing.Dict[str, str],
+        resumable: bool,
+        response: typing.Optional[httpx.Response] = None,
+    ):
+        """下载一个分段，中断后从已写入的位置重试"""
+        attempt = 0
+        while not segment.done:
+            try:
+                if response is None:
+                    response = await self._request_range(url, headers, segment)
+                try:
+                    await self._write_response(download, segment, response)
+                finally:
+                    await response.aclose()
+                    response = None
+
+                if segment.end is None:
+                    # 总长度未知，响应结束即下载结束
+                    segment.end = segment.position - 1
+                    download.total_length = segment.position
+                    return
+                if not segment.done:
+                    raise DownloadError(f"connection closed at byte {segment.position}")
+            except (httpx.HTTPError, DownloadError) as e:
+                attempt += 1
+                if not resumable or attempt > SEGMENT_RETRIES:
+                    raise
+                logger.warning(
+                    f"Retrying {download.url} from byte {segment.position} "
+                    f"(attempt {attempt}/{SEGMENT_RETRIES}): {e}"
+                )
+                await asyncio.sleep(attempt)
+
+    async def _request_range(
+        self, url: str, headers: typing.Dict[str, str], segment: Segment
+    ) -> httpx.Response:
+        client = get_upstream_client()
+        range_headers = {**headers, "range": f"bytes={segment.position}-{segment.end}"}
+        request = client.build_request(
+            "GET", url, headers=range_headers, timeout=self.timeout
+        )
+        response = await client.send(request, stream=True, follow_redirects=True)
+        content_range = response.headers.get("content-range", "")
+        if response.status_code != 206 or not content_range.startswith(
+            f"bytes {segment.position}-"
+        ):
+            await response.aclose()
+            raise DownloadError(
+                f"upstream returned {response.status_code} {content_range!r} "
+                f"for bytes {segment.position}-{segment.end}"
+            )
+        return response
+
+    async def _write_response(
+        self, download: NativeDownload, segment: Segment, response: httpx.Response
+    ):
+        fd = os.open(download.part_file, os.O_WRONLY)
+        try:
+            buffer = bytearray()
+            async for chunk in response.aiter_raw():
+                if segment.end is not None:
+                    chunk = chunk[: segment.end + 1 - segment.position - len(buffer)]
+                buffer += chunk
+                reached_end = (
+                    segment.end is not None
+                    and segment.position + len(buffer) > segment.end
+                )
+                if len(buffer) >= WRITE_BUFFER_SIZE or reached_end:
+                    await self._flush(download, segment, fd, buffer)
+                    buffer = bytearray()
+                if reached_end:
+                    # 后面的数据属于其他分段
+                    return
+            if buffer:
+                await self._flush(download, segment, fd, buffer)
+        finally:
+            os.close(fd)
+
+    @staticmethod
+    async def _flush(
+        download: NativeDownload, segment: Segment, fd: int, buffer: bytearray
+    ):
+        await anyio.to_thread.run_sync(write_at, fd, bytes(buffer), segment.position)
+        # 写入返回后才更新进度，读取方看到的进度对应的数据一定已经落盘
+        segment.position += len(buffer)
+        download.notify()
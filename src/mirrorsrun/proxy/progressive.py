@@ -0,0 +1,252 @@
+"""
+边下载边返回：在下载尚未完成时，把已经落盘的连续前缀流式返回给客户端
+
+下载进度由下载后端提供（见 download_backend），默认从 aria2 的控制文件读取。
+aria2 的控制文件（*.aria2）记录了每个 piece 是否完成，格式见
+https://aria2.github.io/manual/en/html/technical-notes.html#control-file-aria2-format
+"""
+
+import logging
+import os
+import struct
+import time
+import typing
+from asyncio import sleep
+from dataclasses import dataclass
+
+import anyio
+from starlette.background import BackgroundTask
+from starlette.datastructures import Headers
+from starlette.responses import Response, StreamingResponse
+
+from mirrorsrun.proxy.file_response import CHUNK_SIZE, parse_range
+from mirrorsrun.proxy.integrity import StreamVerifier
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL = 0.5
+
+
+class DownloadStalled(Exception):
+    """部分文件长时间没有新数据，放弃本次流式响应"""
+
+
+@dataclass
+class ControlFileInfo:
+    """aria2 控制文件中与进度相关的字段"""
+
+    piece_length: int
+    total_length: int
+    bitfield: bytes
+
+    def completed_prefix(self) -> int:
+        """从文件开头起连续完成的字节数"""
+        completed_pieces = 0
+        for byte in self.bitfield:
+            if byte == 0xFF:
+                completed_pieces += 8
+                continue
+            mask = 0x80
+            while mask and byte & mask:
+                completed_pieces += 1
+                mask >>= 1
+            break
+        return min(completed_pieces * self.piece_length, self.total_length)
+
+
+def read_control_file(control_file: str) -> typing.Optional[ControlFileInfo]:
+    """
+    解析 aria2 控制文件
+
+    Returns:
+        ControlFileInfo，文件不存在、被截断或格式无法识别时返回 None
+    """
+    try:
+        with open(control_file, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+
+    try:
+        (version,) = struct.unpack_from(">H", data, 0)
+        # version 1 为大端；version 0 为写入方的本机字节序（实际部署均为 x86/arm 小端）
+        endian = ">" if version == 1 else "<"
+        offset = 2 + 4  # version + extension
+        (info_hash_length,) = struct.unpack_from(f"{endian}I", data, offset)
+        offset += 4 + info_hash_length
+        piece_length, total_length, _upload_length, bitfield_length = (
+            struct.unpack_from(f"{endian}IQQI", data, offset)
+        )
+        offset += 4 + 8 + 8 + 4
+        bitfield = data[offset : offset + bitfield_length]
+        if len(bitfield) != bitfield_length:
+            return None
+    except struct.error:
+        return None
+
+    if piece_length == 0 or total_length == 0:
+        return None
+
+    return ControlFileInfo(
+        piece_length=piece_length,
+        total_length=total_length,
+        bitfield=bitfield,
+    )
+
+
+@dataclass
+class DownloadProgress:
+    """正在下载的文件的进度"""
+
+    # 文件总长度，未知时为 None
+    total_length: typing.Optional[int]
+    # 从文件开头起可以安全读取的连续字节数
+    available_length: int
+    # 下载中的数据所在的文件（aria2 直接写入缓存文件，其他后端可能写入临时文件）
+    data_file: str
+
+
+GetProgress = typing.Callable[[str], typing.Optional[DownloadProgress]]
+
+
+def get_aria2_progress(cache_file: str) -> typing.Optional[DownloadProgress]:
+    """
+    从 aria2 控制文件读取下载进度
+
+    下载完成后 aria2 会删除控制文件，此时整个文件均可读取。
+
+    Returns:
+        DownloadProgress，缓存文件不存在时返回 None
+    """
+    info = read_control_file(f"{cache_file}.aria2")
+    try:
+        file_size = os.path.getsize(cache_file)
+    except OSError:
+        return None
+
+    if info is None:
+        if os.path.exists(f"{cache_file}.aria2"):
+            # 控制文件正在被重写，下次再读
+            return DownloadProgress(None, 0, cache_file)
+        return DownloadProgress(None, file_size, cache_file)
+
+    return DownloadProgress(
+        info.total_length, min(info.completed_prefix(), file_size), cache_file
+    )
+
+
+def get_available_length(
+    cache_file: str, get_progress: GetProgress = get_aria2_progress
+) -> typing.Optional[int]:
+    """返回当前可以安全读取的连续字节数，文件不存在时返回 None"""
+    progress = get_progress(cache_file)
+    if progress is None:
+        return None
+    return progress.available_length
+
+
+async def open_data_file(cache_file: str, get_progress: GetProgress):
+    """打开下载中的数据文件；数据文件已经被重命名为缓存文件时打开缓存文件"""
+    progress = get_progress(cache_file)
+    data_file = progress.data_file if progress is not None else cache_file
+    # 不使用缓冲：文件仍在被写入，预读的缓冲区内容可能已经过期
+    try:
+        return await anyio.open_file(data_file, mode="rb", buffering=0)
+    except FileNotFoundError:
+        if data_file == cache_file:
+            raise
+        return await anyio.open_file(cache_file, mode="rb", buffering=0)
+
+
+async def iter_partial_file(
+    cache_file: str,
+    start: int,
+    end: int,
+    stall_timeout: int,
+    verifier: typing.Optional[StreamVerifier] = None,
+    get_progress: GetProgress = get_aria2_progress,
+) -> typing.AsyncIterator[bytes]:
+    sent = start
+    last_progress = time.time()
+
+    # 已经打开的文件在被重命名后仍然可读，数据不会丢失
+    async with await open_data_file(cache_file, get_progress) as f:
+        while sent <= end:
+            available = get_available_length(cache_file, get_progress)
+            if available is None:
+                raise DownloadStalled(f"{cache_file} disappeared while streaming")
+
+            if available > sent:
+                await f.seek(sent)
+                readable_end = min(available, end + 1)
+                while sent < readable_end:
+                    chunk = await f.read(min(CHUNK_SIZE, readable_end - sent))
+                    if not chunk:
+                        break
+                    sent += len(chunk)
+                    if verifier is not None:
+                        verifier.update(chunk)
+                        if sent > end:
+                            # 最后一块在校验通过后才发送
+                            verifier.finish()
+                    yield chunk
+                last_progress = time.time()
+                continue
+
+            if time.time() - last_progress > stall_timeout:
+                raise DownloadStalled(
+                    f"no progress for {stall_timeout}s on {cache_file} at {sent}"
+                )
+            await sleep(POLL_INTERVAL)
+
+
+def make_progressive_response(
+    request_headers: Headers,
+    cache_file: str,
+    stall_timeout: int,
+    background: typing.Optional[BackgroundTask] = None,
+    verifier: typing.Optional[StreamVerifier] = None,
+    get_progress: GetProgress = get_aria2_progress,
+) -> typing.Optional[Response]:
+    """
+    为正在下载的文件构造流式响应
+
+    verifier 只在返回整个文件时使用。
+
+    Returns:
+        响应对象；总长度未知时返回 None，调用方应继续等待
+    """
+    progress = get_progress(cache_file)
+    if progress is None or progress.total_length is None:
+        return None
+
+    total_length = progress.total_length
+    headers = {"accept-ranges": "bytes"}
+    start, end, status_code = 0, total_length - 1, 200
+
+    range_header = request_headers.get("range")
+    if range_header and "if-range" not in request_headers:
+        try:
+            byte_range = parse_range(range_header, total_length)
+        except ValueError:
+            headers["content-range"] = f"bytes */{total_length}"
+            return Response(status_code=416, headers=headers)
+        if byte_range is not None:
+            start, end = byte_range
+            status_code = 206
+            headers["content-range"] = f"bytes {start}-{end}/{total_length}"
+
+    headers["content-length"] = str(end - start + 1)
+    if status_code != 200:
+        verifier = None
+
+    logger.info(f"Streaming partial file {cache_file} [{start}-{end}/{total_length}]")
+    return StreamingResponse(
+        iter_partial_file(
+            cache_file, start, end, stall_timeout, verifier, get_progress
+        ),
+        status_code=status_code,
+        headers=headers,
+        media_type="application/octet-stream",
+        background=background,
+    )
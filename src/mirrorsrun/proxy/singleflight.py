@@ -0,0 +1,112 @@
+"""
+同一缓存文件的并发未命中合并（single-flight）
+
+第一个请求负责提交下载并启动唯一的监视任务，之后到达的请求只等待同一个
+DownloadFlight，下载完成（或可以边下载边返回）时统一唤醒。
+"""
+
+import asyncio
+import logging
+import time
+from typing import Dict, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+class DownloadFlight:
+    """一次进行中的下载，所有并发请求共享"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.gid: Optional[str] = None
+        self.started_at = time.time()
+        self.finished_at: Optional[float] = None
+        self.error: Optional[str] = None
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        self._done = asyncio.Event()
+        self._streamable = asyncio.Event()
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def streamable(self) -> bool:
+        return self._streamable.is_set()
+
+    @property
+    def download_time(self) -> float:
+        return (self.finished_at or time.time()) - self.started_at
+
+    def mark_streamable(self):
+        """文件总长度已知，可以开始边下载边返回"""
+        self._streamable.set()
+
+    def complete(self):
+        self.finished_at = time.time()
+        self._streamable.set()
+        self._done.set()
+
+    def fail(self, error: str):
+        self.error = error
+        self.finished_at = time.time()
+        self._streamable.set()
+        self._done.set()
+
+    async def wait(self, timeout: float, streamable_ok: bool = False) -> bool:
+        """
+        等待下载完成
+
+        Args:
+            timeout: 最长等待时间（秒）
+            streamable_ok: 为 True 时，文件可以开始流式返回即唤醒
+
+        Returns:
+            是否在超时前被唤醒
+        """
+        event = self._streamable if streamable_ok else self._done
+        self.waiters += 1
+        try:
+            await asyncio.wait_for(event.wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiters -= 1
+
+
+class SingleFlightRegistry:
+    """以缓存文件路径为键的进程内下载登记表"""
+
+    def __init__(self):
+        self._flights: Dict[str, DownloadFlight] = {}
+
+    def join(self, key: str) -> Tuple[DownloadFlight, bool]:
+        """
+        加入已有下载，或登记一个新的下载
+
+        Returns:
+            (flight, is_owner)，is_owner 为 True 表示调用方负责提交下载
+        """
+        flight = self._flights.get(key)
+        if flight is not None and not flight.done:
+            return flight, False
+
+        flight = DownloadFlight(key)
+        self._flights[key] = flight
+        return flight, True
+
+    def get(self, key: str) -> Optional[DownloadFlight]:
+        return self._flights.get(key)
+
+    def release(self, flight: DownloadFlight):
+        if self._flights.get(flight.key) is flight:
+            del self._flights[flight.key]
+
+    def __len__(self) -> int:
+        return len(self._flights)
+
+
+# 全局登记表
+download_flights = SingleFlightRegistry()
@@ -0,0 +1,229 @@
+"""
+缓存未命中时边转发边缓存（tee-on-miss）
+
+不大的文件不经过下载后端：直接向上游请求一次，数据一边写入临时文件
+（<缓存文件>.tee），一边转发给发起请求的客户端，下载完成后原子地发布为缓存文件，
+并唤醒合并等待同一文件的请求。未命中的代价只剩上游传输时间，不需要等待下载完成
+的轮询，也不需要把文件再读一遍。
+
+客户端读得比上游慢、转发队列写满时，客户端改为从临时文件读取剩余部分，
+不会拖慢下载；客户端断开后下载照常完成。
+"""
+
+import asyncio
+import logging
+import os
+import typing
+from pathlib import Path
+
+import anyio
+import httpx
+
+from mirrorsrun.proxy.direct import get_upstream_client
+from mirrorsrun.proxy.integrity import StreamVerifier
+from mirrorsrun.proxy.native_downloader import DownloadError, remove_file, write_at
+from mirrorsrun.proxy.progressive import (
+    DownloadProgress,
+    GetProgress,
+    iter_partial_file,
+)
+
+logger = logging.getLogger(__name__)
+
+TEE_SUFFIX = ".tee"
+# 转发队列的长度（块数）
+QUEUE_SIZE = 64
+
+
+class TeeDownload:
+    def __init__(
+        self,
+        url: str,
+        cache_file: str,
+        total_length: int,
+        verifier: typing.Optional[StreamVerifier] = None,
+    ):
+        self.url = url
+        self.cache_file = cache_file
+        self.part_file = f"{cache_file}{TEE_SUFFIX}"
+        self.total_length = total_length
+        self.verifier = verifier
+        self.written = 0
+        self.error: typing.Optional[str] = None
+        self.finished = asyncio.Event()
+        self.task: typing.Optional[asyncio.Task] = None
+        # 转发给发起请求的客户端：数据块，结束时为 None，失败时为异常
+        self.queue: asyncio.Queue = asyncio.Queue(QUEUE_SIZE)
+        # 队列写满后不再转发，客户端改为读取临时文件
+        self.detached = False
+
+    def get_progress(self) -> DownloadProgress:
+        # 发布（以及校验）之前保留最后一个字节，读取方不会在校验之前拿到完整的文件
+        available = min(self.written, self.total_length - 1)
+        return DownloadProgress(self.total_length, max(available, 0), self.part_file)
+
+    def _forward(self, item):
+        if self.detached:
+            return
+        try:
+            self.queue.put_nowait(item)
+        except asyncio.QueueFull:
+            logger.debug(
+                f"Client of {self.url} is behind, switching it to the temp file"
+            )
+            self.detached = True
+
+    async def run(self, upstream: httpx.Response):
+        """把上游响应写入临时文件并转发，完成后发布为缓存文件"""
+        try:
+            Path(self.part_file).parent.mkdir(parents=True, exist_ok=True)
+            last_chunk = b""
+            fd = os.open(self.part_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                async for chunk in upstream.aiter_raw():
+                    if not chunk:
+                        continue
+                    await anyio.to_thread.run_sync(write_at, fd, chunk, self.written)
+                    self.written += len(chunk)
+                    if self.verifier is not None:
+                        self.verifier.update(chunk)
+                    # 最后一块在发布（以及校验）之后才转发
+                    if self.written < self.total_length:
+                        self._forward(chunk)
+                    else:
+                        last_chunk = chunk
+            finally:
+                os.close(fd)
+                await upstream.aclose()
+
+            if self.written != self.total_length:
+                raise DownloadError(
+                    f"expected {self.total_length} bytes, got {self.written}"
+                )
+
+            os.replace(self.part_file, self.cache_file)
+            if self.verifier is not None:
+                # 校验失败时缓存文件被隔离
+                self.verifier.finish()
+            logger.info(
+                f"Tee download completed: {self.url} ({self.total_length} bytes)"
+            )
+            self._forward(last_chunk)
+            self._forward(None)
+        except BaseException as e:
+            self.error = str(e) or type(e).__name__
+            logger.warning(f"Tee download of {self.url} failed: {self.error}")
+            remove_file(self.part_file)
+            self._forward(e if isinstance(e, Exception) else DownloadError(self.error))
+            if not isinstance(e, Exception):
+                raise
+        finally:
+            tee_downloads.remove(self)
+            self.finished.set()
+
+    async def iter_client(
+        self, stall_timeout: int, get_progress: GetProgress
+    ) -> typing.AsyncIterator[bytes]:
+        """
+        发起请求的客户端读取的内容
+
+        Args:
+            stall_timeout: 改为读取临时文件后，多久没有新数据视为下载停滞（秒）
+            get_progress: 改为读取临时文件后，用于获取下载进度（见 progressive）
+        """
+        sent = 0
+        while not (self.detached and self.queue.empty()):
+            item = await self.queue.get()
+            if item is None:
+                return
+            if isinstance(item, Exception):
+                raise item
+            sent += len(item)
+            yield item
+
+        if sent < self.total_length:
+            async for chunk in iter_partial_file(
+                self.cache_file,
+                sent,
+                self.total_length - 1,
+                stall_timeout,
+                get_progress=get_progress,
+            ):
+                yield chunk
+
+
+class TeeRegistry:
+    """本进程中正在进行的 tee 下载，以缓存文件路径为键"""
+
+    def __init__(self):
+        self._downloads: typing.Dict[str, TeeDownload] = {}
+
+    def get(self, cache_file: str) -> typing.Optional[TeeDownload]:
+        return self._downloads.get(cache_file)
+
+    def add(self, tee: TeeDownload):
+        self._downloads[tee.cache_file] = tee
+
+    def remove(self, tee: TeeDownload):
+        if self._downloads.get(tee.cache_file) is tee:
+            del self._downloads[tee.cache_file]
+
+
+def parse_content_length(headers: httpx.Headers) -> typing.Optional[int]:
+    """Content-Length 缺失、格式错误或重复且不一致时返回 None"""
+    values = {
+        value.strip()
+        for header in headers.get_list("content-length")
+        for value in header.split(",")
+    }
+    if len(values) != 1:
+        return None
+    value = values.pop()
+    return int(value) if value.isdigit() else None
+
+
+async def start_tee(
+    url: str,
+    cache_file: str,
+    headers: typing.Dict[str, str],
+    max_size: int,
+    verifier: typing.Optional[StreamVerifier] = None,
+) -> typing.Optional[TeeDownload]:
+    """
+    向上游请求文件，适合边转发边缓存时开始下载
+
+    Returns:
+        TeeDownload；上游出错、长度未知或无效、内容经过压缩编码或文件超过 max_size 时
+        返回 None，调用方应改用下载后端
+    """
+    client = get_upstream_client()
+    # 缓存的必须是上游的原始字节：不接受压缩编码，并用 aiter_raw 读取
+    request = client.build_request(
+        "GET", url, headers={**headers, "accept-encoding": "identity"}
+    )
+    try:
+        upstream = await client.send(request, stream=True, follow_redirects=True)
+    except httpx.HTTPError as e:
+        logger.warning(f"Tee request for {url} failed: {e}")
+        return None
+
+    total_length = parse_content_length(upstream.headers)
+    # 上游忽略 accept-encoding: identity 时，原始字节是压缩后的内容，不能作为缓存文件
+    encoding = upstream.headers.get("content-encoding", "identity").strip().lower()
+    if (
+        upstream.status_code != 200
+        or total_length is None
+        or total_length > max_size
+        or encoding != "identity"
+    ):
+        await upstream.aclose()
+        return None
+
+    tee = TeeDownload(url, cache_file, total_length, verifier)
+    tee_downloads.add(tee)
+    tee.task = asyncio.create_task(tee.run(upstream))
+    return tee
+
+
+# 全局登记表
+tee_downloads = TeeRegistry()
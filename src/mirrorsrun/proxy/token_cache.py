@@ -0,0 +1,210 @@
+"""
+Docker registry bearer token 缓存
+
+https://distribution.github.io/distribution/spec/auth/token/
+
+以 (realm, service, scope, 客户端凭证) 为键缓存 token 服务的响应，在 token 过期前
+后台刷新；返回缓存的 token 时按剩余有效期改写 expires_in / issued_at。
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import time
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from typing import Dict, Optional, Tuple
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+from mirrorsrun.proxy.direct import get_upstream_client
+
+logger = logging.getLogger(__name__)
+
+# 规范规定未返回 expires_in 时按 60 秒处理
+DEFAULT_EXPIRES_IN = 60
+# 剩余有效期低于总时长的这个比例时后台刷新
+REFRESH_RATIO = 0.2
+# 剩余有效期低于这个值（秒）时不再返回缓存的 token
+MIN_REMAINING = 10
+MAX_ENTRIES = 4096
+
+TokenKey = Tuple[str, str, str, str]
+
+
+@dataclass
+class CachedToken:
+    body: dict
+    content_type: str
+    fetched_at: float
+    expires_at: float
+
+    @property
+    def lifetime(self) -> float:
+        return self.expires_at - self.fetched_at
+
+    def remaining(self) -> float:
+        return self.expires_at - time.time()
+
+
+class TokenCache:
+    """进程内的 token 缓存，同一个键的并发请求只向 token 服务请求一次"""
+
+    def __init__(self):
+        self._tokens: Dict[TokenKey, CachedToken] = {}
+        self._inflight: Dict[TokenKey, asyncio.Task] = {}
+        # 本进程拿到的 token -> (客户端凭证的哈希, 过期时间)，匿名获取时凭证为空，
+        # 用于识别同一个凭证先后拿到的不同 token
+        self._identities: Dict[str, Tuple[str, float]] = {}
+
+    @staticmethod
+    def make_key(realm: str, service: str, scope: str, authorization: str) -> TokenKey:
+        # 不保存明文凭证
+        credential = (
+            hashlib.sha256(authorization.encode()).hexdigest() if authorization else ""
+        )
+        return realm, service, scope, credential
+
+    async def _fetch(
+        self, key: TokenKey, url: str, headers: Dict[str, str]
+    ) -> Tuple[Optional[CachedToken], Response]:
+        response = await get_upstream_client().get(
+            url, headers=headers, follow_redirects=True, timeout=30
+        )
+        if response.status_code != 200:
+            return None, Response(
+                content=response.content,
+                status_code=response.status_code,
+                media_type=response.headers.get("content-type"),
+            )
+
+        try:
+            body = response.json()
+            expires_in = int(body.get("expires_in") or DEFAULT_EXPIRES_IN)
+        except (ValueError, AttributeError):
+            return None, Response(
+                content=response.content,
+                media_type=response.headers.get("content-type"),
+            )
+
+        now = time.time()
+        # issued_at 是 token 服务的时间，与本机时间可能有偏差，以收到响应的时间为准
+        token = CachedToken(
+            body=body,
+            content_type=response.headers.get("content-type", "application/json"),
+            fetched_at=now,
+            expires_at=now + expires_in,
+        )
+        self._store(key, token)
+        self._record_identity(
+            body.get("token") or body.get("access_token"), key[3], token
+        )
+        return token, make_token_response(token)
+
+    def _record_identity(
+        self, value: Optional[str], credential: str, token: CachedToken
+    ):
+        if value:
+            self._identities[value] = (credential, token.expires_at)
+        if len(self._identities) > MAX_ENTRIES:
+            now = time.time()
+            self._identities = {k: v for k, v in self._identities.items() if v[1] > now}
+
+    def get_identity(self, authorization: str) -> str:
+        """
+        返回请求的凭证身份，同一个凭证先后拿到的 token 身份相同
+
+        Returns:
+            没有凭证或只带了本进程匿名获取的 bearer token 时返回空字符串；
+            本进程为某个凭证获取的 token 返回该凭证的哈希；
+            其他 token（例如由其他 worker 获取）返回 token 本身的哈希
+        """
+        if not authorization:
+            return ""
+        scheme, _, value = authorization.partition(" ")
+        if scheme.lower() == "bearer":
+            identity = self._identities.get(value.strip())
+            if identity is not None and identity[1] > time.time():
+                return identity[0]
+        return hashlib.sha256(authorization.encode()).hexdigest()
+
+    def is_anonymous(self, authorization: str) -> bool:
+        """请求没有凭证，或者只带了本进程匿名获取的 bearer token"""
+        return self.get_identity(authorization) == ""
+
+    def _store(self, key: TokenKey, token: CachedToken):
+        self._tokens[key] = token
+        if len(self._tokens) > MAX_ENTRIES:
+            for expired_key in [
+                k for k, v in self._tokens.items() if v.remaining() <= 0
+            ]:
+                del self._tokens[expired_key]
+        while len(self._tokens) > MAX_ENTRIES:
+            del self._tokens[next(iter(self._tokens))]
+
+    def _start_fetch(
+        self, key: TokenKey, url: str, headers: Dict[str, str]
+    ) -> asyncio.Task:
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._fetch(key, url, headers))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return task
+
+    async def get_token(
+        self,
+        request: Request,
+        realm: str,
+        service: str,
+        scope: str,
+        url: str,
+    ) -> Response:
+        """
+        返回 token 服务的响应，有效期内的 token 直接从缓存返回
+
+        Args:
+            request: 客户端请求，其中的 Authorization 参与缓存键并转发给上游
+            realm: token 服务地址
+            service: service 参数
+            scope: scope 参数
+            url: 完整的 token 请求地址
+        """
+        authorization = request.headers.get("authorization", "")
+        key = self.make_key(realm, service, scope, authorization)
+        headers = {"user-agent": request.headers.get("user-agent", "")}
+        if authorization:
+            headers["authorization"] = authorization
+
+        token = self._tokens.get(key)
+        if token is not None and token.remaining() > MIN_REMAINING:
+            if (
+                token.remaining() < token.lifetime * REFRESH_RATIO
+                and key not in self._inflight
+            ):
+                logger.debug(f"Refreshing token for {scope} in background")
+                task = self._start_fetch(key, url, headers)
+                task.add_done_callback(_log_refresh_error)
+            return make_token_response(token)
+
+        _, response = await asyncio.shield(self._start_fetch(key, url, headers))
+        return response
+
+
+def _log_refresh_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.warning(f"Background token refresh failed: {task.exception()}")
+
+
+def make_token_response(token: CachedToken) -> Response:
+    # 客户端按 issued_at + expires_in 计算过期时间，需要改写为剩余有效期
+    body = dict(token.body)
+    body["expires_in"] = max(int(token.remaining()), 0)
+    body["issued_at"] = datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+    return Response(content=json.dumps(body), media_type=token.content_type)
+
+
+# 全局 token 缓存
+token_cache = TokenCache()
@@ -0,0 +1,400 @@
+"""
+PyPI 依赖预取
+
+pip 逐个解析依赖，依赖树上的下载因此是串行的。客户端请求一个 wheel 时，读取它的
+Requires-Dist，按客户端的 Python 版本和平台在 simple 索引中选出依赖最可能使用的文件，
+以较低的并发提前下载；依赖本身的 .metadata 也会继续展开，直到 PYPI_PREFETCH_DEPTH 层。
+
+版本、标记和 wheel 标签的解析依赖可选的 packaging 包，未安装时不预取。
+"""
+
+import asyncio
+import html
+import json
+import logging
+import re
+import time
+import typing
+from dataclasses import dataclass
+from email.parser import BytesHeaderParser
+
+from starlette.requests import Request
+
+from mirrorsrun.config import (
+    PYPI_PREFETCH,
+    PYPI_PREFETCH_CONCURRENCY,
+    PYPI_PREFETCH_DEPTH,
+)
+
+try:
+    from packaging.markers import InvalidMarker
+    from packaging.requirements import InvalidRequirement, Requirement
+    from packaging.specifiers import InvalidSpecifier, SpecifierSet
+    from packaging.tags import Tag, compatible_tags, cpython_tags, mac_platforms
+    from packaging.utils import (
+        InvalidWheelFilename,
+        canonicalize_name,
+        parse_wheel_filename,
+    )
+    from packaging.version import InvalidVersion, Version
+except ImportError:  # 可选依赖
+    Requirement = None  # type: ignore[assignment, misc]
+
+logger = logging.getLogger(__name__)
+
+if PYPI_PREFETCH and Requirement is None:
+    logger.warning("packaging is not installed, PyPI dependency prefetch is disabled")
+
+# 同一个项目在这段时间内只展开一次（秒）
+RESOLVED_TTL = 600
+
+_sdist_regex = re.compile(r"^(?P<name>.+)-(?P<version>[^-]+)\.(tar\.gz|zip)$")
+_html_anchor_regex = re.compile(
+    r'<a\s[^>]*href="(?P<url>[^"]+)"[^>]*>(?P<filename>[^<]+)</a>'
+)
+_html_attribute_regex = re.compile(r'data-(?P<name>[\w-]+)="(?P<value>[^"]*)"')
+
+
+@dataclass
+class IndexFile:
+    """simple 索引中的一个文件"""
+
+    filename: str
+    url: str
+    requires_python: typing.Optional[str] = None
+    yanked: bool = False
+    has_metadata: bool = False
+
+
+@dataclass
+class ClientEnvironment:
+    """从 pip / uv 的 User-Agent 中得到的客户端环境"""
+
+    python_version: typing.Tuple[int, int]
+    python_full_version: str
+    implementation: str
+    system: str
+    machine: str
+    libc: typing.Optional[str] = None
+    libc_version: typing.Optional[typing.Tuple[int, int]] = None
+    macos_version: typing.Optional[typing.Tuple[int, int]] = None
+
+    @classmethod
+    def from_user_agent(cls, user_agent: str) -> typing.Optional["ClientEnvironment"]:
+        """
+        解析 pip 的 User-Agent：pip/<version> {json}
+
+        Returns:
+            无法识别时返回 None
+        """
+        _, _, data = user_agent.partition(" ")
+        try:
+            info = json.loads(data)
+            python = info["python"]
+            major, minor = (int(part) for part in python.split(".")[:2])
+        except (ValueError, KeyError, TypeError, AttributeError):
+            return None
+
+        distro = info.get("distro") or {}
+        libc = distro.get("libc") or {}
+        env = cls(
+            python_version=(major, minor),
+            python_full_version=python,
+            implementation=(info.get("implementation") or {}).get("name", "CPython"),
+            system=(info.get("system") or {}).get("name", ""),
+            machine=info.get("cpu") or "",
+            libc=libc.get("lib"),
+        )
+        env.libc_version = _parse_two_part_version(libc.get("version"))
+        if env.system == "Darwin":
+            env.macos_version = _parse_two_part_version(distro.get("version"))
+        return env
+
+    def marker_environment(self) -> typing.Dict[str, str]:
+        sys_platform = {"Linux": "linux", "Darwin": "darwin", "Windows": "win32"}
+        return {
+            "implementation_name": self.implementation.lower(),
+            "os_name": "nt" if self.system == "Windows" else "posix",
+            "platform_machine": self.machine,
+            "platform_python_implementation": self.implementation,
+            "platform_system": self.system,
+            "python_full_version": self.python_full_version,
+            "python_version": "{}.{}".format(*self.python_version),
+            "sys_platform": sys_platform.get(self.system, self.system.lower()),
+        }
+
+    def platforms(self) -> typing.List[str]:
+        """按优先级排列的平台标签"""
+        machine = self.machine.lower()
+        if self.system == "Windows":
+            return {
+                "amd64": ["win_amd64"],
+                "x86_64": ["win_amd64"],
+                "arm64": ["win_arm64"],
+            }.get(machine, ["win32"])
+        if self.system == "Darwin":
+            arch = "arm64" if machine in ("arm64", "aarch64") else "x86_64"
+            return list(mac_platforms(self.macos_version or (11, 0), arch))
+        if self.system == "Linux":
+            if self.libc == "glibc" and self.libc_version:
+                major, minor = self.libc_version
+                platforms = [
+                    f"manylinux_{major}_{m}_{machine}" for m in range(minor, 4, -1)
+                ]
+                # PEP 600 之前的旧名称
+                legacy = {17: "manylinux2014", 12: "manylinux2010", 5: "manylinux1"}
+                for glibc_minor, name in legacy.items():
+                    if minor >= glibc_minor:
+                        platforms.append(f"{name}_{machine}")
+                return platforms
+            if self.libc_version:
+                major, minor = self.libc_version
+                return [
+                    f"musllinux_{major}_{m}_{machine}" for m in range(minor, -1, -1)
+                ]
+        return []
+
+    def supported_tags(self) -> typing.List["Tag"]:
+        platforms = self.platforms()
+        tags = []
+        if self.implementation == "CPython":
+            tags += list(cpython_tags(self.python_version, platforms=platforms))
+        tags += list(compatible_tags(self.python_version, platforms=platforms))
+        return tags
+
+
+def _parse_two_part_version(value) -> typing.Optional[typing.Tuple[int, int]]:
+    try:
+        major, minor = str(value).split(".")[:2]
+        return int(major), int(minor)
+    except ValueError:
+        return None
+
+
+def parse_requirements(
+    metadata: bytes, env: ClientEnvironment
+) -> typing.List["Requirement"]:
+    """解析 METADATA 中适用于客户端环境、且不属于 extra 的 Requires-Dist"""
+    headers = BytesHeaderParser().parsebytes(metadata)
+    marker_env = env.marker_environment()
+    requirements = []
+    for value in headers.get_all("Requires-Dist") or []:
+        try:
+            requirement = Requirement(value)
+            if requirement.marker is not None and not requirement.marker.evaluate(
+                {**marker_env, "extra": ""}
+            ):
+                continue
+        except (InvalidRequirement, InvalidMarker) as e:
+            logger.debug(f"Skip requirement {value}: {e}")
+            continue
+        requirements.append(requirement)
+    return requirements
+
+
+def parse_simple_page(body: bytes, content_type: str) -> typing.List[IndexFile]:
+    """解析 PEP 691 JSON 或 PEP 503 HTML 格式的项目页面"""
+    if "json" in content_type:
+        files = []
+        for item in json.loads(body).get("files", []):
+            files.append(
+                IndexFile(
+                    filename=item["filename"],
+                    url=item["url"],
+                    requires_python=item.get("requires-python"),
+                    yanked=bool(item.get("yanked")),
+                    has_metadata=bool(
+                        item.get("core-metadata") or item.get("dist-info-metadata")
+                    ),
+                )
+            )
+        return files
+
+    files = []
+    for match in _html_anchor_regex.finditer(body.decode("utf-8", errors="replace")):
+        attributes = dict(_html_attribute_regex.findall(match.group(0)))
+        files.append(
+            IndexFile(
+                filename=match.group("filename").strip(),
+                url=match.group("url").split("#")[0],
+                requires_python=html.unescape(attributes.get("requires-python", ""))
+                or None,
+                yanked="yanked" in attributes,
+                has_metadata="core-metadata" in attributes
+                or "dist-info-metadata" in attributes,
+            )
+        )
+    return files
+
+
+def choose_file(
+    files: typing.List[IndexFile],
+    requirement: "Requirement",
+    env: ClientEnvironment,
+    supported_tags: typing.List["Tag"],
+) -> typing.Optional[IndexFile]:
+    """
+    选出 pip 最可能安装的文件：满足版本约束的最新正式版本，优先兼容的 wheel，其次 sdist
+    """
+    tag_priority = {tag: index for index, tag in enumerate(supported_tags)}
+    try:
+        python_version = Version(env.python_full_version)
+    except InvalidVersion:
+        python_version = Version("{}.{}".format(*env.python_version))
+    candidates: typing.Dict["Version", typing.List[typing.Tuple[int, IndexFile]]] = {}
+
+    for file in files:
+        if file.yanked:
+            continue
+        if file.requires_python:
+            try:
+                if python_version not in SpecifierSet(file.requires_python):
+                    continue
+            except InvalidSpecifier:
+                pass
+
+        try:
+            if file.filename.endswith(".whl"):
+                _, version, _, tags = parse_wheel_filename(file.filename)
+                priorities = [tag_priority[tag] for tag in tags if tag in tag_priority]
+                if not priorities:
+                    continue
+                priority = min(priorities)
+            else:
+                match = _sdist_regex.match(file.filename)
+                if match is None:
+                    continue
+                version = Version(match.group("version"))
+                priority = len(supported_tags)
+        except (InvalidWheelFilename, InvalidVersion):
+            continue
+
+        if version.is_prerelease or version not in requirement.specifier:
+            continue
+        candidates.setdefault(version, []).append((priority, file))
+
+    if not candidates:
+        return None
+    latest = max(candidates)
+    return min(candidates[latest], key=lambda item: item[0])[1]
+
+
+LoadIndex = typing.Callable[[str], typing.Awaitable[typing.List[IndexFile]]]
+LoadMetadata = typing.Callable[[IndexFile], typing.Awaitable[typing.Optional[bytes]]]
+StartDownload = typing.Callable[
+    [IndexFile], typing.Awaitable[typing.Optional[asyncio.Task]]
+]
+
+
+class DependencyPrefetcher:
+    def __init__(
+        self,
+        concurrency: int = PYPI_PREFETCH_CONCURRENCY,
+        max_depth: int = PYPI_PREFETCH_DEPTH,
+    ):
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self.max_depth = max_depth
+        self._resolved: typing.Dict[str, float] = {}
+
+    @staticmethod
+    def available() -> bool:
+        return Requirement is not None
+
+    def _should_resolve(self, key: str) -> bool:
+        now = time.time()
+        for expired in [k for k, t in self._resolved.items() if now - t > RESOLVED_TTL]:
+            del self._resolved[expired]
+        if key in self._resolved:
+            return False
+        self._resolved[key] = now
+        return True
+
+    async def _download(self, file: IndexFile, start_download: StartDownload):
+        # 下载结束后才释放名额，预取最多占用 concurrency 个下载
+        async with self._semaphore:
+            task = await start_download(file)
+            if task is not None:
+                logger.info(f"Prefetching dependency {file.filename}")
+                await asyncio.shield(task)
+
+    async def _expand(
+        self,
+        requirement: "Requirement",
+        depth: int,
+        env: ClientEnvironment,
+        supported_tags: typing.List["Tag"],
+        load_index: LoadIndex,
+        load_metadata: LoadMetadata,
+        start_download: StartDownload,
+    ):
+        project = canonicalize_name(requirement.name)
+        env_key = "{}.{}-{}-{}".format(*env.python_version, env.system, env.machine)
+        if not self._should_resolve(f"{project}|{env_key}"):
+            return
+
+        file = choose_file(await load_index(project), requirement, env, supported_tags)
+        if file is None:
+            return
+
+        jobs = [self._download(file, start_download)]
+        if depth < self.max_depth and file.has_metadata:
+            metadata = await load_metadata(file)
+            if metadata is not None:
+                for dependency in parse_requirements(metadata, env):
+                    jobs.append(
+                        self._expand(
+                            dependency,
+                            depth + 1,
+                            env,
+                            supported_tags,
+                            load_index,
+                            load_metadata,
+                            start_download,
+                        )
+                    )
+        await asyncio.gather(*jobs)
+
+    async def prefetch(
+        self,
+        request: Request,
+        metadata: bytes,
+        load_index: LoadIndex,
+        load_metadata: LoadMetadata,
+        start_download: StartDownload,
+    ):
+        """
+        预取一个发行版的依赖
+
+        Args:
+            request: 客户端请求，用于识别客户端环境
+            metadata: 发行版的 METADATA
+            load_index: 按规范化的项目名返回 simple 索引中的文件
+            load_metadata: 返回某个文件的 METADATA（PEP 658）
+            start_download: 开始下载某个文件，返回等待下载结束的任务；已缓存时返回 None
+        """
+        env = ClientEnvironment.from_user_agent(request.headers.get("user-agent", ""))
+        if env is None:
+            return
+
+        try:
+            supported_tags = env.supported_tags()
+            await asyncio.gather(
+                *(
+                    self._expand(
+                        requirement,
+                        1,
+                        env,
+                        supported_tags,
+                        load_index,
+                        load_metadata,
+                        start_download,
+                    )
+                    for requirement in parse_requirements(metadata, env)
+                )
+            )
+        except Exception as e:
+            logger.warning(f"Dependency prefetch failed: {e}")
+
+
+# 全局预取器
+dependency_prefetcher = DependencyPrefetcher()
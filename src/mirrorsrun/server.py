@@ -4,20 +4,27 @@ import sys
 sys.path.append(os.path.dirname(os.path.dirname(__file__)))  # noqa: E402
 
 import base64
+import hmac
+import json
 import signal
 import urllib.parse
 from typing import Callable
 import logging
 import ipaddress
 
-import httpx
 import uvicorn
 from fastapi import FastAPI
 from starlette.requests import Request
-from starlette.responses import RedirectResponse, Response
+from starlette.responses import RedirectResponse, Response, StreamingResponse
 from starlette.staticfiles import StaticFiles
 
+from mirrorsrun.aria2_api import (
+    close_client as close_aria2_client,
+    get_client as get_aria2_client,
+)
 from mirrorsrun.config import (
+    ADMIN_TOKEN,
+    ARIA2_RPC_URL,
     BASE_DOMAIN,
     RPC_SECRET,
     EXTERNAL_URL_ARIA2,
@@ -26,8 +33,10 @@ from mirrorsrun.config import (
     SERVER_PORT,
     SESSION_TIMEOUT,
     ENABLE_SESSION_SUMMARY,
+    COOCCURRENCE_PREFETCH,
     CACHE_DIR,
     ENABLE_CACHE_CLEANUP,
+    DOCKER_PREFETCH_PLATFORM,
 )
 
 from mirrorsrun.sites.npm import npm
@@ -36,6 +45,7 @@ from mirrorsrun.sites.torch import torch
 from mirrorsrun.sites.docker import dockerhub, k8s, quay, ghcr, nvcr
 from mirrorsrun.sites.common import common
 from mirrorsrun.sites.goproxy import goproxy
+from mirrorsrun.warmup import WarmJob
 
 subdomain_mapping = {
     "mirrors": common,
@@ -69,6 +79,18 @@ app.mount(
 @app.on_event("startup")
 async def startup_event():
     """应用启动时的初始化"""
+    # 创建上游连接池
+    from mirrorsrun.proxy.direct import get_upstream_client
+    get_upstream_client()
+
+    # 发现各个上游 docker registry 的认证 realm，并定期刷新
+    from mirrorsrun.docker_realms import realm_registry
+    realm_registry.start()
+
+    # 启动下载后端（aria2：下载优先级调度和下载完成通知）
+    from mirrorsrun.proxy.download_backend import download_backend
+    download_backend.start()
+
     # 初始化缓存追踪器（扫描现有缓存文件）
     try:
         from mirrorsrun.cache_tracker import get_cache_tracker
@@ -96,6 +118,15 @@ async def startup_event():
         )
         logger.info("Session summary feature enabled")
 
+    # 定期把新校验通过的文件记录写回
+    from mirrorsrun.proxy.integrity import get_verified_file_store
+    get_verified_file_store().start()
+
+    # 载入会话共现模型，并定期把新学到的会话写回
+    if COOCCURRENCE_PREFETCH:
+        from mirrorsrun.cooccurrence import cooccurrence_model
+        cooccurrence_model.start()
+
 
 @app.on_event("shutdown")
 async def shutdown_event():
@@ -109,36 +140,84 @@ async def shutdown_event():
         except Exception as e:
             logger.error(f"Failed to stop cache cleanup scheduler: {e}")
     
+    from mirrorsrun.docker_realms import realm_registry
+    realm_registry.stop()
+
+    from mirrorsrun.proxy.download_backend import download_backend
+    download_backend.stop()
+
     # 停止会话管理
     if ENABLE_SESSION_SUMMARY:
         from mirrorsrun.session_manager import session_manager
         session_manager.stop_cleanup_task()
         logger.info("Session cleanup task stopped")
 
+    if COOCCURRENCE_PREFETCH:
+        from mirrorsrun.cooccurrence import cooccurrence_model
+        await cooccurrence_model.stop()
+
+    from mirrorsrun.proxy.integrity import get_verified_file_store
+    await get_verified_file_store().stop()
+
+    # 关闭与 aria2 的长连接以及上游连接池
+    await close_aria2_client()
+
+    from mirrorsrun.proxy.direct import close_upstream_client
+    await close_upstream_client()
+
+
+@app.post("/_admin/warm")
+async def warm_cache(request: Request):
+    """
+    批量预热缓存，以 NDJSON 流式返回进度
+
+    请求体：{"kind": "requirements|poetry|npm|gosum|docker", "content": "...",
+             "filter": "PyPI 文件名正则（可选）", "platform": "linux/amd64（可选）"}
+    """
+    if not ADMIN_TOKEN:
+        return Response(content="Not Found", status_code=404)
+    authorization = request.headers.get("authorization", "")
+    if not hmac.compare_digest(authorization, f"Bearer {ADMIN_TOKEN}"):
+        return Response(content="Unauthorized", status_code=401)
+
+    try:
+        body = await request.json()
+        job = WarmJob(
+            body.get("kind", ""),
+            body.get("content", ""),
+            file_filter=body.get("filter"),
+            platform=body.get("platform") or DOCKER_PREFETCH_PLATFORM,
+        )
+    except Exception as e:
+        return Response(content=f"Bad Request: {e}", status_code=400)
+
+    async def stream_progress():
+        async for progress in job.run():
+            yield json.dumps(progress, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(stream_progress(), media_type="application/x-ndjson")
+
 
 async def aria2(request: Request, call_next):
     if request.url.path == "/":
         return RedirectResponse("/aria2/index.html")
     if request.url.path == "/jsonrpc":
-        # dont use proxy for internal API
-        async with httpx.AsyncClient(
-            mounts={"all://": httpx.AsyncHTTPTransport()}
-        ) as client:
-            data = await request.body()
-            response = await client.request(
-                url="http://aria2:6800/jsonrpc",
-                method=request.method,
-                headers=request.headers,
-                content=data,
-            )
-            headers = response.headers
-            headers.pop("content-length", None)
-            headers.pop("content-encoding", None)
-            return Response(
-                content=response.content,
-                status_code=response.status_code,
-                headers=headers,
-            )
+        # reuse the pooled aria2 client, it doesn't use proxy for internal API
+        data = await request.body()
+        response = await get_aria2_client().request(
+            url=ARIA2_RPC_URL,
+            method=request.method,
+            headers=request.headers,
+            content=data,
+        )
+        headers = response.headers
+        headers.pop("content-length", None)
+        headers.pop("content-encoding", None)
+        return Response(
+            content=response.content,
+            status_code=response.status_code,
+            headers=headers,
+        )
     return await call_next(request)
 
 
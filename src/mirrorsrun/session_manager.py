@@ -6,6 +6,9 @@ from datetime import datetime
 from typing import Dict, List, Optional
 import hashlib
 
+from mirrorsrun.config import COOCCURRENCE_PREFETCH, SESSION_GROUPING, SESSION_TIMEOUT
+from mirrorsrun.cooccurrence import cooccurrence_model
+
 logger = logging.getLogger(__name__)
 
 
@@ -18,6 +21,9 @@ class PackageInfo:
     download_time: float
     start_time: float
     end_time: float
+    # 上游地址和缓存文件，用于学习会话中的文件共现关系（带认证信息的请求不记录）
+    url: Optional[str] = None
+    cache_file: Optional[str] = None
 
 
 @dataclass
@@ -108,14 +114,33 @@ class SessionManager:
         self.session_lock = asyncio.Lock()
         self._initialized = True
         self._cleanup_task = None
+        self.session_timeout = SESSION_TIMEOUT
         logger.info("SessionManager initialized")
     
     def _generate_session_id(self, user_agent: str, client_ip: str) -> str:
         """生成会话 ID"""
-        # 使用 user-agent + client-ip + 时间窗口（秒级）生成 session key
-        time_window = int(time.time() / 5)  # 每5秒一个时间窗口
-        key = f"{user_agent}:{client_ip}:{time_window}"
+        if SESSION_GROUPING == "activity":
+            # 使用 user-agent + client-ip + 会话开始时间生成 session key
+            key = f"{user_agent}:{client_ip}:{time.time()}"
+        else:
+            # 使用 user-agent + client-ip + 时间窗口（秒级）生成 session key
+            time_window = int(time.time() / 5)  # 每5秒一个时间窗口
+            key = f"{user_agent}:{client_ip}:{time_window}"
         return hashlib.md5(key.encode()).hexdigest()[:12]
+
+    def _find_active_session(self, user_agent: str, client_ip: str) -> Optional[InstallSession]:
+        """查找客户端尚未超时的会话"""
+        for session in self.sessions.values():
+            if (
+                session.user_agent == user_agent
+                and session.client_ip == client_ip
+                and not session.is_expired(self.session_timeout)
+            ):
+                return session
+        return None
+
+    def has_active_session(self, user_agent: str, client_ip: str) -> bool:
+        return self._find_active_session(user_agent, client_ip) is not None
     
     async def record_package(
         self,
@@ -126,13 +151,20 @@ class SessionManager:
         cache_hit: bool,
         download_time: float,
         start_time: float,
-        end_time: float
+        end_time: float,
+        url: Optional[str] = None,
+        cache_file: Optional[str] = None,
     ):
         """记录包信息到会话"""
         async with self.session_lock:
-            session_id = self._generate_session_id(user_agent, client_ip)
-            
-            # 获取或创建会话
+            # 获取或创建会话；activity 分组时客户端尚未超时的会话继续使用
+            active_session = None
+            if SESSION_GROUPING == "activity":
+                active_session = self._find_active_session(user_agent, client_ip)
+            if active_session is not None:
+                session_id = active_session.session_id
+            else:
+                session_id = self._generate_session_id(user_agent, client_ip)
             if session_id not in self.sessions:
                 self.sessions[session_id] = InstallSession(
                     session_id=session_id,
@@ -152,7 +184,9 @@ class SessionManager:
                 cache_hit=cache_hit,
                 download_time=download_time,
                 start_time=start_time,
-                end_time=end_time
+                end_time=end_time,
+                url=url,
+                cache_file=cache_file,
             )
             session.add_package(package_info)
             
@@ -180,6 +214,10 @@ class SessionManager:
             # 记录到 JSON（如果提供了 metrics_recorder）
             if metrics_recorder:
                 self._record_session_to_json(session, metrics_recorder)
+
+            # 学习文件共现关系，用于之后的会话预取
+            if COOCCURRENCE_PREFETCH:
+                self._learn_cooccurrence(session)
             
             # 清理会话
             del self.sessions[session_id]
@@ -218,6 +256,15 @@ class SessionManager:
                 f"  └─ {pkg.name} ({pkg.size_mb:.2f}MB, {status}, {pkg.download_time:.2f}s)"
             )
     
+    def _learn_cooccurrence(self, session: InstallSession):
+        """按请求开始时间排序，会话的第一个文件作为之后预取的触发文件"""
+        packages = sorted(session.packages, key=lambda pkg: pkg.start_time)
+        files = [(pkg.url, pkg.cache_file) for pkg in packages if pkg.url and pkg.cache_file]
+        try:
+            cooccurrence_model.learn(files)
+        except Exception as e:
+            logger.error(f"Failed to learn session {session.session_id}: {e}")
+
     def _record_session_to_json(self, session: InstallSession, metrics_recorder):
         """记录会话到 JSON（记录到会话开始日期的文件中）"""
         from datetime import timezone
@@ -274,6 +321,8 @@ class SessionManager:
         """启动后台清理任务"""
         if self._cleanup_task is not None:
             return
+
+        self.session_timeout = timeout
         
         async def cleanup_loop():
             while True:
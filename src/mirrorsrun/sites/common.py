@@ -1,19 +1,63 @@
+import re
+
 from starlette.requests import Request
 
-from mirrorsrun.config import BASE_URL_ALPINE, BASE_URL_UBUNTU, BASE_URL_UBUNTU_PORTS
+from mirrorsrun.config import (
+    BASE_URL_ALPINE,
+    BASE_URL_UBUNTU,
+    BASE_URL_UBUNTU_PORTS,
+    MIRROR_INDEX_STALE_TTL,
+    MIRROR_INDEX_TTL,
+)
 from mirrorsrun.proxy.direct import direct_proxy
+from mirrorsrun.proxy.file_cache import try_file_based_cache
+from mirrorsrun.proxy.metadata_cache import MetadataCache, serve_cached_metadata
 from starlette.responses import Response
 
+# 软件包文件名包含版本号，内容不可变
+package_regex = re.compile(
+    r"^/ubuntu(-ports)?/pool/.+\.(deb|udeb|ddeb)$|^/alpine/.+\.apk$"
+)
+# dists/<suite>/.../by-hash/<algorithm>/<hash>，按内容哈希寻址，不可变
+by_hash_regex = re.compile(r"^/ubuntu(-ports)?/dists/.+/by-hash/[^/]+/[0-9a-fA-F]+$")
+# 会随仓库更新而变化的索引文件
+index_regex = re.compile(
+    r"^/ubuntu(-ports)?/dists/.+/(InRelease|Release|Release\.gpg|Packages[^/]*)$"
+    r"|^/alpine/.+/APKINDEX\.tar\.gz$"
+)
+
+index_cache = MetadataCache(
+    "mirrors-index", ttl=MIRROR_INDEX_TTL, stale_ttl=MIRROR_INDEX_STALE_TTL
+)
+
+INDEX_KEEP_HEADERS = ("content-type", "last-modified")
+
 
 async def common(request: Request):
     path = request.url.path
     if path == "/":
         return
     if path.startswith("/alpine"):
-        return await direct_proxy(request, BASE_URL_ALPINE + path)
-    if path.startswith("/ubuntu/"):
-        return await direct_proxy(request, BASE_URL_UBUNTU + path)
-    if path.startswith("/ubuntu-ports/"):
-        return await direct_proxy(request, BASE_URL_UBUNTU_PORTS + path)
+        target_url = BASE_URL_ALPINE + path
+    elif path.startswith("/ubuntu/"):
+        target_url = BASE_URL_UBUNTU + path
+    elif path.startswith("/ubuntu-ports/"):
+        target_url = BASE_URL_UBUNTU_PORTS + path
+    else:
+        return Response("Not Found", status_code=404)
+
+    if request.method == "GET" and (
+        package_regex.match(path) or by_hash_regex.match(path)
+    ):
+        return await try_file_based_cache(request, target_url)
+
+    if request.method in ("GET", "HEAD") and index_regex.match(path):
+        return await serve_cached_metadata(
+            request,
+            index_cache,
+            target_url,
+            target_url,
+            keep_headers=INDEX_KEEP_HEADERS,
+        )
 
-    return Response("Not Found", status_code=404)
+    return await direct_proxy(request, target_url)
@@ -1,5 +1,10 @@
+import asyncio
+import dataclasses
+import functools
+import hashlib
 import logging
 import re
+import typing
 
 from mirrorsrun.config import (
     BASE_URL_DOCKERHUB,
@@ -7,9 +12,23 @@ from mirrorsrun.config import (
     BASE_URL_QUAY,
     BASE_URL_GHCR,
     BASE_URL_NVCR,
+    DOCKER_TAG_MANIFEST_STALE_TTL,
+    DOCKER_TAG_MANIFEST_TTL,
+    DOCKER_LAYER_PREFETCH,
+    DOCKER_MANIFEST_CACHE_MAX_ENTRIES,
 )
+from mirrorsrun.docker_prefetch import layer_prefetcher
+from mirrorsrun.docker_realms import parse_bearer_challenge, realm_registry
+from mirrorsrun.proxy.blob_store import adopt_legacy_blob, get_blob_path, parse_digest
 from mirrorsrun.proxy.direct import direct_proxy
-from mirrorsrun.proxy.file_cache import try_file_based_cache
+from mirrorsrun.proxy.file_cache import get_cache_file_and_folder, try_file_based_cache
+from mirrorsrun.proxy.metadata_cache import (
+    MetadataCache,
+    get_forward_headers,
+    head_upstream,
+    serve_cached_metadata,
+)
+from mirrorsrun.proxy.token_cache import token_cache
 from starlette.requests import Request
 from starlette.responses import Response
 
@@ -18,12 +37,58 @@ logger = logging.getLogger(__name__)
 
 HEADER_AUTH_KEY = "www-authenticate"
 
-mirror_root_realm_mapping = {}
-
 # https://github.com/opencontainers/distribution-spec/blob/main/spec.md
 name_regex = "[a-z0-9]+((.|_|__|-+)[a-z0-9]+)*(/[a-z0-9]+((.|_|__|-+)[a-z0-9]+)*)*"
 reference_regex = "[a-zA-Z0-9_][a-zA-Z0-9._-]{0,127}"
 
+HEADER_DIGEST_KEY = "docker-content-digest"
+
+# 按 digest 获取的 manifest 不可变
+digest_manifest_cache = MetadataCache(
+    "docker-manifest-digest",
+    ttl=None,
+    max_entries=DOCKER_MANIFEST_CACHE_MAX_ENTRIES,
+)
+# tag 可能被重新推送，短期缓存，用 HEAD 比较 Docker-Content-Digest 重新验证（不计入 Docker Hub 限额）
+tag_manifest_cache = MetadataCache(
+    "docker-manifest-tag",
+    ttl=DOCKER_TAG_MANIFEST_TTL,
+    stale_ttl=DOCKER_TAG_MANIFEST_STALE_TTL,
+    head_validator=HEADER_DIGEST_KEY,
+    max_entries=DOCKER_MANIFEST_CACHE_MAX_ENTRIES,
+)
+
+MANIFEST_FORWARD_HEADERS = ("accept", "user-agent", "authorization")
+# 401 时保留认证信息，与直接代理时的行为一致
+MANIFEST_KEEP_HEADERS = ("content-type", HEADER_DIGEST_KEY, HEADER_AUTH_KEY)
+
+
+def is_private_pull(request_headers: typing.Dict[str, str]) -> bool:
+    """带凭证拉取的镜像可能是私有的"""
+    return not token_cache.is_anonymous(request_headers.get("authorization", ""))
+
+
+def tag_manifest_key(
+    base_url: str, name: str, reference: str, request_headers: typing.Dict[str, str]
+) -> str:
+    """
+    同一个 tag 按 Accept 可能返回 manifest list 或单个平台的 manifest；
+    带凭证拉取的按凭证身份分开缓存，同一个凭证先后拿到的 token 共享缓存
+    """
+    accept = request_headers.get("accept", "")
+    key = f"{base_url}|{name}|{reference}|{accept}"
+    identity = token_cache.get_identity(request_headers.get("authorization", ""))
+    return f"{key}|{identity}" if identity else key
+
+
+def digest_manifest_key(base_url: str, name: str, digest: str, private: bool) -> str:
+    """
+    按 digest 的 manifest 内容不可变，只按镜像和 digest 区分；
+    带凭证拉取的放在所有凭证共享的私有空间，返回前由上游确认客户端有权访问
+    """
+    key = f"{base_url}|{name}|{digest}"
+    return f"{key}|private" if private else key
+
 
 def try_extract_image_name(path):
     pattern = r"^/v2/(.*)/([a-zA-Z]+)/(.*)$"
@@ -40,25 +105,20 @@ def try_extract_image_name(path):
     return None, None, None
 
 
-def patch_auth_realm(request: Request, response: Response):
+def patch_auth_realm(request: Request, response: Response, base_url: str):
     # https://registry-1.docker.io/v2/
     # < www-authenticate: Bearer realm="https://auth.docker.io/token",service="registry.docker.io"
 
     auth = response.headers.get(HEADER_AUTH_KEY, "")
-    if auth.startswith("Bearer "):
-        parts = auth.removeprefix("Bearer ").split(",")
-
-        auth_values = {}
-        for value in parts:
-            key, value = value.split("=")
-            value = value.strip('"')
-            auth_values[key] = value
-
+    auth_values = parse_bearer_challenge(auth)
+    if auth_values is not None:
         realm = auth_values.get("realm", "")
         assert realm, f"realm not found in {auth}"
 
+        # 顺便更新已发现的 realm
+        realm_registry.record(base_url, realm, auth_values.get("service", ""))
+
         mirror_root = f"{request.url.scheme}://{request.url.netloc}"
-        mirror_root_realm_mapping[mirror_root] = realm
 
         new_token_url = mirror_root + "/token"
         response.headers[HEADER_AUTH_KEY] = auth.replace(realm, new_token_url)
@@ -66,7 +126,127 @@ def patch_auth_realm(request: Request, response: Response):
     return response
 
 
+async def serve_manifest(
+    request: Request, base_url: str, name: str, reference: str, target_url: str
+) -> Response:
+    request_headers = get_forward_headers(request, MANIFEST_FORWARD_HEADERS)
+    if parse_digest(reference) is None:
+        cache = tag_manifest_cache
+        key = tag_manifest_key(base_url, name, reference, request_headers)
+    else:
+        cache = digest_manifest_cache
+        # 匿名拉取过的 manifest 是公开的，带凭证的请求也可以直接使用
+        key = digest_manifest_key(base_url, name, reference, private=False)
+        if is_private_pull(request_headers) and await cache.get(key) is None:
+            key = digest_manifest_key(base_url, name, reference, private=True)
+            if await cache.get(key) is not None:
+                denied = await authorize_upstream(target_url, request_headers)
+                if denied is not None:
+                    return denied
+
+    response = await serve_cached_metadata(
+        request,
+        cache,
+        key,
+        target_url,
+        forward_headers=MANIFEST_FORWARD_HEADERS,
+        keep_headers=MANIFEST_KEEP_HEADERS,
+    )
+
+    if cache is tag_manifest_cache and response.headers.get("x-cache") == "MISS":
+        await seed_digest_manifest(key, base_url, name, request_headers)
+
+    if (
+        DOCKER_LAYER_PREFETCH
+        and request.method == "GET"
+        and response.status_code == 200
+    ):
+        schedule_layer_prefetch(request, base_url, name, response)
+
+    return response
+
+
+async def authorize_upstream(
+    target_url: str, request_headers: typing.Dict[str, str]
+) -> typing.Optional[Response]:
+    """
+    用客户端的凭证向上游发送 HEAD（不计入 Docker Hub 限额），确认客户端有权访问
+
+    Returns:
+        有权访问时返回 None，否则返回上游的响应（例如带认证信息的 401）
+    """
+    response = await head_upstream(target_url, request_headers, MANIFEST_KEEP_HEADERS)
+    return None if response.status_code == 200 else response
+
+
+async def seed_digest_manifest(
+    tag_key: str, base_url: str, name: str, request_headers: typing.Dict[str, str]
+):
+    """按 tag 获取的 manifest 同时按 Docker-Content-Digest 缓存，客户端随后按 digest 拉取时无需再请求上游"""
+    entry = await tag_manifest_cache.get(tag_key)
+    if entry is None or entry.status_code != 200 or entry.encoding:
+        return
+    digest = entry.headers.get(HEADER_DIGEST_KEY, "")
+    parsed = parse_digest(digest)
+    if parsed is None:
+        return
+    algorithm, hex_digest = parsed
+    if hashlib.new(algorithm, entry.body).hexdigest() != hex_digest:
+        logger.warning(f"{HEADER_DIGEST_KEY} of {tag_key} does not match its body")
+        return
+
+    key = digest_manifest_key(
+        base_url, name, digest, private=is_private_pull(request_headers)
+    )
+    if await digest_manifest_cache.get(key) is None:
+        await digest_manifest_cache.put(
+            dataclasses.replace(
+                entry, key=key, url=base_url + f"/v2/{name}/manifests/{digest}"
+            )
+        )
+
+
+# 持有后台预取任务，避免任务在完成前被回收
+_prefetch_tasks: typing.Set[asyncio.Task] = set()
+
+
+def schedule_layer_prefetch(
+    request: Request, base_url: str, name: str, response: Response
+):
+    async def fetch_manifest(digest: str) -> typing.Optional[bytes]:
+        # manifest list 中选中的 manifest 也放入缓存，客户端随后会按 digest 请求它
+        request_headers = get_forward_headers(request, MANIFEST_FORWARD_HEADERS)
+        key = digest_manifest_key(
+            base_url, name, digest, private=is_private_pull(request_headers)
+        )
+        entry = await digest_manifest_cache.get(key)
+        if entry is None:
+            entry = await digest_manifest_cache.fetch(
+                key,
+                base_url + f"/v2/{name}/manifests/{digest}",
+                request_headers,
+                keep_headers=MANIFEST_KEEP_HEADERS,
+            )
+        return entry.body if entry.status_code == 200 else None
+
+    task = asyncio.create_task(
+        layer_prefetcher.prefetch(
+            request,
+            base_url,
+            name,
+            response.body,
+            response.headers.get("content-type", ""),
+            fetch_manifest,
+        )
+    )
+    _prefetch_tasks.add(task)
+    task.add_done_callback(_prefetch_tasks.discard)
+
+
 def build_docker_registry_handler(base_url: str, name_mapper=lambda x: x):
+    # 启动时发现该 registry 的认证 realm
+    realm_registry.register(base_url)
+
     async def handler(request: Request):
         path = request.url.path
         if path == "/token":
@@ -86,6 +266,15 @@ def build_docker_registry_handler(base_url: str, name_mapper=lambda x: x):
             if not scope:
                 return Response(content="Bad Request", status_code=400)
 
+            realm_info = await realm_registry.resolve(base_url)
+            if realm_info is None:
+                return Response(
+                    content=f"Auth realm of {base_url} is unknown",
+                    status_code=502,
+                )
+            realm = realm_info.realm
+            service = service or realm_info.service
+
             new_params = {
                 "scope": scope,
             }
@@ -94,14 +283,15 @@ def build_docker_registry_handler(base_url: str, name_mapper=lambda x: x):
 
             query = "&".join([f"{k}={v}" for k, v in new_params.items()])
 
-            mirror_root = f"{request.url.scheme}://{request.url.netloc}"
-            realm = mirror_root_realm_mapping[mirror_root]
-
-            return await direct_proxy(request, realm + "?" + query)
+            return await token_cache.get_token(
+                request, realm, service, scope, realm + "?" + query
+            )
 
         if path == "/v2/":
             return await direct_proxy(
-                request, base_url + "/v2/", post_process=patch_auth_realm
+                request,
+                base_url + "/v2/",
+                post_process=functools.partial(patch_auth_realm, base_url=base_url),
             )
 
         if not path.startswith("/v2/"):
@@ -120,8 +310,20 @@ def build_docker_registry_handler(base_url: str, name_mapper=lambda x: x):
             f"got docker request, {path=} {name=} {resource=} {reference=} {target_url=}"
         )
 
+        if resource == "manifests" and request.method in ("GET", "HEAD"):
+            return await serve_manifest(request, base_url, name, reference, target_url)
+
         if resource == "blobs":
-            return await try_file_based_cache(request, target_url)
+            # 按 digest 保存，所有镜像名和 registry 共用同一份文件
+            blob_file = get_blob_path(reference)
+            if blob_file is None:
+                return await try_file_based_cache(request, target_url)
+
+            legacy_file, _ = get_cache_file_and_folder(target_url)
+            adopt_legacy_blob(legacy_file, blob_file)
+            return await try_file_based_cache(
+                request, target_url, cache_file=blob_file, expected_digest=reference
+            )
 
         return await direct_proxy(
             request,
@@ -1,11 +1,44 @@
+import re
+
 from starlette.requests import Request
+from starlette.responses import Response
 
+from mirrorsrun.config import GOPROXY_LIST_STALE_TTL, GOPROXY_LIST_TTL
 from mirrorsrun.proxy.direct import direct_proxy
-from starlette.responses import Response
+from mirrorsrun.proxy.file_cache import try_file_based_cache
+from mirrorsrun.proxy.metadata_cache import MetadataCache, serve_cached_metadata
+
+# https://go.dev/ref/mod#goproxy-protocol
+# <module>/@v/<version>.zip|.mod|.info 的内容不可变
+module_file_regex = re.compile(r"^/.+/@v/[^/]+\.(zip|mod|info)$")
+# <module>/@v/list 和 <module>/@latest 会随新版本发布而变化
+module_list_regex = re.compile(r"^/.+/(@v/list|@latest)$")
+# checksum database 的 tile 和 lookup 结果不可变
+# https://go.dev/design/25530-sumdb#checksum-database
+sumdb_immutable_regex = re.compile(r"^/(tile|lookup)/")
+
+# 响应内容与镜像地址无关，直接以路径作为缓存键
+module_file_cache = MetadataCache("goproxy-module", ttl=None)
+module_list_cache = MetadataCache(
+    "goproxy-list", ttl=GOPROXY_LIST_TTL, stale_ttl=GOPROXY_LIST_STALE_TTL
+)
+sumdb_cache = MetadataCache("goproxy-sumdb", ttl=None)
+
+UPSTREAM_URL = "https://proxy.golang.org"
+
+
+def escape_module_path(path: str) -> str:
+    """模块路径和版本中的大写字母编码为 ! 加小写字母（case-encoding）"""
+    return re.sub(r"[A-Z]", lambda m: "!" + m.group(0).lower(), path)
+
+
+def get_module_zip_url(module: str, version: str) -> str:
+    return UPSTREAM_URL + f"/{escape_module_path(module)}/@v/{escape_module_path(version)}.zip"
 
 
 async def goproxy(request: Request):
     path = request.url.path
+    cacheable = request.method in ("GET", "HEAD") and "authorization" not in request.headers
 
     sumdb_prefix = "/sumdb/sum.golang.org"
     if path.startswith(sumdb_prefix):
@@ -15,15 +48,27 @@ async def goproxy(request: Request):
                 content=b"",
             )
         target_url = "https://sum.golang.org" + sumdb_path
+        if cacheable and sumdb_immutable_regex.match(sumdb_path):
+            return await serve_cached_metadata(request, sumdb_cache, sumdb_path, target_url)
         return await direct_proxy(
             request,
             target_url,
         )
 
-    target_url = "https://proxy.golang.org" + path
+    target_url = UPSTREAM_URL + path
+
+    match = module_file_regex.match(path)
+    if cacheable and match:
+        if match.group(1) == "zip":
+            if request.method == "GET":
+                return await try_file_based_cache(request, target_url)
+        else:
+            # .mod / .info 很小，不经过 aria2；同时保留上游的 404/410，go 命令据此回退
+            return await serve_cached_metadata(request, module_file_cache, path, target_url)
+    elif cacheable and module_list_regex.match(path):
+        return await serve_cached_metadata(request, module_list_cache, path, target_url)
 
     return await direct_proxy(
         request,
         target_url,
     )
-
@@ -1,10 +1,87 @@
+import re
+import typing
+
 from starlette.requests import Request
 
-from mirrorsrun.config import BASE_URL_NPM
-from mirrorsrun.proxy.direct import direct_proxy
+from mirrorsrun.config import (
+    BASE_URL_NPM,
+    NPM_PACKUMENT_COMPRESSION,
+    NPM_PACKUMENT_STALE_TTL,
+    NPM_PACKUMENT_TTL,
+)
+from mirrorsrun.proxy.direct import direct_proxy, replace_in_stream
+from mirrorsrun.proxy.file_cache import try_file_based_cache
+from mirrorsrun.proxy.metadata_cache import MetadataCache, serve_cached_metadata
+
+# /<pkg>/-/<name>-<version>.tgz 或 /@scope/<pkg>/-/<name>-<version>.tgz
+tarball_regex = re.compile(r"^/(@[^/]+/)?[^/@]+/-/[^/]+\.tgz$")
+
+# https://github.com/npm/registry/blob/main/docs/responses/package-metadata.md
+ABBREVIATED_ACCEPT = "application/vnd.npm.install-v1+json"
+ACCEPT_VARIANTS = {
+    "abbreviated": f"{ABBREVIATED_ACCEPT}; q=1.0, application/json; q=0.8, */*",
+    "full": "application/json",
+}
+
+packument_cache = MetadataCache(
+    "npm-packument",
+    ttl=NPM_PACKUMENT_TTL,
+    stale_ttl=NPM_PACKUMENT_STALE_TTL,
+    compression=NPM_PACKUMENT_COMPRESSION,
+)
+
+
+def npm_replace_stream(
+    request: Request, chunks: typing.AsyncIterator[bytes]
+) -> typing.AsyncIterator[bytes]:
+    # packument 中 dist.tarball 指向上游 registry，改为指向镜像
+    mirror_url = f"{request.url.scheme}://{request.url.netloc}"
+    return replace_in_stream(chunks, BASE_URL_NPM.encode(), mirror_url.encode())
+
+
+def is_packument_path(path: str) -> bool:
+    # /<pkg>、/@scope/<pkg>、/@scope%2f<pkg>，/-/ 开头的是 registry 的其他接口
+    return not path.startswith("/-/") and "/-/" not in path
+
+
+async def serve_packument(request: Request, target_url: str):
+    # 缓存按包名和 Accept 变体（完整 / 精简）区分，内容中的 tarball 地址已替换为镜像
+    mirror_url = f"{request.url.scheme}://{request.url.netloc}"
+    accept = request.headers.get("accept", "")
+    variant = "abbreviated" if ABBREVIATED_ACCEPT in accept else "full"
+    key = f"{mirror_url}|{variant}|{request.url.path}"
+
+    def rewrite(body: bytes) -> bytes:
+        return body.replace(BASE_URL_NPM.encode(), mirror_url.encode())
+
+    return await serve_cached_metadata(
+        request,
+        packument_cache,
+        key,
+        target_url,
+        transform=rewrite,
+        upstream_headers={"accept": ACCEPT_VARIANTS[variant]},
+    )
 
 
 async def npm(request: Request):
     path = request.url.path
+    target_url = BASE_URL_NPM + path
+
+    # 带认证信息的请求（私有包）不缓存，避免把私有内容返回给其他客户端
+    authorized = "authorization" in request.headers
+
+    # tarball 不可变，通过文件缓存下载
+    if request.method == "GET" and tarball_regex.match(path):
+        if authorized:
+            return await direct_proxy(request, target_url)
+        return await try_file_based_cache(request, target_url)
+
+    if request.method in ("GET", "HEAD") and is_packument_path(path):
+        if authorized:
+            return await direct_proxy(
+                request, target_url, stream_transform=npm_replace_stream
+            )
+        return await serve_packument(request, target_url)
 
-    return await direct_proxy(request, BASE_URL_NPM + path)
+    return await direct_proxy(request, target_url)
@@ -1,26 +1,230 @@
+import asyncio
+import logging
+import os
 import re
+import time
+import typing
+import zipfile
+from urllib.parse import urlsplit
 
+import anyio
 from starlette.requests import Request
 from starlette.responses import Response
 
-from mirrorsrun.config import BASE_URL_PYPI, BASE_URL_PYPI_FILES
-from mirrorsrun.proxy.direct import direct_proxy
-from mirrorsrun.proxy.file_cache import try_file_based_cache
+from mirrorsrun.config import (
+    BASE_URL_PYPI,
+    BASE_URL_PYPI_FILES,
+    PYPI_PREFETCH,
+    PYPI_SIMPLE_STALE_TTL,
+    PYPI_SIMPLE_TTL,
+)
+from mirrorsrun.proxy.direct import direct_proxy, replace_in_stream
+from mirrorsrun.proxy.file_cache import (
+    DownloadingStatus,
+    get_cache_file_and_folder,
+    lookup_cache_file,
+    prefetch_file,
+    try_file_based_cache,
+)
+from mirrorsrun.proxy.metadata_cache import (
+    MetadataCache,
+    MetadataEntry,
+    make_body_etag,
+    serve_cached_metadata,
+)
+from mirrorsrun.pypi_prefetch import IndexFile, dependency_prefetcher, parse_simple_page
 
+logger = logging.getLogger(__name__)
 
-def pypi_replace(request: Request, response: Response) -> Response:
+package_path_regex = re.compile(
+    r"^/packages/([0-9a-f]{2})/([0-9a-f]{2})/([0-9a-f]{60})/[^/]+$"
+)
+
+simple_page_cache = MetadataCache(
+    "pypi-simple", ttl=PYPI_SIMPLE_TTL, stale_ttl=PYPI_SIMPLE_STALE_TTL
+)
+# PEP 658 的 <file>.metadata 与文件本身一样不可变
+file_metadata_cache = MetadataCache("pypi-metadata", ttl=None)
+
+# pip 请求项目页面时使用的 Accept，预取时用它获取索引，顺便为 pip 之后的请求预热缓存
+PIP_ACCEPT = (
+    "application/vnd.pypi.simple.v1+json, "
+    "application/vnd.pypi.simple.v1+html; q=0.1, "
+    "text/html; q=0.01"
+)
+
+
+def pypi_replace_stream(
+    request: Request, chunks: typing.AsyncIterator[bytes]
+) -> typing.AsyncIterator[bytes]:
     is_detail_page = re.search(r"/simple/([^/]+)/", request.url.path) is not None
     if not is_detail_page:
-        return response
+        return chunks
+
+    mirror_url = f"{request.url.scheme}://{request.url.netloc}"
+    return replace_in_stream(chunks, BASE_URL_PYPI_FILES.encode(), mirror_url.encode())
+
+
+def get_file_digest(path: str) -> typing.Optional[str]:
+    # files.pythonhosted.org 的路径由文件内容的 blake2b-256 组成：
+    # /packages/<h[:2]>/<h[2:4]>/<h[4:]>/<filename>
+    match = package_path_regex.match(path)
+    if match is None:
+        return None
+    return "blake2b_256:" + "".join(match.groups())
+
+
+def get_simple_page_key(mirror_url: str, accept: str, path: str) -> str:
+    # 缓存的是替换过下载地址的内容，因此键里要包含镜像地址和 Accept（HTML / JSON）
+    return f"{mirror_url}|{accept}|{path}"
+
+
+def make_download_url_rewrite(mirror_url: str) -> typing.Callable[[bytes], bytes]:
+    def rewrite(body: bytes) -> bytes:
+        return body.replace(BASE_URL_PYPI_FILES.encode(), mirror_url.encode())
+
+    return rewrite
+
+
+async def serve_simple_page(request: Request, target_url: str) -> Response:
+    mirror_url = f"{request.url.scheme}://{request.url.netloc}"
+    key = get_simple_page_key(
+        mirror_url, request.headers.get("accept", ""), request.url.path
+    )
+
+    return await serve_cached_metadata(
+        request,
+        simple_page_cache,
+        key,
+        target_url,
+        transform=make_download_url_rewrite(mirror_url),
+    )
+
+
+def read_wheel_metadata(wheel_file: str) -> typing.Optional[bytes]:
+    """
+    从 wheel 中读取 *.dist-info/METADATA，与 PyPI 提供的 .metadata 文件内容相同
 
-    if is_detail_page:
-        mirror_url = f"{request.url.scheme}://{request.url.netloc}"
-        content = response.body
-        content = content.replace(BASE_URL_PYPI_FILES.encode(), mirror_url.encode())
-        response.body = content
-        del response.headers["content-length"]
-        del response.headers["content-encoding"]
-        return response
+    zipfile 只读取中央目录和这一个成员，不会读取整个 wheel。
+    """
+    # {distribution}-{version}(-{build})?-{python}-{abi}-{platform}.whl
+    distribution, version = os.path.basename(wheel_file).split("-")[:2]
+    expected = f"{distribution}-{version}.dist-info/METADATA".lower()
+    try:
+        with zipfile.ZipFile(wheel_file) as wheel:
+            candidates = [
+                name
+                for name in wheel.namelist()
+                if name.count("/") == 1 and name.endswith(".dist-info/METADATA")
+            ]
+            if len(candidates) > 1:
+                candidates = [name for name in candidates if name.lower() == expected]
+            if len(candidates) != 1:
+                return None
+            return wheel.read(candidates[0])
+    except (OSError, zipfile.BadZipFile) as e:
+        logger.warning(f"Failed to read metadata from {wheel_file}: {e}")
+        return None
+
+
+async def serve_file_metadata(request: Request, path: str, target_url: str) -> Response:
+    # 已经缓存了 wheel 时直接从中提取，不请求上游
+    wheel_url = target_url.removesuffix(".metadata")
+    if await file_metadata_cache.get(path) is None and wheel_url.endswith(".whl"):
+        wheel_file, _ = get_cache_file_and_folder(wheel_url)
+        if lookup_cache_file(wheel_file) == DownloadingStatus.DOWNLOADED:
+            body = await anyio.to_thread.run_sync(read_wheel_metadata, wheel_file)
+            if body is not None:
+                logger.info(f"Extracted {path} from cached wheel")
+                await file_metadata_cache.put(
+                    MetadataEntry(
+                        key=path,
+                        url=target_url,
+                        status_code=200,
+                        fetched_at=time.time(),
+                        etag=make_body_etag(body),
+                        headers={"content-type": "application/octet-stream"},
+                        body=body,
+                    )
+                )
+
+    return await serve_cached_metadata(request, file_metadata_cache, path, target_url)
+
+
+async def load_file_metadata(path: str, user_agent: str) -> typing.Optional[bytes]:
+    """获取 /packages/ 下某个文件的 METADATA，已缓存 wheel 时从中提取"""
+    metadata_path = path + ".metadata"
+    entry = await file_metadata_cache.get(metadata_path)
+    if entry is None:
+        wheel_file, _ = get_cache_file_and_folder(BASE_URL_PYPI_FILES + path)
+        if (
+            path.endswith(".whl")
+            and lookup_cache_file(wheel_file) == DownloadingStatus.DOWNLOADED
+        ):
+            return await anyio.to_thread.run_sync(read_wheel_metadata, wheel_file)
+        entry = await file_metadata_cache.fetch(
+            metadata_path,
+            BASE_URL_PYPI_FILES + metadata_path,
+            {"user-agent": user_agent},
+        )
+    return entry.body if entry.status_code == 200 else None
+
+
+# 持有后台预取任务，避免任务在完成前被回收
+_prefetch_tasks: typing.Set[asyncio.Task] = set()
+
+
+def schedule_dependency_prefetch(request: Request, path: str):
+    mirror_url = f"{request.url.scheme}://{request.url.netloc}"
+    user_agent = request.headers.get("user-agent", "")
+
+    def get_file_path(file: IndexFile) -> typing.Optional[str]:
+        # 索引中的下载地址已被替换为镜像地址
+        file_path = urlsplit(file.url).path
+        return file_path if file_path.startswith("/packages/") else None
+
+    async def load_index(project: str) -> typing.List[IndexFile]:
+        page_path = f"/simple/{project}/"
+        key = get_simple_page_key(mirror_url, PIP_ACCEPT, page_path)
+        entry = await simple_page_cache.get(key)
+        if entry is None or not simple_page_cache.is_fresh(entry):
+            entry = await simple_page_cache.fetch(
+                key,
+                BASE_URL_PYPI + page_path,
+                {"accept": PIP_ACCEPT, "user-agent": user_agent},
+                transform=make_download_url_rewrite(mirror_url),
+            )
+        if entry.status_code != 200:
+            return []
+        return parse_simple_page(entry.body, entry.headers.get("content-type", ""))
+
+    async def load_metadata(file: IndexFile) -> typing.Optional[bytes]:
+        file_path = get_file_path(file)
+        if file_path is None:
+            return None
+        return await load_file_metadata(file_path, user_agent)
+
+    async def start_download(file: IndexFile) -> typing.Optional[asyncio.Task]:
+        file_path = get_file_path(file)
+        if file_path is None:
+            return None
+        flight = await prefetch_file(request, BASE_URL_PYPI_FILES + file_path)
+        return flight.task if flight is not None else None
+
+    async def prefetch():
+        try:
+            metadata = await load_file_metadata(path, user_agent)
+        except Exception as e:
+            logger.warning(f"Failed to load metadata of {path}: {e}")
+            return
+        if metadata is not None:
+            await dependency_prefetcher.prefetch(
+                request, metadata, load_index, load_metadata, start_download
+            )
+
+    task = asyncio.create_task(prefetch())
+    _prefetch_tasks.add(task)
+    task.add_done_callback(_prefetch_tasks.discard)
 
 
 async def pypi(request: Request) -> Response:
@@ -37,7 +241,28 @@ async def pypi(request: Request) -> Response:
     else:
         return Response(content="Not Found", status_code=404)
 
+    if path.startswith("/packages/") and path.endswith(".metadata"):
+        if request.method in ("GET", "HEAD"):
+            return await serve_file_metadata(request, path, target_url)
+
     if path.endswith(".whl") or path.endswith(".tar.gz"):
-        return await try_file_based_cache(request, target_url)
+        if (
+            PYPI_PREFETCH
+            and path.endswith(".whl")
+            and request.method == "GET"
+            and dependency_prefetcher.available()
+        ):
+            schedule_dependency_prefetch(request, path)
+        return await try_file_based_cache(
+            request, target_url, expected_digest=get_file_digest(path)
+        )
+
+    # 带认证信息的请求不缓存，避免把私有内容返回给其他客户端
+    is_detail_page = re.search(r"^/simple/([^/]+)/$", path) is not None
+    cacheable = (
+        request.method in ("GET", "HEAD") and "authorization" not in request.headers
+    )
+    if is_detail_page and cacheable:
+        return await serve_simple_page(request, target_url)
 
-    return await direct_proxy(request, target_url, post_process=pypi_replace)
+    return await direct_proxy(request, target_url, stream_transform=pypi_replace_stream)
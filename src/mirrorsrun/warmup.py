@@ -0,0 +1,661 @@
+"""
+批量预热缓存
+
+把锁文件或镜像列表解析为上游文件地址（与各站点处理请求时使用的地址和缓存路径相同），
+将尚未缓存的文件分批提交给 aria2（并发提交会合并为 system.multicall），并报告进度和吞吐量。
+新节点上线前可以通过 scripts/cache_warm.py 调用管理接口预热。
+
+支持的输入：
+- requirements: requirements.txt，只处理 == 固定的版本，带 --hash 时只预热对应的文件
+- poetry: poetry.lock
+- npm: package-lock.json
+- gosum: go.sum
+- docker: 每行一个镜像引用，例如 nginx:1.25、ghcr.io/org/app@sha256:...
+"""
+
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+import typing
+from dataclasses import dataclass, field
+from urllib.parse import urlparse, urlsplit
+
+from mirrorsrun.config import (
+    BASE_URL_DOCKERHUB,
+    BASE_URL_GHCR,
+    BASE_URL_K8S,
+    BASE_URL_NPM,
+    BASE_URL_NVCR,
+    BASE_URL_PYPI,
+    BASE_URL_PYPI_FILES,
+    BASE_URL_QUAY,
+    DOCKER_PREFETCH_PLATFORM,
+)
+from mirrorsrun.aria2_api import DownloadPriority
+from mirrorsrun.docker_prefetch import (
+    INDEX_MEDIA_TYPES,
+    MANIFEST_MEDIA_TYPES,
+    get_blob_digests,
+    get_media_type,
+    select_platform_manifest,
+)
+from mirrorsrun.docker_realms import realm_registry
+from mirrorsrun.proxy.blob_store import get_blob_path, parse_digest
+from mirrorsrun.proxy.direct import get_upstream_client
+from mirrorsrun.proxy.file_cache import (
+    DownloadingStatus,
+    get_cache_file_and_folder,
+    lookup_cache_file,
+    prefetch_file,
+)
+from mirrorsrun.proxy.singleflight import download_flights
+from mirrorsrun.sites.docker import (
+    MANIFEST_KEEP_HEADERS,
+    digest_manifest_cache,
+    digest_manifest_key,
+    dockerhub_name_mapper,
+)
+from mirrorsrun.sites.goproxy import get_module_zip_url
+from mirrorsrun.sites.npm import tarball_regex
+
+logger = logging.getLogger(__name__)
+
+WARM_KINDS = ("requirements", "poetry", "npm", "gosum", "docker")
+
+# 一次提交的文件数，与 aria2 RPC 合并的上限一致
+SUBMIT_BATCH_SIZE = 100
+# 同时解析的条目数（请求 PyPI 索引、docker manifest）
+RESOLVE_CONCURRENCY = 8
+# 进度报告间隔（秒）
+REPORT_INTERVAL = 2
+# 等待单个文件下载完成的最长时间（秒）
+DOWNLOAD_WAIT_TIME = 24 * 3600
+# 拉取 token 在提交时写入 aria2 的请求头，在队列中等待太久的任务开始时 token 已经过期
+# （Docker Hub 约 300 秒）。因此每个镜像同时只提交这么多个 blob，前面的下载结束后再提交
+DOCKER_BLOBS_PER_TOKEN = 4
+# token 获取后超过这个时长（秒）再提交时重新获取
+PULL_TOKEN_MAX_AGE = 60
+
+
+class PullAuth:
+    """一个镜像的匿名拉取凭证：限制同时提交的 blob 数，token 变旧后重新获取"""
+
+    def __init__(self, base_url: str, name: str, window: int = DOCKER_BLOBS_PER_TOKEN):
+        self.base_url = base_url
+        self.name = name
+        self.slots = asyncio.Semaphore(window)
+        self._token: typing.Optional[str] = None
+        self._fetched_at = 0.0
+        self._lock = asyncio.Lock()
+
+    async def headers(self) -> typing.Dict[str, str]:
+        async with self._lock:
+            if time.time() - self._fetched_at > PULL_TOKEN_MAX_AGE:
+                self._token = await get_pull_token(self.base_url, self.name)
+                self._fetched_at = time.time()
+        return {"authorization": f"Bearer {self._token}"} if self._token else {}
+
+
+@dataclass
+class WarmTarget:
+    """一个需要预热的文件"""
+
+    url: str
+    # 默认由 url 推导
+    cache_file: typing.Optional[str] = None
+    # 发送给上游的请求头
+    headers: typing.Dict[str, str] = field(default_factory=dict)
+    # 需要认证时在提交前取得请求头，并占用一个名额直到下载结束
+    auth: typing.Optional[PullAuth] = None
+
+
+@dataclass
+class PinnedDistribution:
+    """锁定版本的 Python 发行版"""
+
+    name: str
+    version: str
+    # 允许的 sha256（requirements.txt 的 --hash），为空时不限制
+    hashes: typing.Set[str] = field(default_factory=set)
+    # 允许的文件名（poetry.lock），为空时不限制
+    filenames: typing.Set[str] = field(default_factory=set)
+
+
+def canonicalize_name(name: str) -> str:
+    # https://packaging.python.org/en/latest/specifications/name-normalization/
+    return re.sub(r"[-_.]+", "-", name).lower()
+
+
+def split_dist_filename(filename: str) -> typing.Optional[typing.Tuple[str, str]]:
+    """
+    Returns:
+        (名称, 版本)，无法识别时返回 None
+    """
+    if filename.endswith(".whl"):
+        parts = filename[: -len(".whl")].split("-")
+        return (parts[0], parts[1]) if len(parts) >= 5 else None
+    for extension in (".tar.gz", ".zip", ".tar.bz2"):
+        if filename.endswith(extension):
+            name, _, version = filename[: -len(extension)].rpartition("-")
+            return (name, version) if name else None
+    return None
+
+
+def parse_requirements_txt(
+    text: str,
+) -> typing.Tuple[typing.List[PinnedDistribution], typing.List[str]]:
+    """
+    Returns:
+        (固定了版本的发行版, 无法处理的行)
+    """
+    distributions, unresolved = [], []
+    # 续行
+    text = re.sub(r"\\[ \t]*\r?\n", " ", text)
+    for line in text.splitlines():
+        line = re.sub(r"(^|\s)#.*$", "", line).strip()
+        if not line:
+            continue
+        if line.startswith("-"):
+            # -r / -c / --index-url 等选项
+            unresolved.append(line)
+            continue
+
+        hashes = set(re.findall(r"--hash[=\s]+sha256:([0-9a-fA-F]{64})", line))
+        requirement = re.split(r"\s+--", line)[0].split(";")[0].strip()
+        match = re.match(
+            r"^([A-Za-z0-9][A-Za-z0-9._-]*)\s*(\[[^\]]*\])?\s*===?\s*([^\s,]+)$",
+            requirement,
+        )
+        if match is None:
+            unresolved.append(requirement)
+            continue
+        distributions.append(
+            PinnedDistribution(
+                match.group(1), match.group(3), {h.lower() for h in hashes}
+            )
+        )
+    return distributions, unresolved
+
+
+def parse_poetry_lock(
+    text: str,
+) -> typing.Tuple[typing.List[PinnedDistribution], typing.List[str]]:
+    """
+    Returns:
+        (来自 PyPI 的发行版, 来自其他源的包)
+    """
+    distributions, unresolved = [], []
+    for block in text.split("[[package]]")[1:]:
+        # 最后一个包之后是 [metadata]
+        block = re.split(r"^\[metadata", block, flags=re.MULTILINE)[0]
+        name = re.search(r'^name = "([^"]+)"', block, re.MULTILINE)
+        version = re.search(r'^version = "([^"]+)"', block, re.MULTILINE)
+        if name is None or version is None:
+            continue
+        if re.search(r"^\[package\.source\]", block, re.MULTILINE):
+            # git / url / 私有源
+            unresolved.append(f"{name.group(1)}=={version.group(1)}")
+            continue
+        distributions.append(
+            PinnedDistribution(
+                name.group(1),
+                version.group(1),
+                filenames=set(re.findall(r'file = "([^"]+)"', block)),
+            )
+        )
+    return distributions, unresolved
+
+
+def parse_package_lock(
+    text: str,
+) -> typing.Tuple[typing.List[WarmTarget], typing.List[str]]:
+    """
+    Returns:
+        (tarball, 不在 registry 上的依赖)
+    """
+    data = json.loads(text)
+    resolved: typing.Dict[str, str] = {}
+
+    def entries(value) -> typing.Dict[str, dict]:
+        value = value or {}
+        if not isinstance(value, dict) or not all(
+            isinstance(info, dict) and isinstance(info.get("resolved", ""), str)
+            for info in value.values()
+        ):
+            raise ValueError("malformed package-lock.json")
+        return value
+
+    if not isinstance(data, dict):
+        raise ValueError("malformed package-lock.json")
+
+    # lockfileVersion 2/3
+    packages = entries(data.get("packages"))
+    for key, info in packages.items():
+        if key and not info.get("link"):
+            resolved[key] = info.get("resolved", "")
+
+    # lockfileVersion 1
+    def walk(dependencies: typing.Dict[str, dict], prefix: str):
+        for name, info in dependencies.items():
+            resolved[f"{prefix}{name}"] = info.get("resolved", "")
+            walk(entries(info.get("dependencies")), f"{prefix}{name}/")
+
+    if not packages:
+        walk(entries(data.get("dependencies")), "")
+
+    targets, unresolved, seen = [], [], set()
+    for key, url in resolved.items():
+        path = urlsplit(url).path
+        if not tarball_regex.match(path):
+            # git / file / 本地目录
+            unresolved.append(f"{key} {url}".strip())
+            continue
+        if path not in seen:
+            seen.add(path)
+            targets.append(WarmTarget(BASE_URL_NPM + path))
+    return targets, unresolved
+
+
+def parse_go_sum(text: str) -> typing.List[WarmTarget]:
+    targets, seen = [], set()
+    for line in text.splitlines():
+        parts = line.split()
+        # <module> <version>[/go.mod] <hash>，只有不带 /go.mod 的行需要下载模块 zip
+        if len(parts) != 3 or parts[1].endswith("/go.mod"):
+            continue
+        url = get_module_zip_url(parts[0], parts[1])
+        if url not in seen:
+            seen.add(url)
+            targets.append(WarmTarget(url))
+    return targets
+
+
+def parse_image_list(text: str) -> typing.List[str]:
+    images = []
+    for line in text.splitlines():
+        line = line.split("#")[0].strip()
+        if line:
+            images.append(line)
+    return images
+
+
+def get_docker_registries() -> typing.Dict[str, typing.Tuple[str, typing.Callable]]:
+    """registry 主机名 -> (上游地址, 镜像名映射)"""
+    registries: typing.Dict[str, typing.Tuple[str, typing.Callable]] = {}
+    for base_url in (BASE_URL_K8S, BASE_URL_QUAY, BASE_URL_GHCR, BASE_URL_NVCR):
+        registries[urlparse(base_url).hostname or base_url] = (
+            base_url,
+            lambda name: name,
+        )
+    dockerhub = (BASE_URL_DOCKERHUB, dockerhub_name_mapper)
+    for hostname in (
+        "docker.io",
+        "index.docker.io",
+        urlparse(BASE_URL_DOCKERHUB).hostname or BASE_URL_DOCKERHUB,
+    ):
+        registries[hostname] = dockerhub
+    return registries
+
+
+def parse_image_reference(image: str) -> typing.Optional[typing.Tuple[str, str, str]]:
+    """
+    Returns:
+        (上游地址, 上游的镜像名, tag 或 digest)，不是已配置的 registry 时返回 None
+    """
+    first, _, rest = image.partition("/")
+    if rest and ("." in first or ":" in first or first == "localhost"):
+        hostname = first
+    else:
+        hostname, rest = "docker.io", image
+
+    registry = get_docker_registries().get(hostname)
+    if registry is None:
+        return None
+    base_url, name_mapper = registry
+
+    if "@" in rest:
+        name, reference = rest.split("@", 1)
+    elif ":" in rest.rsplit("/", 1)[-1]:
+        name, reference = rest.rsplit(":", 1)
+    else:
+        name, reference = rest, "latest"
+    return base_url, name_mapper(name), reference
+
+
+async def resolve_distribution(
+    distribution: PinnedDistribution, file_filter: typing.Optional[typing.Pattern]
+) -> typing.List[WarmTarget]:
+    project = canonicalize_name(distribution.name)
+    response = await get_upstream_client().get(
+        f"{BASE_URL_PYPI}/simple/{project}/",
+        headers={"accept": "application/vnd.pypi.simple.v1+json"},
+        follow_redirects=True,
+        timeout=30,
+    )
+    if response.status_code != 200:
+        raise ValueError(f"index returned {response.status_code}")
+
+    targets = []
+    for file in response.json().get("files", []):
+        filename = file["filename"]
+        parsed = split_dist_filename(filename)
+        if parsed is None or canonicalize_name(parsed[0]) != project:
+            continue
+        if parsed[1] != distribution.version:
+            continue
+        if (
+            distribution.hashes
+            and file.get("hashes", {}).get("sha256") not in distribution.hashes
+        ):
+            continue
+        if distribution.filenames and filename not in distribution.filenames:
+            continue
+        if file_filter is not None and not file_filter.search(filename):
+            continue
+        # 与 pypi 站点一致：/packages/... 从 BASE_URL_PYPI_FILES 下载
+        path = urlsplit(file["url"]).path
+        if path.startswith("/packages/"):
+            targets.append(WarmTarget(BASE_URL_PYPI_FILES + path))
+
+    if not targets:
+        raise ValueError("no matching files")
+    return targets
+
+
+async def get_pull_token(base_url: str, name: str) -> typing.Optional[str]:
+    """匿名拉取 token，registry 不需要认证时返回 None"""
+    realm_info = await realm_registry.resolve(base_url)
+    if realm_info is None:
+        return None
+    params = {"scope": f"repository:{name}:pull"}
+    if realm_info.service:
+        params["service"] = realm_info.service
+    response = await get_upstream_client().get(
+        realm_info.realm, params=params, follow_redirects=True, timeout=30
+    )
+    if response.status_code != 200:
+        raise ValueError(f"token service returned {response.status_code}")
+    body = response.json()
+    return body.get("token") or body.get("access_token")
+
+
+async def fetch_image_manifest(
+    base_url: str, name: str, reference: str, headers: typing.Dict[str, str]
+) -> typing.Tuple[dict, str]:
+    """
+    Returns:
+        (manifest, Content-Type)
+    """
+    url = base_url + f"/v2/{name}/manifests/{reference}"
+    if parse_digest(reference) is not None:
+        # 按 digest 获取的 manifest 顺便放入缓存；预热使用匿名 token，内容是公开的
+        key = digest_manifest_key(base_url, name, reference, private=False)
+        entry = await digest_manifest_cache.get(
+            key
+        ) or await digest_manifest_cache.fetch(
+            key, url, headers, keep_headers=MANIFEST_KEEP_HEADERS
+        )
+        status_code, body = entry.status_code, entry.body
+        content_type = entry.headers.get("content-type", "")
+    else:
+        response = await get_upstream_client().get(
+            url, headers=headers, follow_redirects=True, timeout=30
+        )
+        status_code, body = response.status_code, response.content
+        content_type = response.headers.get("content-type", "")
+
+    if status_code != 200:
+        raise ValueError(f"manifest {reference} returned {status_code}")
+    return json.loads(body), content_type
+
+
+async def resolve_image(image: str, platform: str) -> typing.List[WarmTarget]:
+    parsed = parse_image_reference(image)
+    if parsed is None:
+        raise ValueError("registry is not mirrored")
+    base_url, name, reference = parsed
+
+    auth = PullAuth(base_url, name)
+    headers = {
+        "accept": ", ".join(INDEX_MEDIA_TYPES + MANIFEST_MEDIA_TYPES),
+        **await auth.headers(),
+    }
+
+    manifest, content_type = await fetch_image_manifest(
+        base_url, name, reference, headers
+    )
+    if get_media_type(manifest, content_type) in INDEX_MEDIA_TYPES:
+        os_name, _, architecture = platform.partition("/")
+        digest = select_platform_manifest(manifest, os_name, architecture.split("/")[0])
+        if digest is None:
+            raise ValueError(f"no manifest for {platform}")
+        manifest, _ = await fetch_image_manifest(base_url, name, digest, headers)
+
+    # 与 docker 站点一致：blob 按 digest 保存在 blob store
+    return [
+        WarmTarget(
+            base_url + f"/v2/{name}/blobs/{digest}",
+            cache_file=get_blob_path(digest),
+            auth=auth,
+        )
+        for digest in get_blob_digests(manifest)
+        if get_blob_path(digest) is not None
+    ]
+
+
+class WarmJob:
+    """一次预热任务，run() 在执行过程中定期产出进度"""
+
+    def __init__(
+        self,
+        kind: str,
+        content: str,
+        file_filter: typing.Optional[str] = None,
+        platform: str = DOCKER_PREFETCH_PLATFORM,
+    ):
+        """
+        Args:
+            kind: 输入类型，见 WARM_KINDS
+            content: 锁文件或镜像列表的内容
+            file_filter: PyPI 文件名需要匹配的正则，例如 "cp311.*manylinux|none-any"
+            platform: 镜像为 manifest list 时预热的平台
+        """
+        if kind not in WARM_KINDS:
+            raise ValueError(
+                f"unknown kind {kind}, expected one of {', '.join(WARM_KINDS)}"
+            )
+        self.kind = kind
+        self.content = content
+        self.file_filter = re.compile(file_filter) if file_filter else None
+        self.platform = platform
+
+        self.started_at = time.time()
+        self.unresolved: typing.List[str] = []
+        self.files = 0
+        self.cached = 0
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.completed_bytes = 0
+        self._seen: typing.Set[str] = set()
+        self._waits: typing.List[asyncio.Task] = []
+
+    def progress(self) -> dict:
+        elapsed = time.time() - self.started_at
+        return {
+            "kind": self.kind,
+            "elapsed": round(elapsed, 1),
+            "files": self.files,
+            "cached": self.cached,
+            "submitted": self.submitted,
+            "completed": self.completed,
+            "failed": self.failed,
+            "pending": self.submitted - self.completed - self.failed,
+            "completed_mb": round(self.completed_bytes / (1024 * 1024), 2),
+            "throughput_mbs": (
+                round(self.completed_bytes / (1024 * 1024) / elapsed, 2)
+                if elapsed > 0
+                else 0
+            ),
+            "unresolved": self.unresolved,
+        }
+
+    def _resolvers(self) -> typing.List[typing.Tuple[str, typing.Callable]]:
+        """(条目, 返回 WarmTarget 列表的协程函数)"""
+        if self.kind in ("requirements", "poetry"):
+            parse = (
+                parse_requirements_txt
+                if self.kind == "requirements"
+                else parse_poetry_lock
+            )
+            distributions, unresolved = parse(self.content)
+            self.unresolved.extend(unresolved)
+            return [
+                (
+                    f"{d.name}=={d.version}",
+                    lambda d=d: resolve_distribution(d, self.file_filter),
+                )
+                for d in distributions
+            ]
+        if self.kind == "docker":
+            return [
+                (image, lambda image=image: resolve_image(image, self.platform))
+                for image in parse_image_list(self.content)
+            ]
+
+        if self.kind == "npm":
+            targets, unresolved = parse_package_lock(self.content)
+            self.unresolved.extend(unresolved)
+        else:
+            targets = parse_go_sum(self.content)
+
+        async def resolved():
+            return targets
+
+        return [(self.kind, resolved)]
+
+    async def _wait_download(
+        self,
+        cache_file: str,
+        task: typing.Optional[asyncio.Task],
+        slot: typing.Optional[asyncio.Semaphore] = None,
+    ):
+        flight = download_flights.get(cache_file)
+        try:
+            if task is not None:
+                await asyncio.shield(task)
+            elif flight is not None:
+                await flight.wait(DOWNLOAD_WAIT_TIME)
+            else:
+                # 由其他 worker 发起的下载，只能轮询
+                deadline = time.time() + DOWNLOAD_WAIT_TIME
+                while lookup_cache_file(cache_file) == DownloadingStatus.DOWNLOADING:
+                    if time.time() > deadline:
+                        break
+                    await asyncio.sleep(REPORT_INTERVAL)
+        finally:
+            if slot is not None:
+                slot.release()
+
+        if lookup_cache_file(cache_file) == DownloadingStatus.DOWNLOADED:
+            self.completed += 1
+            self.completed_bytes += os.path.getsize(cache_file)
+        else:
+            self.failed += 1
+
+    async def _submit(self, target: WarmTarget):
+        cache_file = target.cache_file or get_cache_file_and_folder(target.url)[0]
+        if cache_file in self._seen:
+            return
+        self._seen.add(cache_file)
+        self.files += 1
+
+        status = lookup_cache_file(cache_file)
+        if status == DownloadingStatus.DOWNLOADED:
+            self.cached += 1
+            return
+
+        slot = target.auth.slots if target.auth is not None else None
+        if slot is not None:
+            await slot.acquire()
+        try:
+            headers = dict(target.headers)
+            if target.auth is not None:
+                headers.update(await target.auth.headers())
+            flight = await prefetch_file(
+                None,
+                target.url,
+                cache_file=cache_file,
+                headers=headers,
+                priority=DownloadPriority.BULK,
+            )
+        except Exception as e:
+            logger.warning(f"Failed to submit {target.url} for warming: {e}")
+            if slot is not None:
+                slot.release()
+            self.failed += 1
+            return
+        if (
+            flight is None
+            and status == DownloadingStatus.NOT_FOUND
+            and (download_flights.get(cache_file) is None)
+        ):
+            # 提交失败
+            if slot is not None:
+                slot.release()
+            self.failed += 1
+            return
+        # 新提交的下载，或者已经在下载中（由客户端请求或其他预取发起）
+        self.submitted += 1
+        self._waits.append(
+            asyncio.create_task(
+                self._wait_download(
+                    cache_file, flight.task if flight is not None else None, slot
+                )
+            )
+        )
+
+    async def _resolve_and_submit(
+        self, item: str, resolve: typing.Callable, semaphore: asyncio.Semaphore
+    ):
+        async with semaphore:
+            try:
+                targets = await resolve()
+            except Exception as e:
+                logger.warning(f"Failed to resolve {item} for warming: {e}")
+                self.unresolved.append(f"{item}: {e}")
+                return
+
+        for start in range(0, len(targets), SUBMIT_BATCH_SIZE):
+            batch = targets[start : start + SUBMIT_BATCH_SIZE]
+            await asyncio.gather(*(self._submit(target) for target in batch))
+
+    async def _run(self):
+        semaphore = asyncio.Semaphore(RESOLVE_CONCURRENCY)
+        await asyncio.gather(
+            *(
+                self._resolve_and_submit(item, resolve, semaphore)
+                for item, resolve in self._resolvers()
+            )
+        )
+        logger.info(
+            f"Warming {self.kind}: {self.files} files, {self.cached} cached, "
+            f"{self.submitted} submitted, {len(self.unresolved)} unresolved"
+        )
+        if self._waits:
+            await asyncio.gather(*self._waits)
+
+    async def run(self) -> typing.AsyncIterator[dict]:
+        worker = asyncio.create_task(self._run())
+        while not worker.done():
+            await asyncio.wait([worker], timeout=REPORT_INTERVAL)
+            progress = self.progress()
+            progress["done"] = worker.done()
+            yield progress
+
+        if worker.exception() is not None:
+            logger.error(f"Warming {self.kind} failed", exc_info=worker.exception())
+            yield {**self.progress(), "done": True, "error": str(worker.exception())}
@@ -0,0 +1,81 @@
+"""
+流式替换响应内容
+"""
+
+import random
+import typing
+import unittest
+
+from mirrorsrun.proxy.direct import replace_in_stream
+
+OLD = b"https://registry.npmjs.org"
+NEW = b"http://mirror.local/npm"
+
+
+async def iterate(chunks: typing.List[bytes]) -> typing.AsyncIterator[bytes]:
+    for chunk in chunks:
+        yield chunk
+
+
+async def replace(chunks: typing.List[bytes], old: bytes = OLD, new: bytes = NEW):
+    return b"".join(
+        [chunk async for chunk in replace_in_stream(iterate(chunks), old, new)]
+    )
+
+
+def split_at(data: bytes, positions: typing.Iterable[int]) -> typing.List[bytes]:
+    bounds = [0, *sorted(positions), len(data)]
+    return [data[start:end] for start, end in zip(bounds, bounds[1:])]
+
+
+class ReplaceInStreamTest(unittest.IsolatedAsyncioTestCase):
+    async def test_single_chunk(self):
+        body = b'{"tarball":"' + OLD + b'/a/-/a-1.0.0.tgz"}'
+        self.assertEqual(await replace([body]), body.replace(OLD, NEW))
+
+    async def test_match_straddling_every_boundary(self):
+        body = b"prefix " + OLD + b" suffix"
+        for position in range(1, len(body)):
+            with self.subTest(position=position):
+                chunks = split_at(body, [position])
+                self.assertEqual(await replace(chunks), body.replace(OLD, NEW))
+
+    async def test_match_spanning_several_chunks(self):
+        body = b"a" + OLD + b"b"
+        # 每个字节一块，匹配跨越几十个块
+        chunks = [body[i : i + 1] for i in range(len(body))]
+        self.assertEqual(await replace(chunks), body.replace(OLD, NEW))
+
+    async def test_adjacent_and_repeated_matches(self):
+        body = OLD + OLD + b"/" + OLD
+        chunks = split_at(body, [len(OLD) - 3, len(OLD) + 5])
+        self.assertEqual(await replace(chunks), NEW + NEW + b"/" + NEW)
+
+    async def test_partial_match_at_end_is_kept(self):
+        body = b"data " + OLD[:-1]
+        chunks = split_at(body, [3, len(body) - 2])
+        self.assertEqual(await replace(chunks), body)
+
+    async def test_no_match_and_empty_chunks(self):
+        chunks = [b"", b"hello", b"", b" world", b""]
+        self.assertEqual(await replace(chunks), b"hello world")
+        self.assertEqual(await replace([]), b"")
+
+    async def test_random_chunking(self):
+        generator = random.Random(0)
+        body = b"".join(
+            generator.choice([OLD, OLD[:10], b"x", b"/", b"registry"])
+            for _ in range(200)
+        )
+        for _ in range(50):
+            positions = generator.sample(range(1, len(body)), generator.randint(1, 40))
+            with self.subTest(positions=positions):
+                chunks = split_at(body, positions)
+                self.assertEqual(await replace(chunks), body.replace(OLD, NEW))
+
+    async def test_single_byte_pattern(self):
+        self.assertEqual(await replace([b"a-b", b"-c"], b"-", b"+"), b"a+b+c")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+Range 和条件请求头的解析
+"""
+
+import email.utils
+import unittest
+
+from starlette.datastructures import Headers
+
+from mirrorsrun.proxy.file_response import is_not_modified, parse_range
+
+FILE_SIZE = 1000
+
+
+class ParseRangeTest(unittest.TestCase):
+    def test_closed_range(self):
+        self.assertEqual(parse_range("bytes=0-99", FILE_SIZE), (0, 99))
+        self.assertEqual(parse_range("bytes=999-999", FILE_SIZE), (999, 999))
+
+    def test_open_ended_range(self):
+        self.assertEqual(parse_range("bytes=100-", FILE_SIZE), (100, 999))
+
+    def test_end_past_file_is_clamped(self):
+        self.assertEqual(parse_range("bytes=900-5000", FILE_SIZE), (900, 999))
+
+    def test_suffix_range(self):
+        self.assertEqual(parse_range("bytes=-100", FILE_SIZE), (900, 999))
+        # 后缀长于文件时返回整个文件
+        self.assertEqual(parse_range("bytes=-5000", FILE_SIZE), (0, 999))
+
+    def test_surrounding_whitespace(self):
+        self.assertEqual(parse_range("  bytes=0-1 ", FILE_SIZE), (0, 1))
+
+    def test_ignored_ranges(self):
+        # 多段、其他单位和无法识别的 Range 按 RFC 9110 忽略，返回整个文件
+        for header in (
+            "bytes=0-1,5-6",
+            "items=0-1",
+            "bytes=-",
+            "bytes=a-b",
+            "bytes=1-2-3",
+            "",
+        ):
+            with self.subTest(header=header):
+                self.assertIsNone(parse_range(header, FILE_SIZE))
+
+    def test_unsatisfiable_ranges(self):
+        for header, file_size in (
+            ("bytes=1000-", FILE_SIZE),
+            ("bytes=1000-2000", FILE_SIZE),
+            ("bytes=5-2", FILE_SIZE),
+            ("bytes=-0", FILE_SIZE),
+            ("bytes=0-", 0),
+            ("bytes=-5", 0),
+        ):
+            with self.subTest(header=header, file_size=file_size):
+                with self.assertRaises(ValueError):
+                    parse_range(header, file_size)
+
+
+class IsNotModifiedTest(unittest.TestCase):
+    ETAG = '"5f3a-3e8"'
+    MTIME = 1700000000.75
+
+    def check(self, **headers: str) -> bool:
+        return is_not_modified(
+            Headers({k.replace("_", "-"): v for k, v in headers.items()}),
+            self.ETAG,
+            self.MTIME,
+        )
+
+    def test_no_conditional_headers(self):
+        self.assertFalse(self.check())
+
+    def test_if_none_match(self):
+        self.assertTrue(self.check(if_none_match=self.ETAG))
+        self.assertTrue(self.check(if_none_match=f'"other", {self.ETAG}'))
+        self.assertTrue(self.check(if_none_match="*"))
+        self.assertFalse(self.check(if_none_match='"other"'))
+
+    def test_if_none_match_uses_weak_comparison(self):
+        self.assertTrue(self.check(if_none_match=f"W/{self.ETAG}"))
+
+    def test_if_none_match_takes_precedence(self):
+        since = email.utils.formatdate(self.MTIME + 60, usegmt=True)
+        self.assertFalse(self.check(if_none_match='"other"', if_modified_since=since))
+
+    def test_if_modified_since(self):
+        # HTTP 日期精确到秒，与文件时间的整数部分比较
+        same_second = email.utils.formatdate(int(self.MTIME), usegmt=True)
+        self.assertTrue(self.check(if_modified_since=same_second))
+        later = email.utils.formatdate(self.MTIME + 60, usegmt=True)
+        self.assertTrue(self.check(if_modified_since=later))
+        earlier = email.utils.formatdate(self.MTIME - 60, usegmt=True)
+        self.assertFalse(self.check(if_modified_since=earlier))
+
+    def test_if_modified_since_without_timezone_is_utc(self):
+        since = email.utils.formatdate(int(self.MTIME), usegmt=True)
+        self.assertTrue(self.check(if_modified_since=since.replace(" GMT", "")))
+
+    def test_invalid_if_modified_since(self):
+        self.assertFalse(self.check(if_modified_since="yesterday"))
+
+
+if __name__ == "__main__":
+    unittest.main()
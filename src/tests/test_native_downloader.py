@@ -0,0 +1,216 @@
+"""
+NativeDownloader 对本地假上游的测试
+
+假上游由 httpx.MockTransport 提供，支持 Range 请求，并可以在指定位置断开连接。
+运行：python -m unittest discover -s tests（或 python -m pytest tests）
+"""
+
+import os
+import re
+import tempfile
+import typing
+import unittest
+from unittest import mock
+
+import httpx
+
+from mirrorsrun.proxy import native_downloader
+from mirrorsrun.proxy.native_downloader import PART_SUFFIX, NativeDownloader
+
+URL = "https://upstream.test/files/blob"
+SEGMENT_SIZE = 64 * 1024
+
+
+class FakeBody(httpx.AsyncByteStream):
+    """分块返回数据，到达 fail_after 字节后断开连接"""
+
+    def __init__(self, data: bytes, fail_after: typing.Optional[int] = None):
+        self.data = data
+        self.fail_after = fail_after
+        self.closed = False
+
+    async def __aiter__(self) -> typing.AsyncIterator[bytes]:
+        sent = 0
+        while sent < len(self.data):
+            if self.fail_after is not None and sent >= self.fail_after:
+                raise httpx.ReadError("connection reset by fake upstream")
+            chunk = self.data[sent : sent + 8192]
+            if self.fail_after is not None:
+                chunk = chunk[: self.fail_after - sent]
+            sent += len(chunk)
+            yield chunk
+
+    async def aclose(self):
+        self.closed = True
+
+
+class FakeUpstream:
+    """按 Range 返回 data 的上游，记录收到的请求"""
+
+    def __init__(self, data: bytes, status_code: int = 200):
+        self.data = data
+        self.status_code = status_code
+        self.ranges: typing.List[typing.Optional[str]] = []
+        self.bodies: typing.List[FakeBody] = []
+        # Range 起始位置 -> 断开前发送的字节数，只生效一次
+        self.fail_ranges: typing.Dict[int, int] = {}
+        # 每个响应都在发送这么多字节后断开
+        self.fail_after: typing.Optional[int] = None
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        range_header = request.headers.get("range")
+        self.ranges.append(range_header)
+        if self.status_code != 200:
+            return httpx.Response(self.status_code, content=b"not found")
+
+        headers = {"accept-ranges": "bytes"}
+        if range_header is None:
+            body = FakeBody(self.data, self.fail_after)
+            headers["content-length"] = str(len(self.data))
+            self.bodies.append(body)
+            return httpx.Response(200, headers=headers, stream=body)
+
+        match = re.match(r"bytes=(\d+)-(\d+)", range_header)
+        assert match is not None
+        start, end = int(match.group(1)), int(match.group(2))
+        fail_after = self.fail_ranges.pop(start, self.fail_after)
+        body = FakeBody(self.data[start : end + 1], fail_after)
+        headers["content-length"] = str(end - start + 1)
+        headers["content-range"] = f"bytes {start}-{end}/{len(self.data)}"
+        self.bodies.append(body)
+        return httpx.Response(206, headers=headers, stream=body)
+
+
+class NativeDownloaderTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_file = os.path.join(self.tmp_dir.name, "cache", "blob")
+        self.downloader = NativeDownloader(
+            max_concurrent=2,
+            max_segments=4,
+            min_segment_size=SEGMENT_SIZE,
+            read_timeout=5,
+        )
+
+    async def asyncTearDown(self):
+        self.tmp_dir.cleanup()
+
+    async def download(self, upstream: FakeUpstream, listener=None):
+        client = httpx.AsyncClient(transport=httpx.MockTransport(upstream.handle))
+        # 缓冲区较小时，中断前收到的数据大多已经落盘，重试从落盘的位置继续
+        with mock.patch.object(
+            native_downloader, "get_upstream_client", return_value=client
+        ), mock.patch.object(
+            native_downloader, "WRITE_BUFFER_SIZE", 1000
+        ), mock.patch.object(
+            native_downloader.asyncio, "sleep", fake_sleep
+        ):
+            download = self.downloader.submit(URL, self.cache_file, {}, priority=0)
+            if listener is not None:
+                download.add_listener(listener)
+            await download.finished.wait()
+        await client.aclose()
+        return download
+
+    async def test_splits_large_file_into_range_segments(self):
+        data = os.urandom(4 * SEGMENT_SIZE + 123)
+        upstream = FakeUpstream(data)
+
+        download = await self.download(upstream)
+
+        self.assertIsNone(download.error)
+        self.assertEqual(len(download.segments), 4)
+        # 第一个分段复用探测请求，其余分段各发一个 Range 请求
+        self.assertIsNone(upstream.ranges[0])
+        self.assertEqual(
+            sorted(upstream.ranges[1:]),
+            sorted(
+                f"bytes={segment.start}-{segment.end}"
+                for segment in download.segments[1:]
+            ),
+        )
+        with open(self.cache_file, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    async def test_small_file_is_not_split(self):
+        data = os.urandom(SEGMENT_SIZE)
+        upstream = FakeUpstream(data)
+
+        download = await self.download(upstream)
+
+        self.assertIsNone(download.error)
+        self.assertEqual(upstream.ranges, [None])
+        with open(self.cache_file, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    async def test_retries_interrupted_segment_from_written_position(self):
+        data = os.urandom(4 * SEGMENT_SIZE)
+        upstream = FakeUpstream(data)
+        # 第二个分段发送 5000 字节后断开
+        upstream.fail_ranges[SEGMENT_SIZE] = 5000
+
+        download = await self.download(upstream)
+
+        self.assertIsNone(download.error)
+        self.assertEqual(len(upstream.ranges), 5)
+        self.assertIn(
+            f"bytes={SEGMENT_SIZE + 5000}-{2 * SEGMENT_SIZE - 1}", upstream.ranges
+        )
+        with open(self.cache_file, "rb") as f:
+            self.assertEqual(f.read(), data)
+
+    async def test_cache_file_appears_only_when_complete(self):
+        data = os.urandom(4 * SEGMENT_SIZE)
+        upstream = FakeUpstream(data)
+        seen_partial_cache_file = []
+
+        def on_progress(download):
+            if not download.finished.is_set():
+                seen_partial_cache_file.append(os.path.exists(self.cache_file))
+
+        download = await self.download(upstream, on_progress)
+
+        self.assertIsNone(download.error)
+        self.assertTrue(seen_partial_cache_file)
+        self.assertFalse(any(seen_partial_cache_file))
+        self.assertTrue(os.path.exists(self.cache_file))
+        self.assertFalse(os.path.exists(self.cache_file + PART_SUFFIX))
+
+    async def test_failed_download_leaves_no_files(self):
+        upstream = FakeUpstream(b"", status_code=404)
+
+        download = await self.download(upstream)
+
+        self.assertEqual(download.error, "upstream returned 404")
+        self.assertFalse(os.path.exists(self.cache_file))
+        self.assertFalse(os.path.exists(self.cache_file + PART_SUFFIX))
+
+    async def test_gives_up_after_retries(self):
+        data = os.urandom(SEGMENT_SIZE)
+        upstream = FakeUpstream(data)
+        # 第一个请求和之后每次重试都在 10 字节后断开
+        upstream.fail_after = 10
+
+        download = await self.download(upstream)
+
+        self.assertIsNotNone(download.error)
+        self.assertEqual(len(upstream.ranges), 1 + native_downloader.SEGMENT_RETRIES)
+        self.assertFalse(os.path.exists(self.cache_file))
+        self.assertFalse(os.path.exists(self.cache_file + PART_SUFFIX))
+
+    async def test_empty_file_releases_connection(self):
+        upstream = FakeUpstream(b"")
+
+        download = await self.download(upstream)
+
+        self.assertIsNone(download.error)
+        self.assertEqual(os.path.getsize(self.cache_file), 0)
+        self.assertTrue(all(body.closed for body in upstream.bodies))
+
+
+async def fake_sleep(delay: float):
+    """重试前不真正等待"""
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,269 @@
+"""
+预热输入（锁文件、镜像列表）的解析
+"""
+
+import json
+import unittest
+
+from mirrorsrun.config import (
+    BASE_URL_DOCKERHUB,
+    BASE_URL_GHCR,
+    BASE_URL_NPM,
+)
+from mirrorsrun.sites.goproxy import get_module_zip_url
+from mirrorsrun.warmup import (
+    parse_go_sum,
+    parse_image_list,
+    parse_image_reference,
+    parse_package_lock,
+    parse_poetry_lock,
+    parse_requirements_txt,
+    split_dist_filename,
+)
+
+SHA_A = "a" * 64
+SHA_B = "B" * 64
+
+
+class ParseRequirementsTest(unittest.TestCase):
+    def test_pinned_versions(self):
+        distributions, unresolved = parse_requirements_txt(
+            "requests==2.31.0\n"
+            "Flask[async] == 3.0.0  # web\n"
+            "urllib3===2.0.7\n"
+            'colorama==0.4.6; sys_platform == "win32"\n'
+        )
+        self.assertEqual(
+            [(d.name, d.version) for d in distributions],
+            [
+                ("requests", "2.31.0"),
+                ("Flask", "3.0.0"),
+                ("urllib3", "2.0.7"),
+                ("colorama", "0.4.6"),
+            ],
+        )
+        self.assertEqual(unresolved, [])
+
+    def test_hashes_on_continuation_lines(self):
+        distributions, _ = parse_requirements_txt(
+            "certifi==2023.7.22 \\\n"
+            f"    --hash=sha256:{SHA_A} \\\n"
+            f"    --hash sha256:{SHA_B}\n"
+        )
+        self.assertEqual(len(distributions), 1)
+        self.assertEqual(distributions[0].hashes, {SHA_A, SHA_B.lower()})
+
+    def test_unpinned_and_options_are_unresolved(self):
+        distributions, unresolved = parse_requirements_txt(
+            "# comment only\n"
+            "\n"
+            "-r base.txt\n"
+            "--index-url https://example.com/simple\n"
+            "django>=4.2\n"
+            "git+https://github.com/org/repo.git\n"
+            "numpy==1.26.*,<2\n"
+        )
+        self.assertEqual(distributions, [])
+        self.assertEqual(
+            unresolved,
+            [
+                "-r base.txt",
+                "--index-url https://example.com/simple",
+                "django>=4.2",
+                "git+https://github.com/org/repo.git",
+                "numpy==1.26.*,<2",
+            ],
+        )
+
+
+class ParsePoetryLockTest(unittest.TestCase):
+    LOCK = """
+[[package]]
+name = "idna"
+version = "3.6"
+description = "Internationalized Domain Names in Applications (IDNA)"
+files = [
+    {file = "idna-3.6-py3-none-any.whl", hash = "sha256:aaa"},
+    {file = "idna-3.6.tar.gz", hash = "sha256:bbb"},
+]
+
+[[package]]
+name = "private-lib"
+version = "1.0.0"
+files = []
+
+[package.source]
+type = "legacy"
+url = "https://pypi.example.com/simple"
+
+[[package]]
+name = "broken"
+
+[metadata]
+lock-version = "2.0"
+content-hash = "ccc"
+
+[metadata.files]
+idna = []
+"""
+
+    def test_packages(self):
+        distributions, unresolved = parse_poetry_lock(self.LOCK)
+        self.assertEqual(
+            [(d.name, d.version) for d in distributions], [("idna", "3.6")]
+        )
+        self.assertEqual(
+            distributions[0].filenames,
+            {"idna-3.6-py3-none-any.whl", "idna-3.6.tar.gz"},
+        )
+        # 来自其他源的包不预热；缺少版本的条目忽略
+        self.assertEqual(unresolved, ["private-lib==1.0.0"])
+
+    def test_not_a_lockfile(self):
+        self.assertEqual(parse_poetry_lock("not a lockfile"), ([], []))
+
+
+class ParsePackageLockTest(unittest.TestCase):
+    TARBALL = "https://registry.npmjs.org/lodash/-/lodash-4.17.21.tgz"
+    SCOPED_TARBALL = "https://registry.npmjs.org/@types/node/-/node-20.10.0.tgz"
+
+    def test_lockfile_v3(self):
+        lock = {
+            "lockfileVersion": 3,
+            "packages": {
+                "": {"name": "app"},
+                "node_modules/lodash": {"resolved": self.TARBALL},
+                # 同一个 tarball 只预热一次
+                "node_modules/a/node_modules/lodash": {"resolved": self.TARBALL},
+                "node_modules/@types/node": {"resolved": self.SCOPED_TARBALL},
+                "node_modules/local": {"resolved": "packages/local", "link": True},
+                "node_modules/forked": {
+                    "resolved": "git+ssh://git@github.com/org/forked.git#abc"
+                },
+            },
+        }
+        targets, unresolved = parse_package_lock(json.dumps(lock))
+        self.assertEqual(
+            [target.url for target in targets],
+            [
+                BASE_URL_NPM + "/lodash/-/lodash-4.17.21.tgz",
+                BASE_URL_NPM + "/@types/node/-/node-20.10.0.tgz",
+            ],
+        )
+        self.assertEqual(
+            unresolved,
+            ["node_modules/forked git+ssh://git@github.com/org/forked.git#abc"],
+        )
+
+    def test_lockfile_v1(self):
+        lock = {
+            "lockfileVersion": 1,
+            "dependencies": {
+                "lodash": {"resolved": self.TARBALL},
+                "parent": {
+                    "resolved": "https://registry.npmjs.org/parent/-/parent-1.0.0.tgz",
+                    "dependencies": {
+                        "child": {"version": "file:../child"},
+                    },
+                },
+            },
+        }
+        targets, unresolved = parse_package_lock(json.dumps(lock))
+        self.assertEqual(
+            [target.url for target in targets],
+            [
+                BASE_URL_NPM + "/lodash/-/lodash-4.17.21.tgz",
+                BASE_URL_NPM + "/parent/-/parent-1.0.0.tgz",
+            ],
+        )
+        self.assertEqual(unresolved, ["parent/child"])
+
+    def test_malformed_lockfiles(self):
+        for text in (
+            "",
+            "{not json",
+            "[]",
+            '"package-lock"',
+            '{"packages": ["node_modules/a"]}',
+            '{"packages": {"node_modules/a": "1.0.0"}}',
+            '{"dependencies": {"a": null}}',
+            '{"packages": {"node_modules/a": {"resolved": 1}}}',
+        ):
+            with self.subTest(text=text):
+                with self.assertRaises(ValueError):
+                    parse_package_lock(text)
+
+    def test_empty_lockfile(self):
+        self.assertEqual(parse_package_lock("{}"), ([], []))
+
+
+class ParseGoSumTest(unittest.TestCase):
+    def test_module_zips(self):
+        targets = parse_go_sum(
+            "github.com/BurntSushi/toml v1.3.2 h1:abc=\n"
+            "github.com/BurntSushi/toml v1.3.2/go.mod h1:def=\n"
+            "golang.org/x/text v0.14.0/go.mod h1:ghi=\n"
+            "github.com/BurntSushi/toml v1.3.2 h1:abc=\n"
+            "\n"
+            "malformed line\n"
+        )
+        self.assertEqual(
+            [target.url for target in targets],
+            [get_module_zip_url("github.com/BurntSushi/toml", "v1.3.2")],
+        )
+
+
+class ParseImagesTest(unittest.TestCase):
+    DIGEST = "sha256:" + "c" * 64
+
+    def test_image_list(self):
+        self.assertEqual(
+            parse_image_list("# base images\nnginx:1.25\n\n  redis  # cache\n"),
+            ["nginx:1.25", "redis"],
+        )
+
+    def test_docker_hub_references(self):
+        self.assertEqual(
+            parse_image_reference("nginx"),
+            (BASE_URL_DOCKERHUB, "library/nginx", "latest"),
+        )
+        self.assertEqual(
+            parse_image_reference("nginx:1.25"),
+            (BASE_URL_DOCKERHUB, "library/nginx", "1.25"),
+        )
+        self.assertEqual(
+            parse_image_reference("docker.io/bitnami/redis:7.2"),
+            (BASE_URL_DOCKERHUB, "bitnami/redis", "7.2"),
+        )
+
+    def test_other_registries(self):
+        self.assertEqual(
+            parse_image_reference(f"ghcr.io/org/app@{self.DIGEST}"),
+            (BASE_URL_GHCR, "org/app", self.DIGEST),
+        )
+        self.assertEqual(
+            parse_image_reference("ghcr.io/org/app"),
+            (BASE_URL_GHCR, "org/app", "latest"),
+        )
+
+    def test_unknown_registry(self):
+        self.assertIsNone(parse_image_reference("localhost:5000/app:1.0"))
+        self.assertIsNone(parse_image_reference("registry.example.com/app"))
+
+
+class SplitDistFilenameTest(unittest.TestCase):
+    def test_filenames(self):
+        self.assertEqual(
+            split_dist_filename("requests-2.31.0-py3-none-any.whl"),
+            ("requests", "2.31.0"),
+        )
+        self.assertEqual(
+            split_dist_filename("python-dateutil-2.8.2.tar.gz"),
+            ("python-dateutil", "2.8.2"),
+        )
+        self.assertIsNone(split_dist_filename("broken.whl"))
+        self.assertIsNone(split_dist_filename("README.md"))
+
+
+if __name__ == "__main__":
+    unittest.main()